@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+"""Benchmarks for jqsh.
+
+Usage:
+  benchmarks.py [<benchmark>...]
+
+Runs all benchmarks if none are named.
+"""
+
+import sys
+
+import asyncio
+import concurrent.futures
+import jqsh.cache
+import jqsh.channel
+import jqsh.cli
+import jqsh.compiler
+import jqsh.context
+import jqsh.optimizer
+import jqsh.parser
+import jqsh.pool
+import jqsh.values
+import pathlib
+import tempfile
+import time
+import tracemalloc
+
+benchmarks = {}
+
+def benchmark(f):
+    benchmarks[f.__name__] = f
+    return f
+
+def generated_module(num_statements):
+    return ''.join('$x' + chr(ord('a') + i % 26) + ' = [{"key": ' + str(i) + '}, (1 . 5)] | .0 + $y * 2, if isMain then argv 1 else null end; # statement ' + str(i) + '\n' for i in range(num_statements)) + '.\n'
+
+def json_records(num_records):
+    return ''.join('{"id": ' + str(i) + ', "name": "record number ' + str(i) + '", "tags": ["a", "b\\n", "\\u00e9"], "active": true, "parent": null}\n' for i in range(num_records))
+
+def timed(f, *args, **kwargs):
+    start = time.perf_counter()
+    ret = f(*args, **kwargs)
+    return time.perf_counter() - start, ret
+
+@benchmark
+def tokenize():
+    for num_records in (1000, 10000, 50000):
+        text = json_records(num_records)
+        size = len(text.encode('utf-8')) / 1000000
+        seconds, tokens = timed(lambda: sum(1 for token in jqsh.parser.tokenize(text)))
+        print('tokenize: {:.1f} MB, {} tokens in {:.2f}s ({:.2f} MB/s)'.format(size, tokens, seconds, size / seconds))
+
+@benchmark
+def parse():
+    for num_statements in (100, 1000, 10000):
+        tokens = list(jqsh.parser.tokenize(generated_module(num_statements)))
+        seconds, _ = timed(jqsh.parser.parse, tokens, line_numbers=True)
+        print('parse: module with {} statements ({} tokens) in {:.2f}s ({:.0f} tokens/s)'.format(num_statements, len(tokens), seconds, len(tokens) / seconds))
+
+@benchmark
+def cancellation():
+    for filter_string in ('1000000 | range | nth 0', '1000000 | range | . * 2 | nth 10', '1000000 | range | each (.) | nth 0'):
+        for engine in ('threads', 'generators'):
+            seconds, output = timed(lambda: list(jqsh.cli.start_filter(jqsh.parser.parse(filter_string), jqsh.channel.Channel(terminated=True), engine=engine)))
+            start = time.perf_counter()
+            while jqsh.pool.default_pool.stats()['busy_workers'] > 0: # upstream filters which are still running
+                time.sleep(0.001)
+            idle_seconds = time.perf_counter() - start
+            print('cancellation: {} with {} in {:.3f}s, workers idle {:.3f}s later'.format(filter_string, engine, seconds, idle_seconds))
+
+@benchmark
+def channel_batches():
+    values = [jqsh.values.Number(number) for number in range(100000)]
+    def one_by_one(channel):
+        for value in values:
+            channel.push(value)
+        channel.terminate()
+        return sum(1 for value in channel)
+    def batched(channel):
+        for start in range(0, len(values), jqsh.channel.batch_size):
+            channel.push_many(values[start:start + jqsh.channel.batch_size])
+        channel.terminate()
+        return sum(len(batch) for batch in channel.batches())
+    for transport in (one_by_one, batched):
+        seconds, num_values = timed(transport, jqsh.channel.Channel())
+        print('channel_batches: {} {} values in {:.3f}s ({:.0f} values/s)'.format(transport.__name__, num_values, seconds, num_values / seconds))
+    for filter_string in ('[100000 | range]', '[100000 | range | [.] | .0]', '[300 | range | each (. | range)]'):
+        the_filter = jqsh.parser.parse(filter_string)
+        seconds, _ = timed(lambda: list(the_filter.start(jqsh.channel.Channel(terminated=True))))
+        print('channel_batches: {} in {:.2f}s'.format(filter_string, seconds))
+
+@benchmark
+def channel_split():
+    for num_channels in (2, 8):
+        source = jqsh.channel.Channel(capacity=1024)
+        def write():
+            for start in range(0, 100000, jqsh.channel.batch_size):
+                source.push_many(jqsh.values.Number(number) for number in range(start, min(start + jqsh.channel.batch_size, 100000)))
+            source.terminate()
+        def read_all(split_channels):
+            counts = [0] * len(split_channels)
+            def read(index):
+                for value in split_channels[index]:
+                    counts[index] += 1
+            for job in [jqsh.pool.start(read, index) for index in range(len(split_channels))]:
+                job.join()
+            return sum(counts)
+        writer = jqsh.pool.start(write)
+        tracemalloc.start()
+        seconds, num_values = timed(read_all, source / num_channels)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        writer.join()
+        print('channel_split: {} values read from {} split channels in {:.2f}s, peak heap usage {:.1f} MB'.format(num_values, num_channels, seconds, peak / 1000000))
+    for filter_string in ('[100000 | range | (., .)]', '[30000 | range | if . then 1 else 2 end]'):
+        the_filter = jqsh.parser.parse(filter_string)
+        tracemalloc.start()
+        seconds, _ = timed(lambda: list(the_filter.start(jqsh.channel.Channel(terminated=True))))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('channel_split: {} in {:.2f}s, peak heap usage {:.1f} MB'.format(filter_string, seconds, peak / 1000000))
+
+@benchmark
+def channel_core():
+    for description, construct in (('empty Channel', jqsh.channel.Channel), ('terminated Channel', lambda: jqsh.channel.Channel(terminated=True)), ('String value', lambda: jqsh.values.String('ab')), ('Array value', lambda: jqsh.values.Array([1, 2]))):
+        seconds, _ = timed(lambda: [construct() for _ in range(50000)])
+        print('channel_core: constructing 50000 of {} in {:.3f}s ({:.1f} µs each)'.format(description, seconds, seconds * 20))
+    for capacity in (0, 1024):
+        channel = jqsh.channel.Channel(capacity=capacity)
+        def write():
+            for number in range(100000):
+                channel.push(number)
+            channel.terminate()
+        writer = jqsh.pool.start(write)
+        seconds, num_values = timed(lambda: sum(1 for value in channel))
+        writer.join()
+        print('channel_core: push/pop {} values between threads with capacity {} in {:.2f}s ({:.0f} values/s)'.format(num_values, capacity, seconds, num_values / seconds))
+
+@benchmark
+def channel_capacity():
+    the_filter = jqsh.parser.parse('100000 | range')
+    for capacity in (0, 1024):
+        jqsh.channel.default_capacity = capacity
+        output_channel = the_filter.start(jqsh.channel.Channel(terminated=True))
+        tracemalloc.start()
+        seconds, num_values = timed(lambda: sum(1 for value in output_channel if str(value))) # the reader formats each value, so it is slower than the writer
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('channel_capacity({}): {} values in {:.2f}s, peak heap usage {:.1f} MB'.format(capacity, num_values, seconds, peak / 1000000))
+    jqsh.channel.default_capacity = 0
+
+@benchmark
+def compiler():
+    examples_directory = pathlib.Path(__file__).with_name('examples')
+    filters = {path.name: path.read_text() for path in sorted(examples_directory.glob('*.jqsh'))}
+    filters.update({
+        'pipeline': '[1000 | range | . * 2 | [., .] | .1]',
+        'local variables': '[1000 | range | x = . | [x, x + 1]]',
+        'global variable': '$n = 3; [1000 | range | . * $n]'
+    })
+    for description, filter_string in filters.items():
+        try:
+            the_filter = jqsh.parser.parse(filter_string)
+        except SyntaxError as e:
+            print('compiler: {} does not parse: {}'.format(description, e))
+            continue
+        jqsh.compiler.compile_filter.cache_clear()
+        seconds, _ = timed(jqsh.compiler.compile_filter, the_filter)
+        print('compiler: {} compiled in {:.2f}ms'.format(description, seconds * 1000))
+        for engine in ('threads', 'generators', 'compiled'):
+            seconds, _ = timed(lambda: [list(jqsh.cli.start_filter(the_filter, jqsh.channel.Channel(context=jqsh.context.FilterContext.command_line_context([description, '20']), terminated=True), engine=engine)) for _ in range(20)])
+            print('compiler: {} with {} in {:.2f}ms per run'.format(description, engine, seconds * 50))
+
+@benchmark
+def engines():
+    filters = {
+        'arithmetic': '[1 + 2 * 3, "ab" * 2, [1] + [2]]',
+        'pipeline': '[1000 | range | . * 2 | [., .] | .1]',
+        'reduce': '500 | range | reduce 0 (. + 1)',
+        'module with 100 statements': generated_module(100).replace('argv 1', 'argv'),
+        'quine example': pathlib.Path(__file__).with_name('examples').joinpath('quine.jqsh').read_text()
+    }
+    for description, filter_string in filters.items():
+        the_filter = jqsh.parser.parse(filter_string)
+        for engine in ('threads', 'generators', 'compiled'):
+            seconds, output = timed(lambda: list(jqsh.cli.start_filter(the_filter, jqsh.channel.Channel(terminated=True), engine=engine)))
+            print('engines: {} with {} in {:.3f}s, {} output values'.format(description, engine, seconds, len(output)))
+
+@benchmark
+def fusion():
+    records = list(jqsh.parser.parse_json_values(json_records(5000)))
+    filters = {
+        'lookups and arithmetic': '. | ."id" | . * 2 + 1',
+        'nested lookups': '."tags" | .1',
+        'fused stage before a collecting filter': '[."id" + 1 | . * 3]'
+    }
+    for description, filter_string in filters.items():
+        the_filter = jqsh.parser.parse(filter_string)
+        for engine in ('threads', 'generators'):
+            for fuse_pipelines in (False, True):
+                jqsh.optimizer.fuse_pipelines = fuse_pipelines
+                jqsh.optimizer.optimize.cache_clear()
+                seconds, output = timed(lambda: list(jqsh.cli.start_filter(the_filter, jqsh.channel.Channel(*records, terminated=True), engine=engine)))
+                print('fusion: {} with {}, {} in {:.3f}s, {} output values'.format(description, engine, 'fused' if fuse_pipelines else 'not fused', seconds, len(output)))
+    jqsh.optimizer.fuse_pipelines = True
+    jqsh.optimizer.optimize.cache_clear()
+
+@benchmark
+def module_cache():
+    with tempfile.TemporaryDirectory() as temp_directory:
+        module_path = pathlib.Path(temp_directory) / 'module.jqsh'
+        for num_statements in (100, 1000, 10000):
+            module_path.write_text(generated_module(num_statements))
+            seconds, _ = timed(jqsh.cache.load_module, module_path)
+            print('module_cache: module with {} statements, first run in {:.3f}s'.format(num_statements, seconds))
+            seconds, _ = timed(jqsh.cache.load_module, module_path)
+            print('module_cache: module with {} statements, cached in {:.3f}s'.format(num_statements, seconds))
+
+@benchmark
+def optimizer():
+    filters = {
+        'constants': '[1000 | range | . * (2 + 1.5) + ((1 + 2) * 3)]',
+        'parens and identities': '[1000 | range | ((((. | .)))) | [((.)), (.)] | .1]'
+    }
+    for description, filter_string in filters.items():
+        the_filter = jqsh.parser.parse(filter_string)
+        jqsh.optimizer.optimize.cache_clear()
+        seconds, _ = timed(jqsh.optimizer.optimize, the_filter)
+        print('optimizer: {} optimized in {:.2f}ms'.format(description, seconds * 1000))
+        for engine in ('threads', 'generators'):
+            for enabled in (False, True):
+                jqsh.optimizer.enabled = enabled
+                seconds, _ = timed(lambda: list(jqsh.cli.start_filter(the_filter, jqsh.channel.Channel(terminated=True), engine=engine)))
+                print('optimizer: {} with {}, {} in {:.3f}s'.format(description, engine, 'optimized' if enabled else 'not optimized', seconds))
+    jqsh.optimizer.enabled = True
+
+@benchmark
+def parse_json_events():
+    for num_records in (200, 2000):
+        text = '[' + json_records(num_records).replace('\n', ',') + 'null]' # one big top-level value
+        size = len(text.encode('utf-8')) / 1000000
+        for parse in (jqsh.parser.parse_json_values, jqsh.parser.parse_json_events):
+            tracemalloc.start()
+            seconds, num_values = timed(lambda: sum(1 for value in parse(text)))
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print('{}: {:.2f} MB single value, {} values in {:.2f}s, peak heap usage {:.1f} MB'.format(parse.__name__, size, num_values, seconds, peak / 1000000))
+
+@benchmark
+def parse_json_records():
+    for num_records in (10000, 50000):
+        text = json_records(num_records)
+        size = len(text.encode('utf-8')) / 1000000
+        chunks = [text[i:i + 65536] for i in range(0, len(text), 65536)]
+        seconds, _ = timed(lambda: list(jqsh.parser.parse_json_chunks(chunks)))
+        print('parse_json_chunks: {} records ({:.1f} MB) in {:.2f}s ({:.2f} MB/s)'.format(num_records, size, seconds, size / seconds))
+        seconds, _ = timed(lambda: list(jqsh.parser.parse_json_records(chunks)))
+        print('parse_json_records: {} records ({:.1f} MB) in {:.2f}s ({:.2f} MB/s)'.format(num_records, size, seconds, size / seconds))
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            seconds, _ = timed(lambda: list(jqsh.parser.parse_json_records(chunks, executor=executor)))
+        print('parse_json_records with a process pool: {} records ({:.1f} MB) in {:.2f}s ({:.2f} MB/s)'.format(num_records, size, seconds, size / seconds))
+
+@benchmark
+def parse_json_values():
+    for num_records in (1000, 10000):
+        text = '[' + json_records(num_records).replace('\n', ',') + 'null]' # one big top-level value
+        size = len(text.encode('utf-8')) / 1000000
+        seconds, _ = timed(lambda: list(jqsh.parser.parse_json_values(text)))
+        print('parse_json_values: {:.1f} MB single value in {:.2f}s ({:.2f} MB/s)'.format(size, seconds, size / seconds))
+        chunks = [text[i:i + 65536] for i in range(0, len(text), 65536)]
+        seconds, _ = timed(lambda: list(jqsh.parser.parse_json_chunks(chunks)))
+        print('parse_json_chunks: {:.1f} MB single value in 64 KB chunks in {:.2f}s ({:.2f} MB/s)'.format(size, seconds, size / seconds))
+
+@benchmark
+def plain_json_input():
+    for num_records in (1000, 10000):
+        text = json_records(num_records)
+        size = len(text.encode('utf-8')) / 1000000
+        chunks = [text[i:i + 65536] for i in range(0, len(text), 65536)]
+        for fast in (False, True):
+            seconds, _ = timed(lambda: list(jqsh.parser.parse_json_chunks(chunks, fast=fast)))
+            print('parse_json_chunks(fast={}): {} records ({:.1f} MB) in {:.2f}s ({:.2f} MB/s)'.format(fast, num_records, size, seconds, size / seconds))
+            seconds, _ = timed(lambda: [str(value) for value in jqsh.parser.parse_json_chunks(chunks, fast=fast)])
+            print('parse_json_chunks(fast={}) and reading every value: {} records ({:.1f} MB) in {:.2f}s ({:.2f} MB/s)'.format(fast, num_records, size, seconds, size / seconds))
+        def scan_only():
+            position = 0
+            while position < len(text):
+                _, position = jqsh.parser.plain_json_decoder.raw_decode(text, position)
+                position = jqsh.parser.plain_json_whitespace_pattern.match(text, position).end()
+        seconds, _ = timed(scan_only)
+        print('json scanner without conversion to jqsh values: {} records ({:.1f} MB) in {:.2f}s ({:.2f} MB/s)'.format(num_records, size, seconds, size / seconds))
+
+@benchmark
+def read_chunks():
+    with tempfile.TemporaryDirectory() as temp_directory:
+        input_path = pathlib.Path(temp_directory) / 'input.json'
+        input_path.write_text(json_records(200000))
+        size = input_path.stat().st_size / 1000000
+        for memory_map in (False, True):
+            with input_path.open('rb') as input_file:
+                tracemalloc.start()
+                seconds, _ = timed(lambda: sum(len(chunk) for chunk in jqsh.cli.read_chunks(input_file, memory_map=memory_map)))
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            print('read_chunks(memory_map={}): {:.1f} MB in {:.2f}s ({:.0f} MB/s), peak heap usage {:.0f} KB'.format(memory_map, size, seconds, size / seconds, peak / 1000))
+
+@benchmark
+def worker_pool():
+    the_filter = jqsh.parser.parse('[1000 | range | . * 2 | [., .] | .1], ($a = 1; $a + 1)')
+    for max_idle_workers in (0, 64): # with no idle workers kept, every job starts a new thread, like before there was a pool
+        jqsh.pool.default_pool = jqsh.pool.WorkerPool(max_idle_workers=max_idle_workers)
+        for _ in range(3): # warm up
+            list(the_filter.start(jqsh.channel.Channel(terminated=True)))
+        seconds, _ = timed(lambda: [list(the_filter.start(jqsh.channel.Channel(terminated=True))) for _ in range(20)])
+        stats = jqsh.pool.default_pool.stats()
+        print('worker_pool(max_idle_workers={}): 20 runs in {:.2f}s, {} jobs, {} worker threads started, peak {} workers'.format(max_idle_workers, seconds, stats['jobs_started'], stats['workers_started'], stats['peak_workers']))
+    jqsh.pool.default_pool = jqsh.pool.WorkerPool()
+
+@benchmark
+def asyncio_engine():
+    the_filter = jqsh.parser.parse('. | !"cat" | . * 2')
+    
+    async def run_concurrently(num_evaluations):
+        return await asyncio.gather(*(the_filter.run_async([i]) for i in range(num_evaluations)))
+    
+    for num_evaluations in (10, 100, 1000):
+        seconds, _ = timed(asyncio.run, run_concurrently(num_evaluations))
+        print('asyncio engine: {} concurrent evaluations with a command in {:.2f}s on one thread'.format(num_evaluations, seconds))
+        seconds, _ = timed(lambda: [list(jqsh.cli.start_filter(the_filter, jqsh.channel.Channel(i, terminated=True))) for i in range(num_evaluations)])
+        print('threads engine: {} evaluations with a command, one after another, in {:.2f}s'.format(num_evaluations, seconds))
+
+@benchmark
+def output_pairs():
+    for num_values in (10000, 100000):
+        the_filter = jqsh.parser.parse('(' + str(num_values) + ' | range) + 1 | nth ' + str(num_values - 1))
+        for engine in ('threads', 'compiled'):
+            tracemalloc.start()
+            seconds, _ = timed(lambda: list(jqsh.cli.start_filter(the_filter, jqsh.channel.Channel(terminated=True), engine=engine)))
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print('output_pairs: a single value paired with {} values with the {} engine in {:.2f}s, peak heap usage {:.1f} MB'.format(num_values, engine, seconds, peak / 1000000))
+
+@benchmark
+def conditional():
+    for num_values in (10000, 100000):
+        for condition in ('.', '[.]'): # a mapping condition, computed inline, and one that is evaluated for each value
+            the_filter = jqsh.parser.parse(str(num_values) + ' | range | if ' + condition + ' then . + 1 else "zero" end | nth ' + str(num_values - 1))
+            for engine in ('threads', 'compiled'):
+                tracemalloc.start()
+                seconds, _ = timed(lambda: list(jqsh.cli.start_filter(the_filter, jqsh.channel.Channel(terminated=True), engine=engine)))
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                print('conditional: if {} on {} values with the {} engine in {:.2f}s, peak heap usage {:.1f} MB'.format(condition, num_values, engine, seconds, peak / 1000000))
+
+@benchmark
+def try_catch():
+    for num_values in (10000, 100000):
+        the_filter = jqsh.parser.parse('try (' + str(num_values) + ' | range) catch "error" end | nth ' + str(num_values - 1))
+        for engine in ('threads', 'compiled'):
+            tracemalloc.start()
+            seconds, _ = timed(lambda: list(jqsh.cli.start_filter(the_filter, jqsh.channel.Channel(terminated=True), engine=engine)))
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print('try_catch: try on {} values with the {} engine in {:.2f}s, peak heap usage {:.1f} MB'.format(num_values, engine, seconds, peak / 1000000))
+
+if __name__ == '__main__':
+    for benchmark_name in sys.argv[1:] or sorted(benchmarks):
+        benchmarks[benchmark_name]()
@@ -1,9 +1,15 @@
 __all__ = [
+    'asynchronous',
+    'cache',
     'channel',
     'cli',
+    'compiler',
     'context',
+    'evaluation',
     'filter',
     'functions',
+    'optimizer',
     'parser',
+    'pool',
     'values'
 ]
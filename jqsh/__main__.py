@@ -3,32 +3,52 @@
 """A shell based on jq.
 
 Usage:
-  jqsh [<module_file> [<arguments>...]]
-  jqsh -c <filter> | --filter=<filter> [<arguments>...]
+  jqsh [--engine=<engine>] [--capacity=<n>] [--timeout=<seconds>] [--no-optimize] [--ndjson | --seq | --stream] [<module_file> [<arguments>...]]
+  jqsh [--engine=<engine>] [--capacity=<n>] [--timeout=<seconds>] [--no-optimize] [--ndjson | --seq | --stream] -c <filter> | --filter=<filter> [<arguments>...]
+  jqsh [--no-optimize] --explain (<module_file> | -c <filter> | --filter=<filter>)
   jqsh -h | --help
 
 Options:
+  --capacity=<n>         How many values may wait in the output channel of each filter with the threads engine before the filter waits for its reader [default: 1024]. 0 means unlimited, which uses more memory when a filter is faster than its reader.
   -c, --filter=<filter>  Apply this filter to the standard input instead of starting interactive mode.
+  --engine=<engine>      How filters are evaluated: "threads" (the default) runs every filter on its own thread, "generators" runs them all on one thread as chained generators, which is faster but runs the statements of a module strictly one after another, "compiled" runs them like "generators" after compiling them into closures.
+  --explain              Print the rewrites made by the optimizer and the parse tree that would run, instead of running the filter or module.
   -h, --help             Print this message and exit.
+  --ndjson               Read the standard input as one JSON value per line. Malformed lines are reported and skipped.
+  --no-optimize          Run filters as they are parsed, without folding constants or removing redundant parens and identity filters first.
+  --seq                  Read the standard input as an RFC 7464 JSON text sequence, with each value preceded by an ASCII record separator. Malformed records are reported and skipped.
+  --stream               Read the standard input as [path, leaf] and [path] events like jq's --stream option, so that huge values can be processed in constant memory. The fromStream, toStream and truncateStream builtins work with these events.
+  --timeout=<seconds>    Cancel the filter, or each filter entered in interactive mode, if it hasn't finished after this many seconds: its threads and command processes are stopped, and its output ends with a timeout exception. Pressing control-C cancels it the same way.
 """
 
 import sys
 
 sys.path.append('/opt/py')
 
+import jqsh.cache
 import jqsh.channel
 import jqsh.context
 import jqsh.cli
 import jqsh.filter
+import jqsh.optimizer
 import jqsh.parser
 import json
 import pathlib
+import threading
+import time
 
 arguments = sys.argv[1:]
 
+capacity = 1024
+engine = 'threads'
+explain = False
 filter_argument = None
 module = None
+optimize = True
 parse_options = True
+record_separator = None
+stream = False
+timeout = None
 
 while len(arguments):
     if parse_options and (arguments[0].startswith('-c') or arguments[0].startswith('--filter=') or arguments[0] == '--filter'):
@@ -47,6 +67,56 @@ while len(arguments):
     elif parse_options and (arguments[0] == '--help' or arguments[0].startswith('-h')):
         print('jqsh:', __doc__)
         sys.exit()
+    elif parse_options and (arguments[0].startswith('--capacity=') or arguments[0] == '--capacity'):
+        if arguments[0] == '--capacity' and len(arguments) > 1:
+            capacity_argument = arguments[1]
+            arguments = arguments[2:]
+        else:
+            capacity_argument = arguments[0][len('--capacity='):]
+            arguments.pop(0)
+        try:
+            capacity = int(capacity_argument)
+            if capacity < 0:
+                raise ValueError('capacity must not be negative')
+        except ValueError:
+            sys.exit('[!!!!] jqsh: invalid capacity: ' + capacity_argument)
+    elif parse_options and (arguments[0].startswith('--engine=') or arguments[0] == '--engine'):
+        if arguments[0] == '--engine' and len(arguments) > 1:
+            engine = arguments[1]
+            arguments = arguments[2:]
+        else:
+            engine = arguments[0][len('--engine='):]
+            arguments.pop(0)
+        if engine not in ('threads', 'generators', 'compiled'):
+            sys.exit('[!!!!] jqsh: unknown engine: ' + engine)
+    elif parse_options and arguments[0] == '--explain':
+        explain = True
+        arguments.pop(0)
+    elif parse_options and arguments[0] == '--ndjson':
+        record_separator = '\n'
+        arguments.pop(0)
+    elif parse_options and arguments[0] == '--no-optimize':
+        optimize = False
+        arguments.pop(0)
+    elif parse_options and arguments[0] == '--seq':
+        record_separator = '\x1e'
+        arguments.pop(0)
+    elif parse_options and arguments[0] == '--stream':
+        stream = True
+        arguments.pop(0)
+    elif parse_options and (arguments[0].startswith('--timeout=') or arguments[0] == '--timeout'):
+        if arguments[0] == '--timeout' and len(arguments) > 1:
+            timeout_argument = arguments[1]
+            arguments = arguments[2:]
+        else:
+            timeout_argument = arguments[0][len('--timeout='):]
+            arguments.pop(0)
+        try:
+            timeout = float(timeout_argument)
+            if not timeout > 0:
+                raise ValueError('timeout must be positive')
+        except ValueError:
+            sys.exit('[!!!!] jqsh: invalid timeout: ' + timeout_argument)
     elif parse_options and arguments[0] == '--':
         parse_options = False
         arguments.pop(0)
@@ -59,36 +129,67 @@ while len(arguments):
     else:
         break
 
+if stream and record_separator is not None:
+    sys.exit('[!!!!] jqsh: --stream cannot be combined with --ndjson or --seq')
+
+if explain and filter_argument is None and module is None:
+    sys.exit('[!!!!] jqsh: --explain needs a filter or module')
+
+jqsh.channel.default_capacity = capacity
+jqsh.optimizer.enabled = optimize
+
 if filter_argument is not None or module is not None:
     if sys.stdin.isatty():
         stdin_channel = jqsh.channel.Channel(context=jqsh.context.FilterContext.command_line_context(['--filter' if filter_argument is not None else module] + arguments), terminated=True)
     else:
-        stdin_channel = jqsh.channel.Channel(*jqsh.parser.parse_json_values(sys.stdin.read()), context=jqsh.context.FilterContext.command_line_context(['--filter' if filter_argument is not None else module] + arguments), terminated=True) #TODO fix: this currently waits to read the entire stdin before even looking at the filter
+        stdin_channel = jqsh.channel.Channel(context=jqsh.context.FilterContext.command_line_context(['--filter' if filter_argument is not None else module] + arguments), empty_namespaces=True, capacity=capacity) # so that a huge input is read as fast as it is processed
+        threading.Thread(target=jqsh.cli.read_input, args=(sys.stdin, stdin_channel), kwargs={'record_separator': record_separator, 'stream': stream}, name='jqsh stdin reader', daemon=True).start() # daemon so that the filter can finish without waiting for an endless input stream
     if module is None:
         try:
-            the_filter = jqsh.parser.parse(filter_argument)
+            the_filter = jqsh.cache.parse(filter_argument)
         except (SyntaxError, jqsh.parser.Incomplete) as e:
             sys.exit('[!!!!] jqsh: syntax error in filter: ' + str(e))
     else:
-        with module.resolve().open() as module_file:
-            try:
-                the_filter = jqsh.parser.parse(module_file.read(), line_numbers=True)
-            except (SyntaxError, jqsh.parser.Incomplete) as e:
-                sys.exit('[!!!!] jqsh: syntax error reading module: ' + str(e))
-    jqsh.cli.print_output(jqsh.filter.FilterThread(the_filter, input_channel=stdin_channel)) #TODO fix: this currently waits to read the entire module file before starting to tokenize it
+        try:
+            the_filter = jqsh.cache.load_module(module, stream=not explain) # explain shows the whole module
+        except (SyntaxError, jqsh.parser.Incomplete) as e:
+            sys.exit('[!!!!] jqsh: syntax error reading module: ' + str(e))
+    if explain:
+        if optimize:
+            the_filter, rewrites = jqsh.optimizer.explain(the_filter)
+            for original, rewritten in rewrites:
+                print('rewrite:', repr(original), '->', repr(rewritten))
+        print('filter:', repr(the_filter))
+        sys.exit()
+    output_channel = jqsh.cli.start_filter(the_filter, stdin_channel, engine=engine, deadline=None if timeout is None else time.monotonic() + timeout)
+    try:
+        jqsh.cli.print_output(output_channel)
+    except KeyboardInterrupt:
+        output_channel.evaluation.cancel()
+        jqsh.cli.report_cancellation(output_channel.evaluation, output_file=sys.stderr)
+        sys.exit(130)
+    jqsh.cli.report_cancellation(output_channel.evaluation, output_file=sys.stderr)
     sys.exit()
 
 global_namespace = {}
 local_namespace = {}
 format_strings = {}
 while True: # a simple repl
+    output_channel = None
     try:
-        global_namespace, local_namespace, format_strings = jqsh.cli.print_output(jqsh.filter.FilterThread(jqsh.parser.parse(input('jqsh> ')), input_channel=jqsh.channel.Channel(global_namespace=global_namespace, local_namespace=local_namespace, format_strings=format_strings, terminated=True)))
+        output_channel = jqsh.cli.start_filter(jqsh.cache.parse(input('jqsh> ')), jqsh.channel.Channel(global_namespace=global_namespace, local_namespace=local_namespace, format_strings=format_strings, terminated=True), engine=engine, deadline=None if timeout is None else time.monotonic() + timeout)
+        namespaces = jqsh.cli.print_output(output_channel)
     except EOFError:
         print('^D')
         break
     except KeyboardInterrupt:
         print() # add a newline after the Python-provided '^C'
+        if output_channel is not None: # stop the filter's threads and commands, and keep the namespaces from before it
+            output_channel.evaluation.cancel()
+            jqsh.cli.report_cancellation(output_channel.evaluation)
         continue
     except (SyntaxError, jqsh.parser.Incomplete) as e:
         print('jqsh: syntax error: ' + str(e))
+    else:
+        global_namespace, local_namespace, format_strings = namespaces
+        jqsh.cli.report_cancellation(output_channel.evaluation) # if the deadline has passed
@@ -0,0 +1,751 @@
+import sys
+
+import asyncio
+import codecs
+import contextlib
+import jqsh.channel
+import jqsh.compiler
+import jqsh.context
+import jqsh.filter
+import jqsh.optimizer
+import jqsh.parser
+import jqsh.pool
+import jqsh.values
+import subprocess
+import threading
+import traceback
+
+runners = {} # maps filter classes to functions returning the run functions of filters, see runner
+
+class AsyncChannel:
+    """A channel for the asyncio engine. The values are kept in an asyncio.Queue, so readers and writers are coroutines, and waiting for a value or for space suspends the task instead of blocking the thread.
+    
+    The namespaces are given like those of jqsh.channel.LazyChannel, as a tuple of global namespace, local namespace, format strings and context, or as another AsyncChannel to take them from. Otherwise the writer defines them once it knows them, see set_namespaces.
+    """
+    abandoned = False # has the reader stopped reading?
+    input_terminated = False # has the writer terminated the channel?
+    siblings = () # the channels split from the same channel, see __truediv__
+    task = None # the task writing the values, which is cancelled when the channel is abandoned, see start
+    tee_task = None # the task copying values into split channels, see __truediv__
+    terminated = False # has the reader reached the end?
+    
+    def __init__(self, values=None, namespaces=None, capacity=0):
+        """If values are given, the channel contains them and is terminated. Otherwise, if capacity is nonzero, push waits while that many values are waiting to be read."""
+        self.queue = asyncio.Queue(0 if values is not None else capacity)
+        self.namespace_values = None
+        self.namespaces_defined = asyncio.Event()
+        if namespaces is not None:
+            self.get_namespaces(namespaces)
+        if values is not None:
+            for value in values:
+                self.queue.put_nowait(jqsh.values.from_native(value))
+            self.terminate()
+    
+    def __aiter__(self):
+        return self
+    
+    async def __anext__(self):
+        """Returns the next value. Raises StopAsyncIteration if the channel is terminated."""
+        if self.terminated or self.input_terminated and self.queue.empty(): # the terminator isn't queued if the queue was full, see terminate
+            self.terminated = True
+            raise StopAsyncIteration
+        value = await self.queue.get()
+        if isinstance(value, jqsh.channel.Terminator):
+            self.terminated = True
+            raise StopAsyncIteration
+        return value
+    
+    def __truediv__(self, other):
+        """Splits the channel like jqsh.channel.Channel.__truediv__ does. A task copies the values into the split channels, which are unbounded, so that a split channel which isn't read yet doesn't keep the others from being read. Once all of them have been abandoned, this channel is abandoned as well."""
+        try:
+            other = int(other)
+        except:
+            return NotImplemented
+        ret = tuple(AsyncChannel(namespaces=self) for _ in range(other))
+        
+        async def tee():
+            try:
+                async for value in self:
+                    for channel in ret:
+                        await channel.push(value)
+            except asyncio.CancelledError:
+                self.abandon()
+                raise
+            finally:
+                for channel in ret:
+                    channel.terminate()
+        
+        tee_task = asyncio.ensure_future(tee())
+        for channel in ret:
+            channel.siblings = ret
+            channel.tee_task = tee_task
+        return ret
+    
+    def abandon(self):
+        """Called by the reader when it won't read any more values. The task writing the values is cancelled, which abandons the channels it was reading in turn, and values that are pushed afterwards are dropped."""
+        self.abandoned = True
+        while not self.queue.empty(): # wakes up a writer that waits for space
+            self.queue.get_nowait()
+        if self.task is not None:
+            self.task.cancel()
+        if self.tee_task is not None and all(channel.abandoned for channel in self.siblings):
+            self.tee_task.cancel()
+    
+    def get_namespaces(self, from_channel):
+        """Takes the namespaces from the given channel, or tuple, once they are needed."""
+        self.namespace_values = from_channel
+        self.namespaces_defined.set()
+    
+    async def namespaces(self, include_context=False):
+        """Returns the namespaces, waiting until they are defined. A reader should abandon the channel or read all of its values first, since the writer may only define them once it has finished."""
+        await self.namespaces_defined.wait()
+        if isinstance(self.namespace_values, AsyncChannel):
+            self.namespace_values = await self.namespace_values.namespaces(include_context=True)
+        return self.namespace_values if include_context else self.namespace_values[:3]
+    
+    async def push(self, value):
+        """Adds a value, waiting while the channel is full. The value is dropped if the channel has been abandoned."""
+        if self.abandoned:
+            return
+        if self.input_terminated:
+            raise RuntimeError('jqsh channel has terminated')
+        await self.queue.put(value)
+    
+    def set_namespaces(self, namespaces):
+        """Defines the namespaces, as a tuple like the one jqsh.filter.Filter.evaluate returns."""
+        self.get_namespaces(tuple(namespaces))
+    
+    async def take_first(self):
+        """Returns the first value and abandons the channel. Raises StopAsyncIteration if it is empty."""
+        try:
+            return await self.__anext__()
+        finally:
+            self.abandon()
+    
+    def terminate(self):
+        if self.input_terminated:
+            return
+        self.input_terminated = True
+        if not self.queue.full(): # otherwise the reader stops once it has emptied the queue, see __anext__
+            self.queue.put_nowait(jqsh.channel.Terminator())
+    
+    def with_values(self, *values):
+        """Returns a terminated channel containing the given values, with the same namespaces as this channel."""
+        return AsyncChannel(values, namespaces=self)
+
+async def collect(channel):
+    """Returns the list of values from a channel. The channel is abandoned if this is cancelled."""
+    try:
+        return [value async for value in channel]
+    finally:
+        channel.abandon()
+
+async def conditional_branch(the_filter, input_channel, value=None):
+    """The asyncio counterpart to jqsh.filter.Conditional.branch."""
+    conditional = False
+    for attribute_name, attribute_value in the_filter.attributes:
+        if attribute_name in ('if', 'elif', 'elseIf'):
+            function = None if value is None else attribute_value.map_function()
+            if function is None:
+                try:
+                    next_value = await start(attribute_value, input_channel.with_values() if value is None else input_channel.with_values(value)).take_first()
+                except StopAsyncIteration:
+                    return jqsh.values.JQSHException('empty')
+            else:
+                next_value = function(value)
+            if isinstance(next_value, jqsh.values.JQSHException):
+                return next_value
+            conditional = bool(next_value)
+        elif attribute_name == 'then':
+            if conditional:
+                return attribute_value
+        elif attribute_name == 'else':
+            return attribute_value
+        else:
+            raise NotImplementedError('unknown clause in if filter')
+    return None
+
+async def output_pairs(the_filter, input_channel):
+    """The asyncio counterpart to jqsh.filter.Operator.output_pairs, which reads the operands in lockstep and yields each pair as soon as both of its values are there."""
+    left_input, right_input = input_channel / 2
+    left_output = start(the_filter.left_operand, left_input)
+    right_output = start(the_filter.right_operand, right_input)
+    left_values = []
+    right_values = []
+    try:
+        while True:
+            try:
+                left_value = await left_output.__anext__()
+            except StopAsyncIteration:
+                shorter_is_left, shorter_values, longer_output, longer_values = True, left_values, right_output, []
+                break
+            try:
+                right_value = await right_output.__anext__()
+            except StopAsyncIteration:
+                shorter_is_left, shorter_values, longer_output, longer_values = False, right_values, left_output, [left_value]
+                break
+            left_values.append(left_value)
+            right_values.append(right_value)
+            yield left_value, right_value
+        left_values = right_values = None # the longer operand's values are not needed any more
+        i = len(shorter_values)
+        async for value in prepend(longer_values, longer_output):
+            if len(shorter_values) == 0:
+                yield value
+            else:
+                shorter_value = shorter_values[i % len(shorter_values)]
+                yield (shorter_value, value) if shorter_is_left else (value, shorter_value)
+            i += 1
+    finally:
+        left_output.abandon()
+        right_output.abandon()
+
+async def prepend(values, channel):
+    """Yields the given values, then those from the channel."""
+    for value in values:
+        yield value
+    async for value in channel:
+        yield value
+
+async def run(the_filter, values=(), *, global_namespace=None, local_namespace=None, format_strings=None, context=None):
+    """Runs the filter on the given input values and returns the list of its output values.
+    
+    Unless jqsh.optimizer.enabled is false, the filter is optimized first. Cancelling the coroutine, e.g. with asyncio.wait_for, cancels the filter: its tasks are cancelled and its command processes killed.
+    """
+    if jqsh.optimizer.enabled:
+        the_filter = jqsh.optimizer.optimize(the_filter)
+    input_channel = AsyncChannel(values, namespaces=({} if global_namespace is None else global_namespace, {} if local_namespace is None else local_namespace, {} if format_strings is None else format_strings, jqsh.context.FilterContext() if context is None else context))
+    output_channel = start(the_filter, input_channel)
+    try:
+        return await collect(output_channel)
+    finally:
+        output_channel.abandon() # cancels the filter if this coroutine has been cancelled
+
+async def run_command(command_name, input_channel):
+    """The asyncio counterpart to jqsh.filter.Command.run_command. The command is started with asyncio.create_subprocess_exec, a task writes the input, and the output is decoded as it arrives. If the generator is closed before the command has finished, the command is killed."""
+    if isinstance(command_name, str): # a command without arguments, see jqsh.filter.Command.run
+        command_name = [command_name]
+    try:
+        process = await asyncio.create_subprocess_exec(*command_name, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        yield jqsh.values.JQSHException('path')
+        return
+    except PermissionError:
+        yield jqsh.values.JQSHException('permission')
+        return
+    
+    async def write_input():
+        try:
+            async for value in input_channel:
+                process.stdin.write(str(value).encode('utf-8') + b'\n')
+                await process.stdin.drain()
+            process.stdin.write(b'\x04')
+            await process.stdin.drain()
+        except OSError: # the command has exited or been killed
+            input_channel.abandon()
+        except asyncio.CancelledError:
+            input_channel.abandon()
+            raise
+        finally:
+            with contextlib.suppress(OSError):
+                process.stdin.close()
+    
+    writer = asyncio.ensure_future(write_input())
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    tokenizer = jqsh.parser.ChunkTokenizer()
+    decoder = jqsh.parser.JSONDecoder()
+    finished = False
+    try:
+        try:
+            while True:
+                data = await process.stdout.read(65536)
+                if not data:
+                    break
+                for value in decoder.decode(tokenizer.feed(text_decoder.decode(data))):
+                    yield value
+            for value in decoder.decode(tokenizer.feed(text_decoder.decode(b'', final=True)) + tokenizer.close()):
+                yield value
+            decoder.close()
+            finished = True
+        except (UnicodeDecodeError, SyntaxError, jqsh.parser.Incomplete):
+            finished = True
+            yield jqsh.values.JQSHException('commandOutput')
+    finally:
+        if not finished and process.returncode is None:
+            process.kill()
+        if not finished:
+            writer.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await writer
+        await process.wait()
+
+async def run_generators(the_filter, input_channel, output_channel):
+    """Runs a filter which has no asyncio runner, e.g. a builtin, with the compiled generator engine (see jqsh.compiler.compile_filter). Such filters are fully buffered: they only start once all input values have been read, since the input's namespaces may only be defined then.
+    
+    The generators run on a worker (see jqsh.pool), so that a command run by the filter, e.g. in the body of a builtin, doesn't block the event loop. The worker stays at most jqsh.channel.batch_size values ahead of the output channel, and each value is pushed as soon as it has been computed.
+    """
+    loop = asyncio.get_running_loop()
+    if not the_filter.changes_namespaces():
+        output_channel.get_namespaces(input_channel)
+    input_values = await collect(input_channel)
+    namespaces = await input_channel.namespaces(include_context=True)
+    the_filter = jqsh.compiler.compile_filter(the_filter)
+    lock = threading.Lock()
+    buffer = [] # values computed by the worker but not yet pushed, followed by the namespaces once it is done
+    ready = asyncio.Event() # set when the buffer was empty before the worker added to it
+    space = threading.Semaphore(jqsh.channel.batch_size)
+    stopped = [] # not empty once the output is no longer wanted
+    
+    def put(item):
+        with lock:
+            buffer.append(item)
+            wake = len(buffer) == 1
+        if wake:
+            loop.call_soon_threadsafe(ready.set)
+    
+    def run_worker():
+        output_values = the_filter.evaluate(jqsh.channel.LazyChannel(input_values, namespaces=namespaces))
+        try:
+            while True:
+                space.acquire()
+                if len(stopped):
+                    return
+                try:
+                    value = next(output_values)
+                except StopIteration as e:
+                    put((True, e.value))
+                    return
+                put((False, value))
+        except BaseException as e: # e.g. jqsh.evaluation.Cancelled, which would otherwise be printed by the worker
+            put((True, e))
+        finally:
+            output_values.close()
+    
+    jqsh.pool.start(run_worker)
+    try:
+        while True:
+            await ready.wait()
+            with lock:
+                items = buffer[:]
+                buffer.clear()
+                ready.clear()
+            for done, value in items:
+                if done:
+                    if isinstance(value, BaseException):
+                        raise value
+                    output_channel.set_namespaces(value)
+                    return
+                space.release()
+                await output_channel.push(value)
+    finally:
+        stopped.append(True)
+        space.release() # in case the worker is waiting for space
+
+async def run_raw(the_filter, input_channel, output_channel):
+    """The body of the task started by start. Exceptions are handled like in jqsh.filter.Filter.run_raw, and if the task is cancelled, the input is abandoned."""
+    raw, run = runner_function(the_filter)
+    try:
+        if run is None:
+            await run_generators(the_filter, input_channel, output_channel)
+        elif raw:
+            await run(input_channel, output_channel)
+        else:
+            output_channel.get_namespaces(input_channel)
+            await run_values(run, input_channel, output_channel)
+    except asyncio.CancelledError:
+        input_channel.abandon()
+        raise
+    except Exception as e:
+        await output_channel.push(jqsh.values.JQSHException('internal', python_exception=e, exc_info=sys.exc_info(), traceback_string=traceback.format_exc()))
+    finally:
+        if not output_channel.namespaces_defined.is_set():
+            output_channel.get_namespaces(input_channel)
+        output_channel.terminate()
+
+async def run_values(run, input_channel, output_channel):
+    """Pushes the output of a run function (see runner) onto the output channel, like jqsh.filter.Filter.run_raw does with the output of a run method: run reads the input values up to the first exception, and an exception from the input comes after the output, unless run has output one itself. Once run has abandoned its input or returned, the rest of the input is still read for its first exception."""
+    bridge_channel = AsyncChannel(namespaces=input_channel, capacity=jqsh.channel.default_capacity)
+    input_exceptions = []
+    
+    async def read_input():
+        try:
+            async for value in input_channel:
+                if isinstance(value, jqsh.values.JQSHException):
+                    input_exceptions.append(value)
+                    input_channel.abandon()
+                    break
+                await bridge_channel.push(value) # dropped once the bridge has been abandoned
+        except asyncio.CancelledError:
+            input_channel.abandon()
+            raise
+        finally:
+            bridge_channel.terminate()
+    
+    reader = asyncio.ensure_future(read_input()) # not the bridge's task, since abandoning the bridge would cancel it
+    output_values = run(bridge_channel)
+    try:
+        async for value in output_values:
+            await output_channel.push(value)
+            if isinstance(value, jqsh.values.JQSHException):
+                return
+        bridge_channel.abandon() # run won't read any more input
+        await reader
+        if len(input_exceptions):
+            await output_channel.push(input_exceptions[0])
+    finally:
+        bridge_channel.abandon()
+        reader.cancel()
+        await output_values.aclose()
+
+def runner(filter_class, raw=False):
+    """Registers a function which is called with a filter of the given class, and returns its run function, or None if the filter is run with the generator engine instead, see run_generators.
+    
+    A run function is an async generator function which is called with the input channel, like jqsh.filter.Filter.run, and yields the output values. The output namespaces are those of the input. If raw is true, it is a coroutine function instead, which is called with the input and output channels like jqsh.filter.Filter.run_raw, and defines the output namespaces itself.
+    """
+    def ret(f):
+        runners[filter_class] = raw, f
+        return f
+    
+    return ret
+
+def runner_function(the_filter):
+    """Returns whether the filter's run function is raw, and the run function, see runner. The run function is None if the filter has none."""
+    raw, f = runners.get(the_filter.__class__, (False, None))
+    return raw, None if f is None else f(the_filter)
+
+async def sensible_string(the_filter, input_channel):
+    """The asyncio counterpart to jqsh.filter.Filter.sensible_string, which abandons the input channel once the string has been read. Raises StopAsyncIteration or TypeError if the filter's output doesn't start with a string."""
+    if the_filter.__class__ == jqsh.filter.Name:
+        input_channel.abandon()
+        return the_filter.name
+    ret = await start(the_filter, input_channel).take_first()
+    if isinstance(ret, jqsh.values.String):
+        return ret.value
+    else:
+        raise TypeError('got a ' + ret.__class__.__name__ + ', expected a string')
+
+def start(the_filter, input_channel):
+    """Starts the filter as a task on the running event loop and returns its output channel. Abandoning the output channel cancels the task."""
+    output_channel = AsyncChannel(capacity=jqsh.channel.default_capacity)
+    output_channel.task = asyncio.ensure_future(run_raw(the_filter, input_channel, output_channel))
+    return output_channel
+
+@runner(jqsh.filter.Filter)
+def run_empty(the_filter):
+    async def run(input_channel):
+        input_channel.abandon()
+        return
+        yield # the empty async generator
+    
+    return run
+
+@runner(jqsh.filter.Add)
+@runner(jqsh.filter.Multiply)
+def run_operation(the_filter):
+    async def run(input_channel):
+        async for output in output_pairs(the_filter, input_channel):
+            if isinstance(output, tuple):
+                yield the_filter.operate(*output)
+            else:
+                yield output
+    
+    return run
+
+@runner(jqsh.filter.Apply)
+def run_apply(the_filter):
+    attributes = the_filter.attributes
+    if all(attribute.__class__ == jqsh.filter.Filter for attribute in attributes): # identity function
+        async def run(input_channel):
+            async for value in input_channel:
+                yield value
+    elif len(attributes) == 2 and all(attribute.__class__ == jqsh.filter.NumberLiteral for attribute in attributes): # decimal number
+        number = jqsh.values.Number(str(attributes[0]) + '.' + str(attributes[1]))
+        
+        async def run(input_channel):
+            input_channel.abandon()
+            yield number
+    elif attributes[0].__class__ == jqsh.filter.Filter: # subscripting/lookup on input values
+        async def run(input_channel):
+            input_channel, key_input = input_channel / 2
+            try:
+                key = await start(attributes[1], key_input).take_first()
+            except StopAsyncIteration:
+                input_channel.abandon()
+                yield jqsh.values.JQSHException('empty')
+                return
+            async for value in input_channel:
+                for output in jqsh.filter.Apply.lookup(key, (value,)):
+                    yield output
+                    if isinstance(output, jqsh.values.JQSHException):
+                        input_channel.abandon()
+                        return
+    elif attributes[0].__class__ == jqsh.filter.Command: # command with arguments
+        async def run(input_channel):
+            input_channel, *string_inputs = input_channel / (len(attributes) + 1)
+            try:
+                command_name = [await sensible_string(attribute, string_input) for attribute, string_input in zip([attributes[0].attribute] + list(attributes[1:]), string_inputs)]
+            except (StopAsyncIteration, TypeError):
+                input_channel.abandon()
+                yield jqsh.values.JQSHException('sensibleString')
+                return
+            finally:
+                for string_input in string_inputs:
+                    string_input.abandon()
+            async for value in run_command(command_name, input_channel):
+                yield value
+    else: # built-in function with arguments
+        return None
+    return run
+
+@runner(jqsh.filter.Array)
+def run_array(the_filter):
+    async def run(input_channel):
+        yield jqsh.values.Array(await collect(start(the_filter.attribute, input_channel)))
+    
+    return run
+
+@runner(jqsh.filter.Comma)
+def run_comma(the_filter):
+    async def run(input_channel):
+        left_input, right_input = input_channel / 2
+        left_output = start(the_filter.left_operand, left_input)
+        right_output = start(the_filter.right_operand, right_input)
+        try:
+            async for value in left_output:
+                yield value
+            async for value in right_output:
+                yield value
+        finally:
+            left_output.abandon()
+            right_output.abandon() # if this generator is closed while the left operand's output is being read, the right operand is cancelled as well
+    
+    return run
+
+@runner(jqsh.filter.Command)
+def run_command_filter(the_filter):
+    async def run(input_channel):
+        input_channel, attribute_input = input_channel / 2
+        try:
+            command_name = await sensible_string(the_filter.attribute, attribute_input)
+        except (StopAsyncIteration, TypeError):
+            input_channel.abandon()
+            yield jqsh.values.JQSHException('sensibleString')
+            return
+        async for value in run_command(command_name, input_channel):
+            yield value
+    
+    return run
+
+@runner(jqsh.filter.Conditional)
+def run_conditional(the_filter):
+    async def run(input_channel):
+        empty = True
+        async for value in input_channel:
+            empty = False
+            branch = await conditional_branch(the_filter, input_channel, value)
+            if isinstance(branch, jqsh.values.JQSHException):
+                input_channel.abandon()
+                yield branch
+                return
+            elif branch is None:
+                continue
+            function = branch.map_function()
+            if function is None:
+                branch_output = start(branch, input_channel.with_values(value))
+                try:
+                    async for output in branch_output:
+                        yield output
+                finally:
+                    branch_output.abandon()
+            else:
+                yield function(value)
+        if empty:
+            branch = await conditional_branch(the_filter, input_channel)
+            if isinstance(branch, jqsh.values.JQSHException):
+                yield branch
+            elif branch is not None:
+                branch_output = start(branch, input_channel)
+                try:
+                    async for output in branch_output:
+                        yield output
+                finally:
+                    branch_output.abandon()
+    
+    return run
+
+@runner(jqsh.filter.Fused)
+def run_fused(the_filter):
+    async def run(input_channel):
+        empty = True
+        async for value in input_channel:
+            empty = False
+            output = the_filter.function(value)
+            yield output
+            if isinstance(output, jqsh.values.JQSHException):
+                input_channel.abandon()
+                return
+        if empty: # the filters may still have output, e.g. the literal operand of an operator
+            attribute_output = start(the_filter.attribute, input_channel)
+            try:
+                async for value in attribute_output:
+                    yield value
+            finally:
+                attribute_output.abandon()
+    
+    return run
+
+@runner(jqsh.filter.NumberLiteral)
+def run_number_literal(the_filter):
+    async def run(input_channel):
+        input_channel.abandon()
+        yield jqsh.values.Number(the_filter.number)
+    
+    return run
+
+@runner(jqsh.filter.Object)
+def run_object(the_filter):
+    async def run(input_channel):
+        obj = jqsh.values.Object(terminated=False)
+        attribute_output = start(the_filter.attribute, input_channel)
+        try:
+            async for value in attribute_output:
+                try:
+                    obj.push(value)
+                except TypeError:
+                    yield jqsh.values.JQSHException('type')
+                except ValueError:
+                    yield jqsh.values.JQSHException('length')
+        finally:
+            attribute_output.abandon()
+        obj.terminate()
+        yield obj
+    
+    return run
+
+@runner(jqsh.filter.Pair)
+def run_pair(the_filter):
+    async def run(input_channel):
+        left_input, right_input = input_channel / 2
+        try:
+            right_output = await start(the_filter.right_operand, right_input).take_first()
+        except StopAsyncIteration:
+            left_input.abandon()
+            yield jqsh.values.JQSHException('empty')
+            return
+        left_output = start(the_filter.left_operand, left_input)
+        try:
+            async for value in left_output:
+                yield jqsh.values.Array((value, right_output))
+        finally:
+            left_output.abandon()
+    
+    return run
+
+@runner(jqsh.filter.Parens)
+def run_parens(the_filter):
+    async def run(input_channel):
+        attribute_output = start(the_filter.attribute, input_channel)
+        try:
+            async for value in attribute_output:
+                yield value
+        finally:
+            attribute_output.abandon()
+    
+    return run
+
+@runner(jqsh.filter.Pipe)
+def run_pipe(the_filter):
+    async def run(input_channel):
+        right_output = start(the_filter.right_operand, start(the_filter.left_operand, input_channel))
+        try:
+            async for value in right_output:
+                yield value
+        finally:
+            right_output.abandon() # cancels the right operand, which abandons the left operand's output in turn
+    
+    return run
+
+@runner(jqsh.filter.Semicolon, raw=True)
+def run_semicolon(the_filter):
+    async def run(input_channel, output_channel):
+        statement_input = input_channel
+        for statement, last in the_filter.statements():
+            if last:
+                break
+            left_input, statement_input = statement_input / 2
+            previous_output = start(statement, left_input)
+            await collect(previous_output) # only the namespaces are used, but abandoning the output would cancel the statement before it defines them
+            statement_input.get_namespaces(previous_output)
+        statement_output = start(statement, statement_input)
+        output_channel.get_namespaces(statement_output)
+        try:
+            async for value in statement_output:
+                await output_channel.push(value)
+        finally:
+            statement_output.abandon()
+    
+    return run
+
+@runner(jqsh.filter.StringLiteral)
+def run_string_literal(the_filter):
+    async def run(input_channel):
+        input_channel.abandon()
+        yield jqsh.values.String(the_filter.text)
+    
+    return run
+
+@runner(jqsh.filter.Try)
+def run_try(the_filter):
+    async def run(input_channel):
+        exception_handlers = {}
+        default_handler = None
+        else_handler = None
+        exception_names = []
+        for attribute_name, attribute_value in the_filter.attributes:
+            if attribute_name == 'try':
+                try_block = attribute_value
+            elif attribute_name == 'catch':
+                input_channel, exception_name_input = input_channel / 2
+                try:
+                    exception_names.append(await sensible_string(attribute_value, exception_name_input))
+                except (StopAsyncIteration, TypeError):
+                    input_channel.abandon()
+                    yield jqsh.values.JQSHException('sensibleString')
+                    return
+            elif attribute_name == 'then':
+                for exception_name in exception_names:
+                    exception_handlers[exception_name] = attribute_value
+            elif attribute_name == 'except':
+                default_handler = attribute_value
+            elif attribute_name == 'else':
+                else_handler = attribute_value
+        try_input, except_input = input_channel / 2
+        try_output = start(try_block, try_input)
+        handler = else_handler
+        try:
+            async for value in try_output:
+                if not isinstance(value, jqsh.values.JQSHException):
+                    if else_handler is None:
+                        yield value
+                    continue
+                if value.name in exception_handlers:
+                    handler = exception_handlers[value.name]
+                elif default_handler is not None:
+                    handler = default_handler
+                else:
+                    yield value
+                    return
+                break
+            try_output.abandon()
+            if handler is not None:
+                handler_output = start(handler, except_input)
+                try:
+                    async for value in handler_output:
+                        yield value
+                finally:
+                    handler_output.abandon()
+        finally:
+            try_output.abandon()
+            except_input.abandon()
+    
+    return run
@@ -0,0 +1,121 @@
+import functools
+import hashlib
+import jqsh.cli
+import jqsh.filter
+import jqsh.parser
+import os
+import pathlib
+import pickle
+import stat
+
+cache_directory_name = '__pycache__'
+cache_suffix = '.jqshc'
+
+def cache_key(module_path, stat_result):
+    return str(pathlib.Path(module_path).resolve()), stat_result.st_mtime_ns, stat_result.st_size, jqsh_version()
+
+def cache_path(module_path):
+    """Returns the path of the parse tree cache for the given module file, like __pycache__ for Python modules."""
+    module_path = pathlib.Path(module_path)
+    return module_path.parent / cache_directory_name / (module_path.name + cache_suffix)
+
+def child_filters(value):
+    """Yields the filters in an attribute value of a filter, looking into lists, tuples and dicts but not into the filters themselves."""
+    if isinstance(value, jqsh.filter.Filter):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from child_filters(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from child_filters(item)
+
+def join_statements(statements):
+    """Joins top-level statements with semicolons, giving the same parse tree as parsing them together."""
+    return functools.reduce(lambda left, right: jqsh.filter.Semicolon(left=left, right=right), statements)
+
+@functools.lru_cache(maxsize=None)
+def jqsh_version():
+    """Returns a digest of all jqsh sources, so that caches written by a different jqsh are ignored. Pickled parse trees reference classes from several modules, e.g. jqsh.values.Number in a NumberLiteral, so every module is included rather than only the parser and the filter classes."""
+    ret = hashlib.sha1()
+    for module_path in sorted(pathlib.Path(__file__).parent.glob('*.py')):
+        ret.update(module_path.name.encode('utf-8'))
+        ret.update(module_path.read_bytes())
+    return ret.hexdigest()
+
+def load_module(module_path, *, stream=False, use_cache=True):
+    """Returns the parse tree of a jqsh module file, using the on-disk cache if it is up to date and updating it otherwise.
+    
+    Syntax errors are raised like from jqsh.parser.parse and are never cached. If stream is true and the cache can't be used, a jqsh.filter.Module is returned instead, which parses the file while it runs and reports syntax errors as a syntax exception.
+    """
+    module_path = pathlib.Path(module_path)
+    module_file = module_path.open('rb')
+    stat_result = os.fstat(module_file.fileno())
+    key = cache_key(module_path, stat_result) if use_cache and stat.S_ISREG(stat_result.st_mode) else None # modules read from pipes can't be cached
+    if key is not None:
+        ret = read_cache(cache_path(module_path), key)
+        if ret is not None:
+            module_file.close()
+            return ret
+    statements = module_statements(module_file, module_path, key)
+    if stream:
+        return jqsh.filter.Module(statements)
+    return join_statements(statement for statement, last in statements)
+
+def module_statements(module_file, module_path, key=None):
+    """Reads and parses an open module file one top-level statement at a time, see jqsh.parser.parse_statements. Writes the cache for the whole module before yielding the last statement, unless key is None."""
+    with module_file:
+        statements = []
+        for statement, last in jqsh.parser.parse_statements(jqsh.parser.tokenize_chunks(jqsh.cli.read_chunks(module_file)), line_numbers=True):
+            statements.append(statement)
+            if last and key is not None:
+                write_cache(cache_path(module_path), key, join_statements(statements))
+            yield statement, last
+
+@functools.lru_cache(maxsize=256)
+def parse(filter_string):
+    """Like jqsh.parser.parse with the default options, but remembers the most recently parsed strings. Parse trees are not modified by running them, so they can be shared."""
+    return jqsh.parser.parse(filter_string)
+
+def post_order(the_filter):
+    """Returns the nodes of a parse tree as a list in which children come before their parents, so the root is last.
+    
+    Parse trees of long modules are deeper than the recursion limit (a chain of n statements is n levels deep), so they can't be pickled directly. Pickling this list instead makes every child a memo reference by the time its parent is pickled.
+    """
+    ret = []
+    seen = set()
+    stack = [(the_filter, False)]
+    while len(stack):
+        node, children_done = stack.pop()
+        if children_done:
+            ret.append(node)
+        elif id(node) not in seen:
+            seen.add(id(node))
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(list(child_filters(vars(node)))))
+    return ret
+
+def read_cache(path, key):
+    """Returns the cached parse tree, or None if there is no cache or it does not match the key."""
+    try:
+        with path.open('rb') as cache_file:
+            if pickle.load(cache_file) != key:
+                return None
+            return pickle.load(cache_file)[-1]
+    except Exception: # missing, unreadable, truncated, or written by an incompatible jqsh
+        return None
+
+def write_cache(path, key, the_filter):
+    """Writes the cache atomically. Failing to write it (e.g. in a read-only directory) is not an error."""
+    temp_path = path.with_name(path.name + '.' + str(os.getpid()) + '.tmp')
+    try:
+        path.parent.mkdir(exist_ok=True)
+        with temp_path.open('wb') as cache_file:
+            pickle.dump(key, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(post_order(the_filter), cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(str(temp_path), str(path))
+    except (OSError, pickle.PicklingError):
+        try:
+            temp_path.unlink()
+        except OSError:
+            pass
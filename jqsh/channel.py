@@ -1,8 +1,20 @@
-import contextlib
+import sys
+
+import collections
 import functools
+import itertools
 import jqsh.context
+import jqsh.evaluation
+import jqsh.pool
 import queue
 import threading
+import traceback
+
+batch_size = 256 # how many values builtins like range produce at once, see Batch
+default_capacity = 0 # the capacity of the output channels of filters, see Channel
+
+class Batch(list):
+    """Several values which a builtin yields at once instead of one by one, so that they are pushed onto its output channel with push_many."""
 
 class Terminator:
     """a special value used to signal the end of a channel"""
@@ -17,16 +29,29 @@ def coerce_other(f):
     return wrapper
 
 class Channel:
+    """A stream of jqsh values from writers to readers, along with the namespaces and context that filters pass on.
+    
+    One condition variable guards the values and the namespaces: readers wait on it for values and for namespaces that are not yet defined, and writers wait on it for space. The values are kept in a deque, followed by a Terminator once the channel has been terminated.
+    """
     _globals = None
     _locals = None
     _format_strings = None
     _context = None
+    abandoned = False # has the reader stopped reading?
+    capacity = 0
+    ended = False # is the terminator on the queue?
+    evaluation = None # the jqsh.evaluation.Evaluation this channel was created for, if any
     input_terminated = False # has the terminator been pushed?
+    pulling = False # is pull moving values onto this channel without terminating it?
     terminated = False # has the terminator been popped?
     
-    def __init__(self, *args, global_namespace=None, local_namespace=None, format_strings=None, terminated=False, empty_namespaces=None, context=None):
-        self.input_lock = threading.Lock()
-        self.output_lock = threading.Lock()
+    def __init__(self, *args, global_namespace=None, local_namespace=None, format_strings=None, terminated=False, empty_namespaces=None, context=None, capacity=0):
+        """If capacity is nonzero, push blocks while that many values are waiting to be read, so that a fast writer waits for a slow reader instead of filling memory. The initial values, the terminator and thrown exceptions are not limited."""
+        self.lock = threading.Condition(threading.Lock())
+        self.value_queue = collections.deque()
+        self.evaluation = jqsh.evaluation.current()
+        if self.evaluation is not None:
+            self.evaluation.add_channel(self)
         # namespaces and context
         if empty_namespaces is None:
             empty_namespaces = terminated
@@ -39,22 +64,14 @@ class Channel:
                 format_strings = {}
             if context is None:
                 context = jqsh.context.FilterContext()
-        self.has_globals = threading.Event()
-        self.has_locals = threading.Event()
-        self.has_format_strings = threading.Event()
-        self.has_context = threading.Event()
-        if global_namespace is not None:
-            self.global_namespace = global_namespace
-        if local_namespace is not None:
-            self.local_namespace = local_namespace
-        if format_strings is not None:
-            self.format_strings = format_strings
-        if context is not None:
-            self.context = context
+        self._globals = global_namespace
+        self._locals = local_namespace
+        self._format_strings = format_strings
+        self._context = context
         # values
-        self.value_queue = queue.Queue()
         for value in args:
             self.push(value)
+        self.capacity = capacity
         if terminated:
             self.terminate()
     
@@ -70,81 +87,129 @@ class Channel:
         
         All values that have not yet been read from this channel, and any values that are added later, will be copied into the other channels.
         The original channel will appear to be terminated immediately, and the split channels will terminate when the original channel is actually terminated.
-        The split channels are returned as a tuple.
+        The split channels are returned as a tuple. They read from one shared Tee, which holds each value only until all of them have read it.
         """
-        import jqsh.filter
-        
-        def spread_values(split_channels):
-            while True:
-                value = self.value_queue.get()
-                if isinstance(value, Terminator):
-                    for chan in split_channels:
-                        chan.terminate()
-                    break
-                self.store_value(value)
-                for chan in split_channels:
-                    chan.push(value)
-        
         try:
             other = int(other)
         except:
             return NotImplemented
-        buffered_values = []
-        with self.output_lock:
+        with self.lock:
             if self.terminated:
                 return tuple([Channel(terminated=True)] * other)
             self.terminated = True
-            self.value_queue.put(Terminator())
-            while True:
-                value = self.value_queue.get()
-                if isinstance(value, Terminator):
-                    break
-                self.store_value(value)
-                buffered_values.append(value)
-        ret = [Channel(*buffered_values) for _ in range(other)]
-        threading.Thread(target=spread_values, args=(ret,)).start()
-        threading.Thread(target=self.push_namespaces, args=tuple(ret)).start()
-        return tuple(ret)
+        tee = Tee(self, other)
+        ret = tuple(SplitChannel(tee, index) for index in range(other))
+        jqsh.pool.start(self.push_namespaces, *ret)
+        return ret
+    
+    def abandon(self):
+        """Called by the reader when it won't read any more values. Values that are pushed afterwards are dropped, so that the writer is never blocked by the capacity and doesn't fill memory.
+        
+        This is how a reader cancels the filters upstream: a filter stops once its output has been abandoned, and abandons the channels it was reading in turn (see jqsh.filter.Filter.run_raw).
+        """
+        with self.lock:
+            self.abandoned = True
+            self.lock.notify_all()
+    
+    def accept_input(self):
+        """Called by writers with the lock held. Waits while pull is moving values onto this channel, and raises RuntimeError if it has been terminated."""
+        while self.pulling:
+            self.lock.wait()
+        if self.input_terminated:
+            raise RuntimeError('jqsh channel has terminated')
+    
+    def batches(self):
+        """Yields lists of values, as returned by pop_many, until the channel is terminated."""
+        while True:
+            try:
+                yield self.pop_many()
+            except StopIteration:
+                return
+    
+    def cancel(self, exception=None, namespaces_from=None):
+        """Ends the channel at once, for jqsh.evaluation.Evaluation.cancel: the values waiting to be read are dropped and replaced by the exception, if one is given, and values pushed later are dropped. Namespaces that are not yet defined are taken from namespaces_from if it has them, and are empty otherwise, so that no reader or writer waits for this channel any more."""
+        with self.lock:
+            self.value_queue.clear()
+            if exception is not None:
+                self.value_queue.append(exception)
+            self.abandoned = True
+            self.pulling = False
+            self.ended = False
+            self.end()
+            for attribute_name, default in (('_globals', dict), ('_locals', dict), ('_format_strings', dict), ('_context', jqsh.context.FilterContext)):
+                if getattr(self, attribute_name) is None:
+                    value = getattr(namespaces_from, attribute_name, None)
+                    setattr(self, attribute_name, default() if value is None else value)
+    
+    def close(self):
+        """Abandons the channel. Python calls this when a generator that is reading the channel with yield from is closed (see PEP 380), so closing the generator of a filter's run method cancels the filters it was reading from."""
+        self.abandon()
     
     @property
     def global_namespace(self):
-        self.has_globals.wait()
-        return self._globals
+        return self.wait_for_attribute('_globals')
     
     @global_namespace.setter
     def global_namespace(self, value):
-        self._globals = value
-        self.has_globals.set()
+        self.set_attribute('_globals', value)
     
     @property
     def local_namespace(self):
-        self.has_locals.wait()
-        return self._locals
+        return self.wait_for_attribute('_locals')
     
     @local_namespace.setter
     def local_namespace(self, value):
-        self._locals = value
-        self.has_locals.set()
+        self.set_attribute('_locals', value)
     
     @property
     def format_strings(self):
-        self.has_format_strings.wait()
-        return self._format_strings
+        return self.wait_for_attribute('_format_strings')
     
     @format_strings.setter
     def format_strings(self, value):
-        self._format_strings = value
-        self.has_format_strings.set()
+        self.set_attribute('_format_strings', value)
     
     @property
     def context(self):
-        self.has_context.wait()
-        return self._context
+        return self.wait_for_attribute('_context')
     
     @context.setter
     def context(self, value):
-        self._context = value
-        self.has_context.set()
+        self.set_attribute('_context', value)
+    
+    def buffered(self):
+        """Returns this channel. See LazyChannel.buffered."""
+        return self
+    
+    def end(self):
+        """Puts the terminator onto the queue unless it is already there. Called with the lock held."""
+        if not self.ended:
+            self.ended = True
+            self.value_queue.append(Terminator())
+            self.lock.notify_all()
+    
+    def first_exception(self, output_channel=None):
+        """Reads the remaining values and returns the first exception among them, or None if there is none, abandoning the rest. Used by filters which don't use their input values, so that an exception in the input is still output after their own output, like jqsh.filter.Filter.run_raw does. Reading stops early once output_channel has been abandoned, since the exception wouldn't be read anyway."""
+        import jqsh.values
+        
+        for values in self.batches():
+            for value in values:
+                if isinstance(value, jqsh.values.JQSHException):
+                    self.abandon()
+                    return value
+            if output_channel is not None and output_channel.abandoned:
+                self.abandon()
+                break
+        return None
+    
+    @classmethod
+    def lazily(cls, values, **kwargs):
+        """Creates a terminated channel containing the given values without coercing them to jqsh values, so that subclasses can convert each one in store_value when it is read."""
+        ret = cls(terminated=False, **kwargs)
+        with ret.lock:
+            ret.value_queue.extend(values)
+        ret.terminate()
+        return ret
     
     def get_namespaces(self, from_channel, include_context=True):
         from_channel.push_namespaces(self, include_context=include_context)
@@ -154,42 +219,72 @@ class Channel:
     
     def pop(self, wait=True):
         """Returns a value. Raises queue.Empty if no element is currently available, and StopIteration if the channel is terminated."""
-        with self.output_lock:
+        with self.lock:
+            if self.terminated:
+                raise StopIteration('jqsh channel has terminated')
+            while len(self.value_queue) == 0:
+                if not wait:
+                    raise queue.Empty()
+                self.lock.wait()
+            if isinstance(self.value_queue[0], Terminator):
+                self.terminated = True
+                raise StopIteration('jqsh channel has terminated')
+            ret = self.store_value(self.value_queue.popleft())
+            if self.capacity:
+                self.lock.notify_all()
+        return ret
+    
+    def pop_many(self, max_values=None, wait=True):
+        """Returns a nonempty list of at most max_values values: the next one, and those after it which are available without blocking. Otherwise like pop, but with one lock acquisition for all of them."""
+        with self.lock:
             if self.terminated:
                 raise StopIteration('jqsh channel has terminated')
-            ret = self.value_queue.get(block=wait)
-            if isinstance(ret, Terminator):
+            ret = [self.store_value(value) for value in self.take_values(max_values, wait=wait)]
+            if len(ret) == 0:
                 self.terminated = True
                 raise StopIteration('jqsh channel has terminated')
-            self.store_value(ret)
         return ret
     
     def pull(self, from_channel, terminate=True):
-        """Move all values from from_channel to this one, blocking until from_channel terminates, then optionally terminate."""
-        if terminate:
-            with self.input_lock:
-                if self.input_terminated:
-                    raise RuntimeError('jqsh channel has terminated')
+        """Move all values from from_channel to this one, blocking until from_channel terminates, then optionally terminate. Other writers wait until it is done."""
+        with self.lock:
+            self.accept_input()
+            if terminate:
                 self.input_terminated = True
-        else:
-            self.input_lock.acquire()
-        while True:
-            try:
-                value = from_channel.pop()
-            except StopIteration:
-                break
-            self.value_queue.put(value)
-        if terminate:
-            self.value_queue.put(Terminator())
-        else:
-            self.input_lock.release()
+            else:
+                self.pulling = True
+        try:
+            while True:
+                if self.abandoned:
+                    from_channel.abandon()
+                try:
+                    values = from_channel.pop_many()
+                except StopIteration:
+                    break
+                with self.lock:
+                    self.put_values(values)
+        finally:
+            with self.lock:
+                if terminate:
+                    self.end()
+                else:
+                    self.pulling = False
+                    self.lock.notify_all()
     
     @coerce_other
     def push(self, value):
-        with self.input_lock:
-            if self.input_terminated:
-                raise RuntimeError('jqsh channel has terminated')
-            self.value_queue.put(value)
+        with self.lock:
+            self.accept_input()
+            self.put_values([value])
+    
+    def push_many(self, values):
+        """Pushes the values in order, like calling push for each of them, but with one lock acquisition for as many of them as the capacity allows. Subclasses which check values in push don't use this."""
+        import jqsh.values
+        
+        values = [jqsh.values.from_native(value) for value in values]
+        with self.lock:
+            self.accept_input()
+            self.put_values(values)
     
     def push_attribute(self, attribute_name, *output_channels):
         """Waits until the attribute is available, then passes it unchanged to the output channels. Used by Filter.run_raw and Channel.push_namespaces."""
@@ -198,36 +293,381 @@ class Channel:
             setattr(chan, attribute_name, attribute_value)
     
     def push_namespaces(self, *output_channels, include_context=True):
-        threads = []
-        for attribute_name in ['global_namespace', 'local_namespace', 'format_strings'] + (['context'] if include_context else []):
-            thread = threading.Thread(target=self.push_attribute, args=(attribute_name,) + output_channels)
-            thread.start()
-            threads.append(thread)
-        for thread in threads:
-            thread.join()
+        first_attribute, *attribute_names = ['global_namespace', 'local_namespace', 'format_strings'] + (['context'] if include_context else [])
+        jobs = [jqsh.pool.start(self.push_attribute, attribute_name, *output_channels) for attribute_name in attribute_names] # each attribute is waited for separately since they may become available in any order
+        self.push_attribute(first_attribute, *output_channels)
+        for job in jobs:
+            job.join()
+    
+    def put_values(self, values, wait=True):
+        """Called by writers with the lock held. Appends the values to the queue, first waiting until there is space for them if wait is true. Values put onto an abandoned or terminated channel are dropped."""
+        position = 0
+        while position < len(values):
+            while wait and self.capacity and not self.abandoned and not self.ended and len(self.value_queue) >= self.capacity:
+                self.lock.wait()
+            if self.abandoned or self.ended:
+                return
+            num_values = len(values) - position if not wait or not self.capacity else min(self.capacity - len(self.value_queue), len(values) - position)
+            self.value_queue.extend(values[position:position + num_values] if position or num_values < len(values) else values)
+            position += num_values
+            self.lock.notify_all()
+    
+    def read_values(self, max_values=None, wait=True):
+        """Takes up to max_values values off the queue, even if the channel has been split, and returns them as a list, which is empty at the end of the channel. Used by Tee to read the channel it splits."""
+        with self.lock:
+            return [self.store_value(value) for value in self.take_values(max_values, wait=wait)]
+    
+    def set_attribute(self, attribute_name, value):
+        with self.lock:
+            setattr(self, attribute_name, value)
+            self.lock.notify_all()
     
     def store_value(self, value):
-        pass # subclass this if required, by default channels don't store values
+        """Called with each value as it is read from the channel, with the lock held. Returns the value that is handed to the reader."""
+        return value # subclass this if required, by default channels don't store values
+    
+    def take_first(self):
+        """Returns the next value and abandons the channel, for readers that only need one value. Raises StopIteration if the channel is terminated."""
+        try:
+            return self.pop()
+        finally:
+            self.abandon()
+    
+    def take_values(self, max_values=None, wait=True):
+        """Called by readers with the lock held. Takes up to max_values values off the queue, first waiting for one if wait is true, and returns them as a list, which is empty if the terminator has been reached. Raises queue.Empty if wait is false and the queue is empty."""
+        while len(self.value_queue) == 0:
+            if not wait:
+                raise queue.Empty()
+            self.lock.wait()
+        if max_values is None or max_values >= len(self.value_queue):
+            ret = list(self.value_queue)
+            self.value_queue.clear()
+            if isinstance(ret[-1], Terminator):
+                self.value_queue.append(ret.pop())
+        else:
+            ret = [self.value_queue.popleft() for _ in range(max_values)]
+        if self.capacity and len(ret):
+            self.lock.notify_all()
+        return ret
     
     def terminate(self):
-        with self.input_lock:
+        with self.lock:
             self.input_terminated = True
-            self.value_queue.put(Terminator())
+            self.end()
     
     def throw(self, exception):
-        """Tries to append the exception onto the channel, failing silently if terminated, then defines all properties for which events are defined, and terminates."""
+        """Tries to append the exception onto the channel, failing silently if terminated, then defines all namespaces that are not yet defined, and terminates."""
         import jqsh.values
         
         if isinstance(exception, str) or isinstance(exception, jqsh.values.String):
             exception = jqsh.values.JQSHException(exception)
-        with contextlib.suppress(RuntimeError):
-            self.push(exception)
-        if self._globals is None:
-            self.global_namespace = {}
-        if self._locals is None:
-            self.local_namespace = {}
-        if self._format_strings is None:
-            self.format_strings = {}
-        if self._context is None:
-            self.context = jqsh.context.FilterContext()
-        self.terminate()
+        with self.lock:
+            if not self.input_terminated:
+                self.put_values([exception], wait=False) # even if the channel is full, so that throwing never blocks
+            if self._globals is None:
+                self._globals = {}
+            if self._locals is None:
+                self._locals = {}
+            if self._format_strings is None:
+                self._format_strings = {}
+            if self._context is None:
+                self._context = jqsh.context.FilterContext()
+            self.input_terminated = True
+            self.end()
+    
+    def wait_for_attribute(self, attribute_name):
+        """Returns the value of a namespace attribute, waiting until it is defined."""
+        ret = getattr(self, attribute_name)
+        if ret is None:
+            with self.lock:
+                while getattr(self, attribute_name) is None:
+                    self.lock.wait()
+                ret = getattr(self, attribute_name)
+        return ret
+    
+    def with_values(self, *values):
+        """Returns a terminated channel containing the given values, which gets its namespaces from this channel."""
+        ret = Channel(*values, terminated=True, empty_namespaces=False)
+        jqsh.pool.start(ret.get_namespaces, self)
+        return ret
+
+class SplitChannel(Channel):
+    """One of the channels returned by Channel.__truediv__. It can't be pushed to: its values are read from a Tee, taking all values that are available at once, and the queue only holds those that have been read ahead like this."""
+    input_terminated = True
+    
+    def __init__(self, tee, index):
+        super().__init__()
+        self.tee = tee
+        self.index = index
+    
+    def abandon(self):
+        super().abandon()
+        self.tee.abandon(self.index)
+    
+    def pop(self, wait=True):
+        with self.lock:
+            if len(self.value_queue) and not self.terminated:
+                return self.value_queue.popleft()
+        return self.pop_many(max_values=1, wait=wait)[0]
+    
+    def pop_many(self, max_values=None, wait=True):
+        if self.terminated:
+            raise StopIteration('jqsh channel has terminated')
+        ret = self.read_values(max_values, wait=wait)
+        if len(ret) == 0:
+            self.terminated = True
+            raise StopIteration('jqsh channel has terminated')
+        return ret
+    
+    def read_values(self, max_values=None, wait=True):
+        while True:
+            with self.lock:
+                if len(self.value_queue):
+                    return self.take_values(max_values, wait=False)
+                if self.ended:
+                    return []
+            values = self.tee.read(self.index, wait=wait)
+            with self.lock:
+                self.value_queue.extend(values)
+                if len(values) == 0:
+                    self.ended = True
+
+class Tee:
+    """The buffer shared by the channels a channel is split into. Like itertools.tee, it reads a value from the source channel when the first split channel needs it, and keeps it until the last one that is still reading has read it, so it only holds the values between the slowest and the fastest reader.
+    
+    The buffer is a list of values starting at a position of the source channel. Each split channel has a cursor, the position of the next value it reads. Values before all cursors are dropped from the start of the list once they make up at least half of it, so that this takes constant time per value.
+    """
+    def __init__(self, source, num_channels):
+        self.lock = threading.Condition(threading.Lock())
+        self.source = source
+        self.buffer = []
+        self.start = 0 # the position of buffer[0]
+        self.cursors = dict.fromkeys(range(num_channels), 0) # the split channels that are still reading
+        self.ended = False # has the source been terminated?
+        self.reading = False # is a split channel reading from the source?
+    
+    def abandon(self, index):
+        """Stops buffering values for the split channel. The source is abandoned once all of them are."""
+        with self.lock:
+            self.cursors.pop(index, None)
+            self.drop_read_values()
+            abandon_source = len(self.cursors) == 0
+        if abandon_source:
+            self.source.abandon()
+    
+    def drop_read_values(self):
+        """Called with the lock held."""
+        num_read = min(self.cursors.values(), default=self.start + len(self.buffer)) - self.start
+        if num_read > 0 and 2 * num_read >= len(self.buffer):
+            del self.buffer[:num_read]
+            self.start += num_read
+    
+    def read(self, index, max_values=None, wait=True):
+        """Returns up to max_values values for the split channel with the given index, reading them from the source if no other split channel has. The list is empty at the end of the source, and queue.Empty is raised if wait is false and no values are available."""
+        with self.lock:
+            while True:
+                if index not in self.cursors: # abandoned
+                    return []
+                position = self.cursors[index]
+                num_values = self.start + len(self.buffer) - position
+                if num_values > 0:
+                    break
+                if self.ended:
+                    return []
+                if self.reading:
+                    if not wait:
+                        raise queue.Empty()
+                    self.lock.wait()
+                    continue
+                self.reading = True
+                self.lock.release() # so that the other split channels can read buffered values meanwhile
+                try:
+                    values = self.source.read_values(wait=wait)
+                finally:
+                    self.lock.acquire()
+                    self.reading = False
+                    self.lock.notify_all()
+                if len(values) == 0:
+                    self.ended = True
+                self.buffer.extend(values)
+            if max_values is not None:
+                num_values = min(num_values, max_values)
+            offset = position - self.start
+            ret = self.buffer[offset:offset + num_values]
+            self.cursors[index] = position + num_values
+            self.drop_read_values()
+            return ret
+
+class LazyChannel:
+    """A channel for the single-threaded generator engine (see jqsh.filter.Filter.evaluate). Instead of a queue, it wraps an iterator, so each value is computed on the reading thread when it is read.
+    
+    The namespaces are given as a tuple of global namespace, local namespace, format strings and context, or as another channel to take them from once they are needed. If they are not given, they are the return value of the values generator, and asking for them before all values have been read buffers the remaining values.
+    """
+    abandoned = False # see Channel.abandoned
+    evaluation = None # see Channel.evaluation, only set for the output channel of the evaluation, see jqsh.evaluation.Evaluation.start
+    split_from = None # the channel this one was split from and its siblings, see __truediv__
+    
+    def __init__(self, values=(), namespaces=None):
+        self.values = iter(values)
+        self.namespace_values = namespaces
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        """Raises StopIteration if the channel is terminated."""
+        try:
+            return next(self.values)
+        except StopIteration as e:
+            if self.namespace_values is None:
+                self.namespace_values = e.value
+            raise StopIteration('jqsh channel has terminated')
+    
+    def __truediv__(self, other):
+        """Splits the channel like Channel.__truediv__ does. The split channels share one buffer of the values that have been read by some but not all of them. Once all of them have been abandoned, this channel is abandoned as well."""
+        try:
+            other = int(other)
+        except:
+            return NotImplemented
+        namespaces = self.namespaces(include_context=True)
+        split_values = itertools.tee(self.values, other)
+        self.values = iter(())
+        ret = tuple(LazyChannel(values, namespaces) for values in split_values)
+        for channel in ret:
+            channel.split_from = self, ret
+        return ret
+    
+    @property
+    def global_namespace(self):
+        return self.namespaces(include_context=True)[0]
+    
+    @property
+    def local_namespace(self):
+        return self.namespaces(include_context=True)[1]
+    
+    @property
+    def format_strings(self):
+        return self.namespaces(include_context=True)[2]
+    
+    @property
+    def context(self):
+        return self.namespaces(include_context=True)[3]
+    
+    def abandon(self):
+        """Stops reading, see Channel.abandon. The remaining values are never computed, and the generator that would compute them is closed, so that e.g. a running command is stopped."""
+        self.abandoned = True
+        values, self.values = self.values, iter(())
+        if hasattr(values, 'close'):
+            values.close()
+        if self.split_from is not None:
+            source, siblings = self.split_from
+            if all(channel.abandoned for channel in siblings):
+                source.abandon()
+    
+    def buffered(self):
+        """Returns a channel with the remaining values and the namespaces, after reading them all. Used where a filter's output would otherwise become the input of another filter in a chain as long as the input, like the iterations of reduce, since the generators of such a chain would be nested too deeply."""
+        namespaces = self.namespaces(include_context=True)
+        return LazyChannel(list(self), namespaces=namespaces)
+    
+    def close(self):
+        """Abandons the channel, see Channel.close."""
+        self.abandon()
+    
+    def drain(self):
+        """Reads and discards all remaining values, e.g. to run a filter for its side effects and namespaces."""
+        for value in self:
+            pass
+    
+    def first_exception(self):
+        """Reads the remaining values and returns the first exception among them, or None if there is none, see Channel.first_exception."""
+        import jqsh.values
+        
+        for value in self:
+            if isinstance(value, jqsh.values.JQSHException):
+                self.abandon()
+                return value
+        return None
+    
+    def get_namespaces(self, from_channel, include_context=True):
+        """Takes the namespaces from the given channel once they are needed."""
+        self.namespace_values = from_channel
+    
+    def namespaces(self, include_context=False):
+        if self.namespace_values is None:
+            buffered_values = []
+            while self.namespace_values is None:
+                try:
+                    buffered_values.append(next(self.values))
+                except StopIteration as e:
+                    self.namespace_values = e.value
+                    break
+            self.values = iter(buffered_values)
+        if not isinstance(self.namespace_values, tuple):
+            source = self.namespace_values
+            self.namespace_values = source.global_namespace, source.local_namespace, source.format_strings, source.context
+        return self.namespace_values if include_context else self.namespace_values[:3]
+    
+    def batches(self):
+        for value in self:
+            yield [value]
+    
+    def pop(self, wait=True):
+        return next(self)
+    
+    def pop_many(self, max_values=None, wait=True):
+        """Returns a list of only the next value, since each value is computed when it is read."""
+        return [next(self)]
+    
+    def push_attribute(self, attribute_name, *output_channels):
+        attribute_value = getattr(self, attribute_name)
+        for chan in output_channels:
+            setattr(chan, attribute_name, attribute_value)
+    
+    def push_namespaces(self, *output_channels, include_context=True):
+        for attribute_name in ['global_namespace', 'local_namespace', 'format_strings'] + (['context'] if include_context else []):
+            self.push_attribute(attribute_name, *output_channels)
+    
+    def run_lazily(self, run, *args, break_on_exception=True, stop_if_abandoned=False):
+        """A generator which calls a run-style generator function (see jqsh.filter.Filter.run) on a channel of the values from this channel up to the first exception, and yields its output. An exception from the input ends the input of run, and is yielded after the rest of its output, as in Filter.run_raw, even if run returns before reading it. If stop_if_abandoned is true and run abandons its input, as nth does once it has found its value, the input exception is not yielded. Returns the namespaces of this channel, so that it can be used as the body of jqsh.filter.Filter.evaluate."""
+        import jqsh.values
+        
+        evaluation = jqsh.evaluation.current()
+        input_exceptions = []
+        
+        def input_values():
+            for value in self:
+                if isinstance(value, jqsh.values.JQSHException):
+                    input_exceptions.append(value)
+                    return
+                yield value
+        
+        run_input = LazyChannel(input_values(), namespaces=self)
+        try:
+            for value in run(*args, input_channel=run_input):
+                if evaluation is not None and evaluation.cancelled: # checked for each value, since nothing else can interrupt the thread
+                    raise jqsh.evaluation.Cancelled()
+                if isinstance(value, Batch):
+                    yield from (jqsh.values.from_native(batch_value) for batch_value in value)
+                    continue
+                value = jqsh.values.from_native(value) # like push does
+                yield value
+                if break_on_exception and isinstance(value, jqsh.values.JQSHException):
+                    return self.namespaces(include_context=True)
+        except Exception as e:
+            yield jqsh.values.JQSHException('internal', python_exception=e, exc_info=sys.exc_info(), traceback_string=traceback.format_exc())
+            return self.namespaces(include_context=True)
+        if not (stop_if_abandoned and run_input.abandoned):
+            input_exception = input_exceptions[0] if len(input_exceptions) else self.first_exception() # otherwise the rest of the input, which run didn't read, may contain one
+            if input_exception is not None:
+                yield input_exception
+        return self.namespaces(include_context=True)
+    
+    def take_first(self):
+        try:
+            return next(self)
+        finally:
+            self.abandon()
+    
+    def with_values(self, *values):
+        """Returns a channel containing the given values, with the same namespaces as this channel."""
+        return LazyChannel(values, namespaces=self)
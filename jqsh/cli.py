@@ -1,17 +1,135 @@
 import sys
 
 import blessings
+import codecs
+import io
+import jqsh.channel
+import jqsh.compiler
+import jqsh.evaluation
 import jqsh.filter
+import jqsh.optimizer
 import jqsh.parser
 import jqsh.values
+import mmap
+import os
+import stat
+
+def describe_cancellation(report):
+    """Returns a message about what cancelling an evaluation stopped, from the report returned by jqsh.evaluation.Evaluation.cancel."""
+    ret = 'cancelled in {seconds:.3f}s: stopped {threads} filter threads and {jobs} worker jobs, ended {channels} channels, killed {processes} command processes'.format(**report)
+    if report['threads_running'] or report['jobs_running']:
+        ret += ' ({threads_running} filter threads and {jobs_running} worker jobs are still running)'.format(**report)
+    return ret
+
+def map_file(binary_file):
+    """Returns a read-only memory map of a regular file and the position in the file at which reading should start, or (None, None) if the file can't be mapped, e.g. because it's a pipe, a terminal, an in-memory file, or empty."""
+    try:
+        file_descriptor = binary_file.fileno()
+        if not stat.S_ISREG(os.fstat(file_descriptor).st_mode):
+            return None, None
+        position = binary_file.tell() # includes anything that has already been read into the file's buffer
+        mapping = mmap.mmap(file_descriptor, 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, io.UnsupportedOperation): # ValueError is raised for empty files
+        return None, None
+    if hasattr(mapping, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mapping.madvise(mmap.MADV_SEQUENTIAL)
+    return mapping, position
 
 def print_output(filter_thread, output_file=None):
+    """Prints the output of a filter, a filter thread, or the output channel of a filter that has already been started, and returns the output namespaces."""
     terminal = blessings.Terminal()
     if output_file is None:
         output_file = sys.stdout
     if isinstance(filter_thread, jqsh.filter.Filter):
         filter_thread = jqsh.filter.FilterThread(filter_thread)
-    filter_thread.start()
-    for value in filter_thread.output_channel:
+    if isinstance(filter_thread, jqsh.filter.FilterThread):
+        filter_thread.start()
+        output_channel = filter_thread.output_channel
+    else:
+        output_channel = filter_thread
+    for value in output_channel:
         value.print_to_terminal(terminal, output_file)
-    return filter_thread.output_channel.namespaces()
+    return output_channel.namespaces()
+
+def read_chunks(input_file, chunk_size=65536, memory_map=True):
+    """Yields the text from a binary or text file in chunks. Where possible, whatever is available is returned instead of waiting for a full chunk, so that a pipe which is written to slowly is still decoded without delay.
+    
+    If memory_map is true and the input is a regular file, it is decoded straight from a memory map of the file, so the undecoded input stays in the page cache instead of being copied onto the heap, however large the file is.
+    """
+    binary_file = getattr(input_file, 'buffer', input_file)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    mapping, position = map_file(binary_file) if memory_map else (None, None)
+    if mapping is None:
+        read = getattr(binary_file, 'read1', binary_file.read)
+        while True:
+            data = read(chunk_size)
+            if not data:
+                break
+            text = decoder.decode(data)
+            if text:
+                yield text
+    else:
+        with mapping, memoryview(mapping) as mapped_bytes:
+            while position < len(mapped_bytes):
+                text = decoder.decode(mapped_bytes[position:position + chunk_size])
+                position += chunk_size
+                if text:
+                    yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+def read_input(input_file, output_channel, chunk_size=65536, record_separator=None, stream=False, error_file=None):
+    """Pushes the JSON values from input_file onto output_channel as soon as each one has been read, then terminates the channel. Meant to run on its own thread.
+    
+    If record_separator is given, the input is read as a sequence of JSON records (see jqsh.parser.parse_json_records). A malformed record is then printed to error_file as an input exception and skipped, instead of ending the input. If stream is true, [path, leaf] and [path] events are pushed instead of the values (see jqsh.parser.parse_json_events).
+    """
+    if error_file is None:
+        error_file = sys.stderr
+    try:
+        if stream:
+            for event in jqsh.parser.parse_json_events(jqsh.parser.tokenize_chunks(read_chunks(input_file, chunk_size=chunk_size))):
+                output_channel.push(event)
+        elif record_separator is None:
+            for value in jqsh.parser.parse_json_chunks(read_chunks(input_file, chunk_size=chunk_size)):
+                output_channel.push(value)
+        else:
+            terminal = blessings.Terminal(stream=error_file)
+            for value in jqsh.parser.parse_json_records(read_chunks(input_file, chunk_size=chunk_size), record_separator):
+                if isinstance(value, jqsh.values.JQSHException):
+                    value.print_to_terminal(terminal, error_file)
+                else:
+                    output_channel.push(value)
+    except (UnicodeDecodeError, SyntaxError, jqsh.parser.Incomplete) as e:
+        output_channel.throw(jqsh.values.JQSHException('input', python_exception=e))
+    else:
+        output_channel.terminate()
+
+def report_cancellation(evaluation, output_file=None):
+    """If the evaluation has been cancelled, waits until it has stopped and prints what was stopped, see describe_cancellation. Also stops its deadline timer, so it is called once the output has been read."""
+    if output_file is None:
+        output_file = sys.stdout
+    evaluation.finish()
+    if evaluation.cancelled:
+        evaluation.stopped.wait()
+        print('jqsh: ' + describe_cancellation(evaluation.report), file=output_file)
+
+def start_filter(the_filter, input_channel, engine='threads', deadline=None):
+    """Starts the filter with the given engine and returns its output channel.
+    
+    With the threads engine, every filter runs on its own thread. With the generators engine, the filters are chained generators which run on the thread that reads the output channel. The compiled engine runs them like the generators engine, but compiles the parse tree into closures first, see jqsh.compiler.compile_filter.
+    Unless jqsh.optimizer.enabled is false, the parse tree is optimized first with any engine, see jqsh.optimizer.optimize.
+    The filter runs as a new jqsh.evaluation.Evaluation, the evaluation attribute of the output channel, which can be cancelled, e.g. when the user presses control-C. It is cancelled at the deadline, if one is given as a time.monotonic() timestamp. Cancelling it stops reading the input channel.
+    """
+    if jqsh.optimizer.enabled:
+        the_filter = jqsh.optimizer.optimize(the_filter)
+    evaluation = jqsh.evaluation.Evaluation(deadline=deadline)
+    if engine == 'threads':
+        return evaluation.start(the_filter, input_channel)
+    evaluation.add_channel(input_channel)
+    if engine == 'generators':
+        return evaluation.start(the_filter, jqsh.channel.LazyChannel(input_channel, namespaces=input_channel))
+    elif engine == 'compiled':
+        return evaluation.start(jqsh.compiler.compile_filter(the_filter), jqsh.channel.LazyChannel(input_channel, namespaces=input_channel))
+    else:
+        raise ValueError('unknown engine: ' + repr(engine))
@@ -0,0 +1,225 @@
+import sys
+
+import copy
+import functools
+import jqsh.channel
+import jqsh.evaluation
+import jqsh.filter
+import jqsh.functions
+import jqsh.values
+import traceback
+
+compilers = {} # maps filter classes to functions returning the evaluate closures of compiled filters, see compiler
+
+def compiled_attribute(value):
+    """Compiles the filters in an attribute value of a filter, looking into lists, tuples and dicts like jqsh.cache.child_filters."""
+    if isinstance(value, jqsh.filter.Filter):
+        return compile_filter(value)
+    elif isinstance(value, dict):
+        return {key: compiled_attribute(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [compiled_attribute(item) for item in value]
+    elif isinstance(value, tuple):
+        return tuple(compiled_attribute(item) for item in value)
+    else:
+        return value
+
+@functools.lru_cache(maxsize=1024)
+def compile_filter(the_filter):
+    """Returns a copy of the parse tree in which every filter has its own evaluate closure (see jqsh.filter.Filter.evaluate), so it can be run with jqsh.cli.start_filter's compiled engine.
+
+    For the filter classes that have a compiler, the closure is specialized when compiling: literal values, constant lookup keys, the names of variables and builtins, and the branch of Apply are resolved once instead of every time the filter runs. Other filters evaluate as usual, but with compiled child filters. Parse trees are not modified by running them, so compiled trees are cached like jqsh.cache.parse caches parse trees.
+    """
+    ret = copy.copy(the_filter)
+    compile_children, f = compilers.get(the_filter.__class__, (True, None))
+    if compile_children:
+        for attribute_name, attribute_value in vars(the_filter).items():
+            setattr(ret, attribute_name, compiled_attribute(attribute_value))
+    if f is not None:
+        ret.evaluate = f(ret)
+    return ret
+
+def compiler(filter_class, compile_children=True):
+    """Registers a function which is called with a copy of a filter of the given class, with compiled child filters unless compile_children is false, and returns its evaluate closure."""
+    def ret(f):
+        compilers[filter_class] = compile_children, f
+        return f
+
+    return ret
+
+def default_builtin(function_name, num_args):
+    """Returns the builtin which the default context (see jqsh.context.FilterContext) resolves the name to, or None if there is none."""
+    try:
+        return jqsh.functions.get_builtin(function_name, num_args=num_args)
+    except KeyError:
+        return None
+
+def evaluate_values(run, input_channel):
+    """The compiled counterpart to jqsh.channel.LazyChannel.run_lazily, for the run methods of filters which only yield jqsh values, see values_compiler. Their output is not converted with jqsh.values.from_native, and exceptions are recognized by their class, since JQSHException has no subclasses."""
+    evaluation = jqsh.evaluation.current()
+    input_exceptions = []
+    
+    def input_values():
+        for value in input_channel:
+            if value.__class__ is jqsh.values.JQSHException:
+                input_exceptions.append(value)
+                return
+            yield value
+    
+    try:
+        for value in run(input_channel=jqsh.channel.LazyChannel(input_values(), namespaces=input_channel)):
+            if evaluation is not None and evaluation.cancelled:
+                raise jqsh.evaluation.Cancelled()
+            yield value
+            if value.__class__ is jqsh.values.JQSHException:
+                return input_channel.namespaces(include_context=True)
+    except Exception as e:
+        yield jqsh.values.JQSHException('internal', python_exception=e, exc_info=sys.exc_info(), traceback_string=traceback.format_exc())
+        return input_channel.namespaces(include_context=True)
+    input_exception = input_exceptions[0] if len(input_exceptions) else input_channel.first_exception() # otherwise the rest of the input, which run didn't read, may contain one
+    if input_exception is not None:
+        yield input_exception
+    return input_channel.namespaces(include_context=True)
+
+def values_compiler(*filter_classes):
+    """Registers a compiler for filter classes which are evaluated by their run method, and whose run method only yields jqsh values, see evaluate_values."""
+    for filter_class in filter_classes:
+        compiler(filter_class)(lambda the_filter: functools.partial(evaluate_values, the_filter.run))
+
+values_compiler(jqsh.filter.Add, jqsh.filter.Array, jqsh.filter.Comma, jqsh.filter.Conditional, jqsh.filter.Fused, jqsh.filter.Multiply, jqsh.filter.Object, jqsh.filter.Pair, jqsh.filter.Parens, jqsh.filter.Pipe, jqsh.filter.Try)
+
+@compiler(jqsh.filter.Apply)
+def compile_apply(the_filter):
+    attributes = the_filter.attributes
+    if all(attribute.__class__ == jqsh.filter.Filter for attribute in attributes): # identity function
+        def evaluate(input_channel):
+            namespaces = input_channel.namespaces(include_context=True)
+            yield from input_channel
+            return namespaces
+    elif len(attributes) == 2 and all(attribute.__class__ == jqsh.filter.NumberLiteral for attribute in attributes): # decimal number
+        number = jqsh.values.Number(str(attributes[0]) + '.' + str(attributes[1]))
+
+        def evaluate(input_channel):
+            namespaces = input_channel.namespaces(include_context=True)
+            yield number
+            input_exception = input_channel.first_exception()
+            if input_exception is not None:
+                yield input_exception
+            return namespaces
+    elif attributes[0].__class__ == jqsh.filter.Filter and attributes[1].__class__ in (jqsh.filter.NumberLiteral, jqsh.filter.StringLiteral): # lookup with a constant key
+        if attributes[1].__class__ == jqsh.filter.NumberLiteral:
+            key = jqsh.values.Number(attributes[1].number)
+        else:
+            key = jqsh.values.String(attributes[1].text)
+            key.value # read the whole string, so that it can be used as a key any number of times
+
+        def evaluate(input_channel):
+            namespaces = input_channel.namespaces(include_context=True)
+            for value in jqsh.filter.Apply.lookup(key, input_channel):
+                yield value
+                if isinstance(value, jqsh.values.JQSHException):
+                    break
+            return namespaces
+    elif attributes[0].__class__ == jqsh.filter.Name: # built-in function with arguments
+        function_name = attributes[0].name
+        args = attributes[1:]
+        builtin = default_builtin(function_name, len(args))
+
+        def evaluate(input_channel):
+            namespaces = input_channel.namespaces(include_context=True)
+            context = input_channel.context
+            if context.get_builtin is jqsh.functions.get_builtin:
+                context_builtin = builtin
+            else:
+                try:
+                    context_builtin = context.get_builtin(function_name, *args)
+                except KeyError:
+                    context_builtin = None
+            if context_builtin is None:
+                yield jqsh.values.JQSHException('numArgs') if function_name in jqsh.functions.builtin_functions else jqsh.values.JQSHException('name', missing_name=function_name) #TODO fix for context-based builtins
+                return namespaces
+            return (yield from context_builtin.evaluate(*args, input_channel=input_channel))
+    else: # lookup with a computed key, or a command
+        return the_filter.evaluate
+    return evaluate
+
+@compiler(jqsh.filter.GlobalVariable)
+def compile_global_variable(the_filter):
+    if the_filter.attribute.__class__ != jqsh.filter.Name:
+        return the_filter.evaluate
+    variable_name = the_filter.attribute.name
+
+    def evaluate(input_channel):
+        global_namespace = input_channel.global_namespace
+        if variable_name in global_namespace:
+            yield from global_namespace[variable_name]
+            input_exception = input_channel.first_exception()
+            if input_exception is not None:
+                yield input_exception
+        else:
+            yield jqsh.values.JQSHException('name', missing_name=variable_name)
+        return input_channel.namespaces(include_context=True)
+
+    return evaluate
+
+@compiler(jqsh.filter.Module, compile_children=False)
+def compile_module(the_filter):
+    return jqsh.filter.Module((compile_filter(statement), last) for statement, last in the_filter.statements).evaluate # compiled as they are parsed
+
+@compiler(jqsh.filter.Name)
+def compile_name(the_filter):
+    name = the_filter.name
+    builtin = default_builtin(name, 0)
+
+    def evaluate(input_channel):
+        local_namespace = input_channel.local_namespace
+        if name in local_namespace:
+            yield from local_namespace[name]
+            input_exception = input_channel.first_exception()
+            if input_exception is not None:
+                yield input_exception
+            return input_channel.namespaces(include_context=True)
+        context = input_channel.context
+        if context.get_builtin is jqsh.functions.get_builtin:
+            context_builtin = builtin
+        else:
+            try:
+                context_builtin = context.get_builtin(name)
+            except KeyError:
+                context_builtin = None
+        if context_builtin is None:
+            yield jqsh.values.JQSHException('numArgs', function_name=name, expected=set(jqsh.functions.builtin_functions[name]), received=0) if name in jqsh.functions.builtin_functions else jqsh.values.JQSHException('name', missing_name=name)
+            return input_channel.namespaces(include_context=True)
+        return (yield from context_builtin.evaluate(input_channel=input_channel))
+
+    return evaluate
+
+@compiler(jqsh.filter.NumberLiteral)
+def compile_number_literal(the_filter):
+    number = jqsh.values.Number(the_filter.number)
+
+    def evaluate(input_channel):
+        yield number
+        input_exception = input_channel.first_exception() # the input values are not used, but an exception among them is output, see evaluate_values
+        if input_exception is not None:
+            yield input_exception
+        return input_channel.namespaces(include_context=True)
+
+    return evaluate
+
+@compiler(jqsh.filter.Semicolon, compile_children=False)
+def compile_semicolon(the_filter):
+    return jqsh.filter.Module([(compile_filter(statement), last) for statement, last in the_filter.statements()]).evaluate # the statements are compiled one by one, since a chain of them is as deep as it is long
+
+@compiler(jqsh.filter.StringLiteral)
+def compile_string_literal(the_filter):
+    text = the_filter.text
+
+    def evaluate(input_channel):
+        yield jqsh.values.String(text)
+        input_exception = input_channel.first_exception()
+        if input_exception is not None:
+            yield input_exception
+        return input_channel.namespaces(include_context=True)
+
+    return evaluate
@@ -0,0 +1,158 @@
+import threading
+import time
+import weakref
+
+local = threading.local() # holds the evaluation the current thread is working for, see current
+
+class Cancelled(BaseException):
+    """Raised on the thread running the generator engine once its evaluation has been cancelled. Like KeyboardInterrupt, it is not an Exception, so the handlers which turn Python exceptions into jqsh exceptions let it through, and the chain of generators is closed as it propagates."""
+
+class Evaluation:
+    """One run of a filter, with the filter threads, worker jobs, channels and command processes that were started for it, so that they can all be stopped at once, e.g. when the user presses control-C or a deadline passes.
+    
+    A thread works for the evaluation of the thread that started it: filter threads and worker jobs are registered with the evaluation that is current when they are started, and so are the channels and processes they create. Only weak references are kept, so the parts that have finished are forgotten.
+    """
+    cancelled = False
+    exception = None # the exception which ends the output once the evaluation has been cancelled, if any
+    input_channel = None
+    output_channel = None
+    report = None # what cancel stopped, see cancel
+    
+    def __init__(self, deadline=None, join_timeout=5.0):
+        """If deadline is given, as a time.monotonic() timestamp, the evaluation is cancelled then, and its output ends with a timeout exception. join_timeout is how long cancel waits for the threads to finish."""
+        self.deadline = deadline
+        self.join_timeout = join_timeout
+        self.lock = threading.Lock()
+        self.channels = {} # the parts of the evaluation, as weak references by id, see add
+        self.jobs = {}
+        self.processes = {}
+        self.threads = {}
+        self.stopped = threading.Event() # set once cancel has stopped everything
+        self.timer = None
+    
+    def add(self, parts, part):
+        """Adds a weak reference to the part to one of the dicts of parts, which drops it once the part is gone. Parts are keyed by id rather than kept in a weakref.WeakSet, since values are channels whose hash reads all their values."""
+        key = id(part)
+        
+        def forget(ref): # without the lock, since the garbage collector may call this on a thread which holds it
+            if parts.get(key) is ref:
+                parts.pop(key, None)
+        
+        with self.lock:
+            parts[key] = weakref.ref(part, forget)
+    
+    def add_channel(self, channel):
+        self.add(self.channels, channel)
+    
+    def add_job(self, job):
+        self.add(self.jobs, job)
+    
+    def add_process(self, process):
+        self.add(self.processes, process)
+    
+    def add_thread(self, thread):
+        self.add(self.threads, thread)
+    
+    def cancel(self, exception=None):
+        """Stops everything that belongs to the evaluation: command processes are killed, and every channel is ended at once (see jqsh.channel.Channel.cancel), so the threads waiting to read or write them finish. Waits up to join_timeout seconds for them.
+        
+        The output channel then ends with the exception, if one is given. Returns a dict with the number of seconds this took and the numbers of threads, worker jobs, channels and processes that were stopped, along with those of the threads and jobs still running. It is also stored as the report attribute. Returns None if the evaluation had already been cancelled.
+        """
+        import jqsh.channel
+        
+        start = time.monotonic()
+        with self.lock:
+            if self.cancelled:
+                return None
+            self.cancelled = True
+            self.exception = exception
+            channels, processes, threads, jobs = ([part for part in (ref() for ref in list(parts.values())) if part is not None] for parts in (self.channels, self.processes, self.threads, self.jobs))
+        threads = [thread for thread in threads if thread.is_alive()]
+        jobs = [job for job in jobs if not job.done.is_set()]
+        if self.timer is not None:
+            self.timer.cancel()
+        killed_processes = [process for process in processes if process.poll() is None]
+        for process in killed_processes:
+            process.kill()
+        if isinstance(self.output_channel, jqsh.channel.Channel):
+            self.output_channel.cancel(exception, namespaces_from=self.input_channel) # before the input, whose namespaces become empty if they are still undefined
+        for channel in channels:
+            if channel is not self.output_channel:
+                channel.cancel()
+        end = start + self.join_timeout
+        for thread_or_job in threads + jobs:
+            thread_or_job.join(max(0, end - time.monotonic()))
+        self.report = {
+            'seconds': time.monotonic() - start,
+            'threads': len(threads),
+            'jobs': len(jobs),
+            'channels': len(channels),
+            'processes': len(killed_processes),
+            'threads_running': sum(1 for thread in threads if thread.is_alive()),
+            'jobs_running': sum(1 for job in jobs if not job.done.is_set())
+        }
+        self.stopped.set()
+        return self.report
+    
+    def evaluate(self, output_channel):
+        """The values of the output channel with the generator engine. The values of the filter's output are computed as this evaluation, and if it is cancelled meanwhile, they end with its exception instead."""
+        while True:
+            previous = switch(self)
+            try:
+                value = next(output_channel)
+            except StopIteration:
+                if not self.cancelled:
+                    return output_channel.namespaces(include_context=True)
+                break
+            except Cancelled:
+                break
+            finally:
+                switch(previous)
+            if self.cancelled: # e.g. the input was cancelled while the filter was reading it
+                break
+            try:
+                yield value
+            except GeneratorExit:
+                output_channel.abandon() # see jqsh.channel.LazyChannel.close
+                raise
+        if self.exception is not None:
+            yield self.exception
+        return self.input_channel.namespaces(include_context=True)
+    
+    def finish(self):
+        """Stops the deadline timer, once the output has been read."""
+        if self.timer is not None:
+            self.timer.cancel()
+    
+    def start(self, the_filter, input_channel=None):
+        """Starts the filter as this evaluation, like jqsh.filter.Filter.start, and returns its output channel, whose evaluation attribute is this evaluation. A channel given as the input is cancelled with the evaluation."""
+        import jqsh.channel
+        import jqsh.values
+        
+        if isinstance(input_channel, jqsh.channel.Channel):
+            self.add_channel(input_channel)
+        self.input_channel = jqsh.channel.Channel(terminated=True) if input_channel is None else input_channel
+        previous = switch(self)
+        try:
+            output_channel = the_filter.start(self.input_channel)
+        finally:
+            switch(previous)
+        if isinstance(output_channel, jqsh.channel.LazyChannel):
+            output_channel = jqsh.channel.LazyChannel(self.evaluate(output_channel))
+            output_channel.evaluation = self
+        self.output_channel = output_channel
+        if self.deadline is not None:
+            self.timer = threading.Timer(max(0, self.deadline - time.monotonic()), self.cancel, kwargs={'exception': jqsh.values.JQSHException('timeout', deadline=self.deadline)})
+            self.timer.daemon = True
+            self.timer.start()
+        return output_channel
+
+def current():
+    """Returns the evaluation the current thread is working for, or None."""
+    return getattr(local, 'evaluation', None)
+
+def switch(evaluation):
+    """Makes the current thread work for the evaluation, which may be None, and returns the one it was working for."""
+    previous = getattr(local, 'evaluation', None)
+    local.evaluation = evaluation
+    return previous
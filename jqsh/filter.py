@@ -5,7 +5,9 @@ import copy
 import decimal
 import itertools
 import jqsh.channel
+import jqsh.evaluation
 import jqsh.functions
+import jqsh.pool
 import jqsh.values
 import more_itertools
 import subprocess
@@ -20,9 +22,13 @@ class FilterThread(threading.Thread):
         super().__init__(name='jqsh FilterThread')
         self.filter = the_filter
         self.input_channel = jqsh.channel.Channel(terminated=True) if input_channel is None else input_channel
-        self.output_channel = jqsh.channel.Channel()
+        self.output_channel = jqsh.channel.Channel(capacity=jqsh.channel.default_capacity)
+        self.evaluation = jqsh.evaluation.current() # the thread works for the evaluation of the thread that creates it
+        if self.evaluation is not None:
+            self.evaluation.add_thread(self)
     
     def run(self):
+        jqsh.evaluation.switch(self.evaluation)
         self.filter.run_raw(self.input_channel, self.output_channel)
 
 class Filter:
@@ -37,6 +43,28 @@ class Filter:
     def assign(self, value_channel, input_channel, output_channel):
         raise NotImplementedError('cannot assign to this filter')
     
+    def changes_namespaces(self):
+        """Returns whether the output namespaces can differ from the input namespaces. If not, the generator engine doesn't have to wait for the filter to finish before passing the namespaces on."""
+        return False
+    
+    def evaluate(self, input_channel):
+        """The generator engine's counterpart to run_raw, which evaluates the filter on the calling thread. It is called with a jqsh.channel.LazyChannel, yields the output values, and returns the output namespaces as a tuple like the one jqsh.channel.LazyChannel takes.
+        
+        Subclasses that override run_raw should override this as well.
+        """
+        return (yield from input_channel.run_lazily(self.run))
+    
+    def evaluate_assign(self, value_channel, input_channel):
+        """The generator engine's counterpart to assign."""
+        raise NotImplementedError('cannot assign to this filter')
+    
+    def map_function(self):
+        """Returns a function which computes the filter's output for a single input value, if the filter maps each input value to exactly one output value regardless of the other values, or None otherwise. The function is never called with an exception, and it returns an exception instead of the value if one occurs.
+        
+        Such filters can run on each value separately, so pipelines of them are fused into one stage by jqsh.optimizer, see Fused.
+        """
+        return None
+    
     def run(self, input_channel):
         """This is called from run_raw, and should be overridden by subclasses.
         
@@ -45,40 +73,72 @@ class Filter:
         return
         yield # the empty generator #FROM http://stackoverflow.com/a/13243870/667338
     
+    async def run_async(self, values=(), **namespaces):
+        """Runs the filter with the asyncio engine on the given input values and returns the list of output values. Many filters can run concurrently on one event loop, since they wait for their input and for commands without blocking it. See jqsh.asynchronous.run, which takes the same keyword arguments for the input namespaces."""
+        import jqsh.asynchronous
+        
+        return await jqsh.asynchronous.run(self, values, **namespaces)
+    
     def run_raw(self, input_channel, output_channel):
         """This is called from the filter thread, and may be overridden by subclasses instead of run."""
+        output_exceptions = []
+        
         def run_thread(bridge):
             try:
-                for value in self.run(input_channel=bridge):
+                output_values = self.run(input_channel=bridge)
+                for value in output_values:
                     output_channel.push(value)
                     if isinstance(value, jqsh.values.JQSHException):
+                        output_exceptions.append(value)
                         break
+                    if output_channel.abandoned:
+                        break
+                output_values.close() # if the output has been abandoned, this abandons the channels run was reading from, see jqsh.channel.Channel.close
             except Exception as e:
+                output_exceptions.append(e)
                 output_channel.throw(jqsh.values.JQSHException('internal', python_exception=e, exc_info=sys.exc_info(), traceback_string=traceback.format_exc()))
+            bridge.abandon() # run won't read any more input
         
-        bridge_channel = jqsh.channel.Channel()
-        helper_thread = threading.Thread(target=run_thread, kwargs={'bridge': bridge_channel})
-        handle_namespaces = threading.Thread(target=input_channel.push_namespaces, args=(bridge_channel, output_channel))
-        helper_thread.start()
-        handle_namespaces.start()
-        for value in input_channel:
-            bridge_channel.push(value)
-            if isinstance(value, jqsh.values.JQSHException):
-                output_channel.throw(value)
+        bridge_channel = jqsh.channel.Channel(capacity=jqsh.channel.default_capacity)
+        helper_thread = jqsh.pool.start(run_thread, bridge=bridge_channel)
+        handle_namespaces = jqsh.pool.start(input_channel.push_namespaces, bridge_channel, output_channel)
+        input_exception = None
+        for values in input_channel.batches():
+            exception_indices = [index for index, value in enumerate(values) if isinstance(value, jqsh.values.JQSHException)]
+            if len(exception_indices):
+                if not bridge_channel.abandoned:
+                    bridge_channel.push_many(values[:exception_indices[0]])
+                input_exception = values[exception_indices[0]]
+                input_channel.abandon()
+                break
+            if output_channel.abandoned or len(output_exceptions): # an input exception would not be output any more
+                input_channel.abandon()
                 break
+            if not bridge_channel.abandoned: # once run is done, the rest of the input is still read for its first exception, so that whether it is output doesn't depend on timing
+                bridge_channel.push_many(values)
         bridge_channel.terminate()
         helper_thread.join()
+        if input_exception is not None and len(output_exceptions) == 0: # only now, so that it comes after the output for the values before it, as with run_lazily
+            output_channel.throw(input_exception)
         handle_namespaces.join()
         output_channel.terminate()
     
     def sensible_string(self, input_channel=None):
-        ret = next(self.start(input_channel))
+        ret = self.start(input_channel).take_first()
         if isinstance(ret, jqsh.values.String):
             return ret.value
         else:
             raise TypeError('got a ' + ret.__class__.__name__ + ', expected a string')
     
-    def start(self, input_channel=None):
+    def start(self, input_channel=None, deadline=None):
+        """Starts the filter and returns its output channel. If input_channel is a jqsh.channel.LazyChannel, the filter is run by the generator engine instead of on a new thread, see evaluate.
+        
+        If a deadline is given, as a time.monotonic() timestamp, the filter runs as a new jqsh.evaluation.Evaluation, which is cancelled at the deadline: its threads and command processes are stopped, and the output ends with a timeout exception.
+        """
+        if deadline is not None:
+            return jqsh.evaluation.Evaluation(deadline=deadline).start(self, input_channel)
+        if isinstance(input_channel, jqsh.channel.LazyChannel):
+            return jqsh.channel.LazyChannel(self.evaluate(input_channel), namespaces=input_channel if not self.changes_namespaces() else None)
         filter_thread = FilterThread(self, input_channel=input_channel)
         filter_thread.start()
         return filter_thread.output_channel
@@ -93,6 +153,9 @@ class Parens(Filter):
     def __str__(self):
         return '(' + str(self.attribute) + ')'
     
+    def map_function(self):
+        return self.attribute.map_function()
+    
     def run(self, input_channel):
         yield from self.attribute.start(input_channel)
 
@@ -100,6 +163,9 @@ class Array(Parens):
     def __str__(self):
         return '[' + str(self.attribute) + ']'
     
+    def map_function(self):
+        return None # collects all values
+    
     def run(self, input_channel):
         yield jqsh.values.Array(self.attribute.start(input_channel))
 
@@ -107,6 +173,9 @@ class Object(Parens):
     def __str__(self):
         return '{' + str(self.attribute) + '}'
     
+    def map_function(self):
+        return None # collects all values
+    
     def run(self, input_channel):
         #TODO handle shorthand keys and sensible strings
         obj = jqsh.values.Object(terminated=False)
@@ -130,29 +199,60 @@ class Conditional(Filter):
     def __str__(self):
         return ' '.join(attribute_name + ' ' + str(attribute_value) for attribute_name, attribute_value in self.attributes) + ' end'
     
-    def run(self, input_channel):
+    def branch(self, input_channel, value=None):
+        """Returns the filter to run for an input value: the one after the then of the first condition whose first output for the value is true, the else filter, or None if there is neither. If no value is given, the conditions are evaluated without input values instead.
+        
+        Returns an exception instead if the output of a condition is empty or starts with an exception. Conditions which map each value (see Filter.map_function) are computed inline, and the others are evaluated for the value by the generator engine on the calling thread, rather than being started on a new thread for each value.
+        """
+        conditional = False
         for attribute_name, attribute_value in self.attributes:
             if attribute_name in ('if', 'elif', 'elseIf'):
-                input_channel, conditional_input = input_channel / 2
-                try:
-                    next_value = next(attribute_value.start(conditional_input))
-                    if isinstance(next_value, jqsh.values.JQSHException):
-                        yield next_value
-                        return
-                    conditional = bool(next_value)
-                except StopIteration:
-                    yield jqsh.values.JQSHException('empty')
-                    return
+                function = None if value is None else attribute_value.map_function()
+                if function is None:
+                    try:
+                        next_value = attribute_value.start(input_channel.with_values() if value is None else jqsh.channel.LazyChannel((value,), namespaces=input_channel)).take_first()
+                    except StopIteration:
+                        return jqsh.values.JQSHException('empty')
+                else:
+                    next_value = function(value)
+                if isinstance(next_value, jqsh.values.JQSHException):
+                    return next_value
+                conditional = bool(next_value)
             elif attribute_name == 'then':
-                if not conditional:
-                    continue
-                yield from attribute_value.start(input_channel)
-            elif attribute_name == 'else':
                 if conditional:
-                    continue
-                yield from attribute_value.start(input_channel)
+                    return attribute_value
+            elif attribute_name == 'else':
+                return attribute_value
             else:
                 raise NotImplementedError('unknown clause in if filter')
+        return None
+    
+    def run(self, input_channel):
+        """Each input value is passed to the branch chosen for it, so the input stream is never split. Like the conditions, a branch runs inline or on the generator engine for each value, see branch. If there are no input values, the branch is chosen without them and run on the empty input, since it may still have output, e.g. a literal."""
+        empty = True
+        for value in input_channel:
+            empty = False
+            branch = self.branch(input_channel, value)
+            if isinstance(branch, jqsh.values.JQSHException):
+                yield branch
+                return
+            elif branch is None:
+                continue
+            function = branch.map_function()
+            if function is None:
+                branch_output = branch.start(jqsh.channel.LazyChannel((value,), namespaces=input_channel))
+                try:
+                    yield from branch_output
+                finally:
+                    branch_output.abandon()
+            else:
+                yield function(value)
+        if empty:
+            branch = self.branch(input_channel)
+            if isinstance(branch, jqsh.values.JQSHException):
+                yield branch
+            elif branch is not None:
+                yield from branch.start(input_channel)
 
 class Try(Conditional):
     def run(self, input_channel):
@@ -170,6 +270,8 @@ class Try(Conditional):
                 except (StopIteration, TypeError):
                     yield jqsh.values.JQSHException('sensibleString')
                     return
+                finally:
+                    exception_name_input.abandon()
             elif attribute_name == 'then':
                 for exception_name in exception_names:
                     exception_handlers[exception_name] = attribute_value
@@ -178,22 +280,146 @@ class Try(Conditional):
             elif attribute_name == 'else':
                 else_handler = attribute_value
         try_input, except_input = input_channel / 2
-        try_output, ret = try_block.start(try_input) / 2
-        for value in try_output:
-            if isinstance(value, jqsh.values.JQSHException):
+        try_output = try_block.start(try_input)
+        handler = else_handler
+        try:
+            for value in try_output:
+                if not isinstance(value, jqsh.values.JQSHException):
+                    if else_handler is None:
+                        yield value # forwarded as it arrives, since only an else handler replaces the output
+                    continue
                 if value.name in exception_handlers:
-                    yield from exception_handlers[value.name].start(except_input) #TODO modify context to allow re-raise
-                    return
+                    handler = exception_handlers[value.name]
                 elif default_handler is not None:
-                    yield from default_handler.start(except_input) #TODO modify context to allow re-raise
-                    return
+                    handler = default_handler
                 else:
                     yield value
                     return
-        if else_handler is None:
-            yield from ret
-        else:
-            yield from else_handler.start(except_input)
+                break
+            try_output.abandon() # once an exception is handled, the try block is cancelled
+            if handler is not None:
+                yield from handler.start(except_input) #TODO modify context to allow re-raise
+        finally:
+            try_output.abandon()
+            except_input.abandon()
+
+class Fused(Filter):
+    """A pipeline of filters which map each input value to one output value (see Filter.map_function), fused by jqsh.optimizer into a single stage that computes each output value inline, instead of running each filter on its own thread with its own channels."""
+    def __init__(self, attribute):
+        self.attribute = attribute
+        self.function = attribute.map_function()
+    
+    def __repr__(self):
+        return 'jqsh.filter.' + self.__class__.__name__ + '(' + repr(self.attribute) + ')'
+    
+    def __str__(self):
+        return str(self.attribute)
+    
+    def map_function(self):
+        return self.function
+    
+    def run(self, input_channel):
+        empty = True
+        for value in input_channel:
+            empty = False
+            output = self.function(value)
+            yield output
+            if isinstance(output, jqsh.values.JQSHException):
+                return
+        if empty: # the filters may still have output, e.g. the literal operand of an operator
+            yield from self.attribute.start(input_channel)
+
+class StatementBuffer:
+    """The statements of a Module, which can be iterated any number of times, also concurrently. Each statement is taken from the underlying iterable once, by the first iteration that needs it, and replayed by the others, as is an exception raised while parsing."""
+    def __init__(self, statements):
+        self.lock = threading.Lock()
+        self.parse_exception = None
+        self.statement_iterator = iter(statements)
+        self.statements = []
+    
+    def __iter__(self):
+        index = 0
+        while True:
+            with self.lock:
+                if index == len(self.statements):
+                    if self.parse_exception is not None:
+                        raise self.parse_exception
+                    if self.statement_iterator is None:
+                        return
+                    try:
+                        self.statements.append(next(self.statement_iterator))
+                    except StopIteration:
+                        self.statement_iterator = None
+                        return
+                    except Exception as e:
+                        self.parse_exception = e
+                        raise
+                statement = self.statements[index]
+            index += 1
+            yield statement
+
+class Module(Filter):
+    """A module which is parsed while it runs. Behaves like its top-level statements joined by Semicolon, but each statement is started as soon as it has been parsed. The parsed statements are kept, so the module can run again, like any other parse tree."""
+    def __init__(self, statements):
+        self.statements = statements if isinstance(statements, StatementBuffer) else StatementBuffer(statements) # (statement, last) pairs, see jqsh.parser.parse_statements
+    
+    def __repr__(self):
+        return 'jqsh.filter.' + self.__class__.__name__ + '(' + repr(self.statements) + ')'
+    
+    def changes_namespaces(self):
+        return True
+    
+    def evaluate(self, input_channel):
+        import jqsh.parser
+        
+        statement_input = input_channel
+        try:
+            for statement, last in self.statements:
+                if last:
+                    break
+                left_input, statement_input = statement_input / 2
+                previous_output = statement.start(left_input)
+                previous_output.drain() # unlike with the threaded engine, each statement finishes before the next one starts
+                statement_input.get_namespaces(previous_output)
+            else:
+                statement = Filter() # there is no last statement, e.g. in an empty module
+        except (SyntaxError, UnicodeDecodeError, jqsh.parser.Incomplete) as e:
+            yield jqsh.values.JQSHException('syntax', python_exception=e)
+            return statement_input.namespaces(include_context=True)
+        return (yield from statement.evaluate(statement_input))
+    
+    def run_raw(self, input_channel, output_channel):
+        import jqsh.parser
+        
+        statement_input = input_channel
+        previous_output = None
+        statement_output = None
+        try:
+            for statement, last in self.statements:
+                if previous_output is not None:
+                    previous_output.abandon() # only the namespaces of a statement that isn't the last one are used
+                    statement_input.get_namespaces(previous_output)
+                if last:
+                    statement_output = statement.start(statement_input)
+                else:
+                    left_input, statement_input = statement_input / 2
+                    previous_output = statement.start(left_input)
+        except (SyntaxError, UnicodeDecodeError, jqsh.parser.Incomplete) as e:
+            output_channel.throw(jqsh.values.JQSHException('syntax', python_exception=e)) # statements before the error have already run, like commands in a shell script
+            return
+        if statement_output is None: # there is no last statement, e.g. in an empty module
+            if previous_output is not None:
+                previous_output.abandon()
+                statement_input.get_namespaces(previous_output)
+            statement_output = Filter().start(statement_input)
+        handle_namespaces = jqsh.pool.start(output_channel.get_namespaces, statement_output) # while pushing the values, in case the reader waits for the namespaces first
+        for value in statement_output:
+            output_channel.push(value)
+            if output_channel.abandoned:
+                statement_output.abandon()
+                break
+        output_channel.terminate()
+        handle_namespaces.join()
 
 class Name(Filter):
     def __init__(self, name):
@@ -206,35 +432,62 @@ class Name(Filter):
         return self.name
     
     def assign(self, value_channel, input_channel, output_channel):
-        handle_globals = threading.Thread(target=input_channel.push_attribute, args=('global_namespace', output_channel))
-        handle_format_strings = threading.Thread(target=input_channel.push_attribute, args=('format_strings', output_channel))
-        handle_context = threading.Thread(target=input_channel.push_attribute, args=('context', output_channel))
-        handle_values = threading.Thread(target=output_channel.pull, args=(input_channel,))
-        handle_globals.start()
-        handle_format_strings.start()
-        handle_context.start()
-        handle_values.start()
+        handle_globals = jqsh.pool.start(input_channel.push_attribute, 'global_namespace', output_channel)
+        handle_format_strings = jqsh.pool.start(input_channel.push_attribute, 'format_strings', output_channel)
+        handle_context = jqsh.pool.start(input_channel.push_attribute, 'context', output_channel)
+        handle_values = None
         input_locals = copy.copy(input_channel.local_namespace)
         var = list(value_channel)
         for value in var:
             if isinstance(value, jqsh.values.JQSHException):
                 output_channel.throw(value)
+                input_channel.abandon()
                 break
         else:
             input_locals[self.name] = var
+            handle_values = jqsh.pool.start(output_channel.pull, input_channel) # only once the assignment has succeeded, since the output is terminated by throw otherwise
         output_channel.local_namespace = input_locals
-        output_channel.terminate()
         handle_globals.join()
         handle_format_strings.join()
         handle_context.join()
-        handle_values.join()
+        if handle_values is not None:
+            handle_values.join()
+    
+    def evaluate(self, input_channel):
+        if self.name in input_channel.local_namespace:
+            yield from input_channel.local_namespace[self.name]
+            input_exception = input_channel.first_exception()
+            if input_exception is not None:
+                yield input_exception
+            return input_channel.namespaces(include_context=True)
+        try:
+            builtin = input_channel.context.get_builtin(self.name)
+        except KeyError:
+            yield jqsh.values.JQSHException('numArgs', function_name=self.name, expected=set(jqsh.functions.builtin_functions[self.name]), received=0) if self.name in jqsh.functions.builtin_functions else jqsh.values.JQSHException('name', missing_name=self.name)
+            return input_channel.namespaces(include_context=True)
+        return (yield from builtin.evaluate(input_channel=input_channel))
+    
+    def evaluate_assign(self, value_channel, input_channel):
+        global_namespace, local_namespace, format_strings, context = input_channel.namespaces(include_context=True)
+        local_namespace = copy.copy(local_namespace)
+        var = list(value_channel)
+        for value in var:
+            if isinstance(value, jqsh.values.JQSHException):
+                yield value
+                break
+        else:
+            local_namespace[self.name] = var
+            yield from input_channel
+        return global_namespace, local_namespace, format_strings, context
     
     def run_raw(self, input_channel, output_channel):
         if self.name in input_channel.local_namespace:
-            handle_namespaces = threading.Thread(target=input_channel.push_namespaces, args=(output_channel,))
-            handle_namespaces.start()
+            handle_namespaces = jqsh.pool.start(input_channel.push_namespaces, output_channel)
             for value in input_channel.local_namespace[self.name]:
                 output_channel.push(value)
+            input_exception = input_channel.first_exception(output_channel) # the input values are not used, but an exception among them is output, as in Filter.run_raw
+            if input_exception is not None:
+                output_channel.push(input_exception)
             output_channel.terminate()
             handle_namespaces.join()
         else:
@@ -242,6 +495,7 @@ class Name(Filter):
                 builtin = input_channel.context.get_builtin(self.name)
             except KeyError:
                 output_channel.throw(jqsh.values.JQSHException('numArgs', function_name=self.name, expected=set(jqsh.functions.builtin_functions[self.name]), received=0) if self.name in jqsh.functions.builtin_functions else jqsh.values.JQSHException('name', missing_name=self.name)) #TODO fix for context-based builtins
+                input_channel.abandon()
             else:
                 builtin(input_channel=input_channel, output_channel=output_channel)
     
@@ -306,6 +560,8 @@ class StringLiteral(Filter):
 class Operator(Filter):
     """Abstract base class for operator filters."""
     
+    operations = {} # maps pairs of operand value classes to functions computing the result, see operate
+    
     def __init__(self, *, left=Filter(), right=Filter()):
         self.left_operand = left
         self.right_operand = right
@@ -316,24 +572,90 @@ class Operator(Filter):
     def __str__(self):
         return str(self.left_operand) + self.operator_string + str(self.right_operand)
     
+    def map_function(self):
+        """Operators with an operations table map each value if one operand does and the other one does or is a literal, see Filter.map_function."""
+        if len(self.operations) == 0:
+            return None
+        operand_functions = [operand.map_function() for operand in (self.left_operand, self.right_operand)]
+        if operand_functions == [None, None]:
+            return None
+        for i, operand in enumerate((self.left_operand, self.right_operand)):
+            if operand_functions[i] is None:
+                if operand.__class__ == NumberLiteral:
+                    operand_functions[i] = lambda value, constant=operand.number: constant
+                elif operand.__class__ == StringLiteral:
+                    operand_functions[i] = lambda value, constant=jqsh.values.String(operand.text): constant
+                elif operand.__class__ == Apply and len(operand.attributes) == 2 and all(attribute.__class__ == NumberLiteral for attribute in operand.attributes): # decimal number
+                    operand_functions[i] = lambda value, constant=jqsh.values.Number(str(operand.attributes[0]) + '.' + str(operand.attributes[1])): constant
+                else:
+                    return None
+        left_function, right_function = operand_functions
+        
+        def ret(value):
+            return self.operate(left_function(value), right_function(value))
+        
+        return ret
+    
+    def operate(self, left_output, right_output):
+        """Returns the result of the operator for a pair of operand values. The operation is looked up by the classes of the values in the operations dict of the subclass."""
+        operation = self.operations.get((left_output.__class__, right_output.__class__))
+        if operation is None:
+            return jqsh.values.JQSHException('type')
+        return operation(left_output, right_output)
+    
     def output_pairs(self, input_channel):
-        #TODO don't block until both operands have terminated
+        """Yields pairs of operand values, or the values of one operand if the other has none. The i-th pair is made of the values at i modulo the number of values of each operand, and there are as many pairs as the longer operand has values.
+        
+        The operands are read in lockstep, and each pair is yielded as soon as both of its values are there. Once the shorter operand has ended, only its values are kept, and they are cycled through for the rest of the longer one, so that e.g. a single value is paired with a huge or endless stream in constant memory.
+        """
         left_input, right_input = input_channel / 2
-        left_output = list(self.left_operand.start(left_input))
-        right_output = list(self.right_operand.start(right_input))
-        if len(left_output) == 0 and len(right_output) == 0:
-            return
-        elif len(left_output) == 0:
-            yield from right_output
-        elif len(right_output) == 0:
-            yield from left_output
-        else:
-            for i in range(max(len(left_output), len(right_output))):
-                yield left_output[i % len(left_output)], right_output[i % len(right_output)]
+        left_output = self.left_operand.start(left_input)
+        right_output = self.right_operand.start(right_input)
+        left_values = []
+        right_values = []
+        try:
+            while True:
+                try:
+                    left_value = next(left_output)
+                except StopIteration:
+                    shorter_is_left, shorter_values, longer_output = True, left_values, right_output
+                    break
+                try:
+                    right_value = next(right_output)
+                except StopIteration:
+                    shorter_is_left, shorter_values, longer_output = False, right_values, itertools.chain([left_value], left_output)
+                    break
+                left_values.append(left_value)
+                right_values.append(right_value)
+                yield left_value, right_value
+            left_values = right_values = None # the longer operand's values are not needed any more
+            if len(shorter_values) == 0:
+                yield from longer_output
+                return
+            for i, value in enumerate(longer_output, start=len(shorter_values)):
+                shorter_value = shorter_values[i % len(shorter_values)]
+                yield (shorter_value, value) if shorter_is_left else (value, shorter_value)
+        finally:
+            left_output.abandon()
+            right_output.abandon() # cancels the operands if this generator is closed early
 
 class Pipe(Operator): #TODO add correct namespace handling
     operator_string = ' | '
     
+    def map_function(self):
+        left_function = self.left_operand.map_function()
+        right_function = self.right_operand.map_function()
+        if left_function is None or right_function is None:
+            return None
+        
+        def ret(value):
+            value = left_function(value)
+            if isinstance(value, jqsh.values.JQSHException):
+                return value
+            return right_function(value)
+        
+        return ret
+    
     def run(self, input_channel):
         left_output = self.left_operand.start(input_channel)
         yield from self.right_operand.start(left_output)
@@ -341,25 +663,25 @@ class Pipe(Operator): #TODO add correct namespace handling
 class Add(Operator):
     operator_string = ' + '
     
+    @staticmethod
+    def merge_objects(left_output, right_output): #TODO fix object handling
+        ret = copy.copy(left_output)
+        ret.update(right_output)
+        return ret
+    
+    operations = {
+        (jqsh.values.Number, jqsh.values.Number): lambda left_output, right_output: jqsh.values.Number(left_output + right_output),
+        (jqsh.values.Array, jqsh.values.Array): lambda left_output, right_output: jqsh.values.Array(itertools.chain(left_output, right_output)),
+        (jqsh.values.String, jqsh.values.String): lambda left_output, right_output: jqsh.values.String(left_output.value + right_output.value),
+        (jqsh.values.Object, jqsh.values.Object): lambda left_output, right_output: Add.merge_objects(left_output, right_output)
+    }
+    
     def run(self, input_channel):
         for output in self.output_pairs(input_channel):
             if isinstance(output, tuple):
-                left_output, right_output = output
+                yield self.operate(*output)
             else:
                 yield output
-                continue
-            if isinstance(left_output, jqsh.values.Number) and isinstance(right_output, jqsh.values.Number):
-                yield jqsh.values.Number(left_output + right_output)
-            elif isinstance(left_output, jqsh.values.Array) and isinstance(right_output, jqsh.values.Array):
-                yield jqsh.values.Array(itertools.chain(left_output, right_output))
-            elif isinstance(left_output, jqsh.values.String) and isinstance(right_output, jqsh.values.String):
-                yield jqsh.values.String(left_output.value + right_output.value)
-            elif all(isinstance(output, jqsh.values.Object) for output in (left_output, right_output)): #TODO fix object handling
-                ret = copy.copy(left_output)
-                ret.update(right_output)
-                yield ret
-            else:
-                yield jqsh.values.JQSHException('type')
 
 class Apply(Operator):
     operator_string = '.'
@@ -384,12 +706,103 @@ class Apply(Operator):
         else:
             return str(self.attributes[0]) + '.' + str(self.attributes[1])
     
+    def evaluate(self, input_channel):
+        namespaces = input_channel.namespaces(include_context=True)
+        if all(attribute.__class__ == Filter for attribute in self.attributes): # identity function
+            yield from input_channel
+        elif len(self.attributes) == 2 and all(attribute.__class__ == NumberLiteral for attribute in self.attributes): # decimal number
+            yield jqsh.values.Number(str(self.attributes[0]) + '.' + str(self.attributes[1]))
+            input_exception = input_channel.first_exception()
+            if input_exception is not None:
+                yield input_exception
+        elif self.attributes[0].__class__ == Filter: # subscripting/lookup on input values
+            input_channel, key_input = input_channel / 2
+            try:
+                key = self.attributes[1].start(key_input).take_first()
+            except StopIteration:
+                yield jqsh.values.JQSHException('empty')
+            else:
+                for value in self.lookup(key, input_channel):
+                    yield value
+                    if isinstance(value, jqsh.values.JQSHException):
+                        break
+        elif self.attributes[0].__class__ == Command: # command with arguments
+            input_channel, *string_inputs = input_channel / (len(self.attributes) + 1)
+            try:
+                command_name = [attribute.sensible_string(string_input) for attribute, string_input in zip([self.attributes[0].attribute] + list(self.attributes[1:]), string_inputs)]
+            except (StopIteration, TypeError):
+                yield jqsh.values.JQSHException('sensibleString')
+            else:
+                for string_input in string_inputs:
+                    string_input.abandon() # only the names were read from them, see the builtin branch below
+                yield from Command.run_command(command_name, input_channel)
+        else: # built-in function with arguments
+            input_channel, string_input = input_channel / 2
+            try:
+                function_name = self.attributes[0].sensible_string(input_channel=string_input)
+            except (StopIteration, TypeError):
+                yield jqsh.values.JQSHException('sensibleString')
+                return namespaces
+            finally:
+                string_input.abandon() # a name doesn't read its input, and a split channel that is never read or abandoned buffers the whole input
+            try:
+                builtin = input_channel.context.get_builtin(function_name, *self.attributes[1:])
+            except KeyError:
+                yield jqsh.values.JQSHException('numArgs') if function_name in jqsh.functions.builtin_functions else jqsh.values.JQSHException('name', missing_name=function_name) #TODO fix for context-based builtins
+            else:
+                return (yield from builtin.evaluate(*self.attributes[1:], input_channel=input_channel))
+        return namespaces
+    
+    @staticmethod
+    def lookup(key, input_channel):
+        """Yields the values at the given key of each input value, or an exception instead of the first value that can't be looked up, after which the lookup ends."""
+        for value in input_channel:
+            if isinstance(value, jqsh.values.Object):
+                if key in value:
+                    yield value[key]
+                else:
+                    yield jqsh.values.JQSHException('key')
+                    return
+            elif isinstance(value, jqsh.values.Array):
+                if isinstance(key, jqsh.values.Number):
+                    if key % 1 == 0:
+                        try:
+                            yield value[int(key)]
+                        except IndexError:
+                            yield jqsh.values.JQSHException('index')
+                            return
+                    else:
+                        yield jqsh.values.JQSHException('integer')
+                        return
+                else:
+                    yield jqsh.values.JQSHException('type')
+                    return
+            else:
+                yield jqsh.values.JQSHException('type')
+                return
+    
+    def map_function(self):
+        """The identity and lookups with a literal key map each value, see Filter.map_function."""
+        if all(attribute.__class__ == Filter for attribute in self.attributes):
+            return lambda value: value
+        elif len(self.attributes) == 2 and self.attributes[0].__class__ == Filter and self.attributes[1].__class__ in (NumberLiteral, StringLiteral):
+            if self.attributes[1].__class__ == NumberLiteral:
+                key = self.attributes[1].number
+            else:
+                key = jqsh.values.String(self.attributes[1].text)
+                key.value # read the whole string, so that it can be used as a key any number of times
+            return lambda value: next(self.lookup(key, (value,)))
+        return None
+    
     def run_raw(self, input_channel, output_channel):
         if all(attribute.__class__ == Filter for attribute in self.attributes): # identity function
             output_channel.get_namespaces(input_channel)
             output_channel.pull(input_channel)
         elif len(self.attributes) == 2 and all(attribute.__class__ == NumberLiteral for attribute in self.attributes): # decimal number
             output_channel.push(jqsh.values.Number(str(self.attributes[0]) + '.' + str(self.attributes[1])))
+            input_exception = input_channel.first_exception(output_channel) # see Name.run_raw
+            if input_exception is not None:
+                output_channel.push(input_exception)
             output_channel.terminate()
             output_channel.get_namespaces(input_channel)
             return
@@ -397,48 +810,37 @@ class Apply(Operator):
             #TODO support variadic form (recursive run_raw calls)
             input_channel, key_input = input_channel / 2
             try:
-                key = next(self.attributes[1].start(key_input))
+                key = self.attributes[1].start(key_input).take_first()
             except StopIteration:
                 output_channel.throw('empty')
                 return
-            for value in input_channel:
-                if isinstance(value, jqsh.values.Object):
-                    if key in value:
-                        output_channel.push(value[key])
-                    else:
-                        output_channel.throw('key')
-                        return
-                elif isinstance(value, jqsh.values.Array):
-                    if isinstance(key, jqsh.values.Number):
-                        if key % 1 == 0:
-                            try:
-                                output_channel.push(value[int(key)])
-                            except IndexError:
-                                output_channel.throw('index')
-                                return
-                        else:
-                            output_channel.throw('integer')
-                            return
-                    else:
-                        output_channel.throw('type')
-                        return
-                else:
-                    output_channel.throw('type')
+            for value in self.lookup(key, input_channel):
+                if isinstance(value, jqsh.values.JQSHException):
+                    output_channel.throw(value)
                     return
+                output_channel.push(value)
+                if output_channel.abandoned:
+                    input_channel.abandon()
+                    break
             output_channel.terminate()
             output_channel.get_namespaces(input_channel)
             return
         elif self.attributes[0].__class__ == Command: # command with arguments
+            input_channel, *string_inputs = input_channel / (len(self.attributes) + 1)
             try:
-                input_channel, string_input, *string_inputs = input_channel / (len(self.attributes) + 1)
-                command_name = [self.attributes[0].attribute.sensible_string(string_input)]
-                for attribute, string_input in zip(self.attributes[1:], string_inputs):
-                    command_name.append(attribute.sensible_string(string_input))
+                command_name = [attribute.sensible_string(string_input) for attribute, string_input in zip([self.attributes[0].attribute] + list(self.attributes[1:]), string_inputs)]
             except (StopIteration, TypeError):
                 output_channel.throw('sensibleString')
                 return
-            for value in Command.run_command(command_name, input_channel):
+            finally:
+                for string_input in string_inputs:
+                    string_input.abandon()
+            command_output = Command.run_command(command_name, input_channel)
+            for value in command_output:
                 output_channel.push(value)
+                if output_channel.abandoned:
+                    break
+            command_output.close() # stops the command if the output has been abandoned
             output_channel.get_namespaces(input_channel)
             output_channel.terminate()
         else: # built-in function with arguments
@@ -448,6 +850,8 @@ class Apply(Operator):
             except (StopIteration, TypeError):
                 output_channel.throw('sensibleString')
                 return
+            finally:
+                string_input.abandon()
             try:
                 builtin = input_channel.context.get_builtin(function_name, *self.attributes[1:])
             except KeyError:
@@ -459,6 +863,17 @@ class Apply(Operator):
 class Assign(Operator):
     operator_string = ' = '
     
+    def changes_namespaces(self):
+        return True
+    
+    def evaluate(self, input_channel):
+        input_channel, assignment_input = input_channel / 2
+        try:
+            return (yield from self.left_operand.evaluate_assign(self.right_operand.start(input_channel), input_channel=assignment_input))
+        except NotImplementedError:
+            yield jqsh.values.JQSHException('assignment', target_filter=self.left_operand)
+            return assignment_input.namespaces(include_context=True)
+    
     def run_raw(self, input_channel, output_channel):
         input_channel, assignment_input = input_channel / 2
         try:
@@ -474,43 +889,39 @@ class Comma(Operator):
     def run(self, input_channel):
         left_input, right_input = input_channel / 2
         right_output = self.right_operand.start(right_input)
-        yield from self.left_operand.start(left_input)
-        yield from right_output
+        try:
+            yield from self.left_operand.start(left_input)
+            yield from right_output
+        finally:
+            right_output.abandon() # if this generator is closed while the left operand's output is being read, the right operand is cancelled as well
 
 class Multiply(Operator):
     operator_string = ' * '
     
+    @staticmethod
+    def repeat(sequence, count):
+        """Returns a string or array repeated count times."""
+        if count % 1 != 0:
+            return jqsh.values.JQSHException('integer')
+        elif isinstance(sequence, jqsh.values.String):
+            return jqsh.values.String(sequence.value * int(count))
+        else:
+            return jqsh.values.Array(more_itertools.ncycles(sequence, int(count)))
+    
+    operations = {
+        (jqsh.values.Number, jqsh.values.Number): lambda left_output, right_output: jqsh.values.Number(left_output * right_output),
+        (jqsh.values.String, jqsh.values.Number): lambda left_output, right_output: Multiply.repeat(left_output, right_output),
+        (jqsh.values.Array, jqsh.values.Number): lambda left_output, right_output: Multiply.repeat(left_output, right_output),
+        (jqsh.values.Number, jqsh.values.String): lambda left_output, right_output: Multiply.repeat(right_output, left_output),
+        (jqsh.values.Number, jqsh.values.Array): lambda left_output, right_output: Multiply.repeat(right_output, left_output)
+    }
+    
     def run(self, input_channel):
         for output in self.output_pairs(input_channel):
             if isinstance(output, tuple):
-                left_output, right_output = output
+                yield self.operate(*output)
             else:
                 yield output
-                continue
-            if isinstance(left_output, jqsh.values.Number) and isinstance(right_output, jqsh.values.Number):
-                yield jqsh.values.Number(left_output * right_output)
-            elif isinstance(left_output, jqsh.values.String) and isinstance(right_output, jqsh.values.Number):
-                if right_output % 1 == 0:
-                    yield jqsh.values.String(left_output.value * int(right_output))
-                else:
-                    yield jqsh.values.JQSHException('integer')
-            elif isinstance(left_output, jqsh.values.Array) and isinstance(right_output, jqsh.values.Number):
-                if right_output % 1 == 0:
-                    yield jqsh.values.Array(more_itertools.ncycles(left_output, int(right_output)))
-                else:
-                    yield jqsh.values.JQSHException('integer')
-            elif isinstance(left_output, decimal.Decimal) and isinstance(right_output, jqsh.values.String):
-                if left_output % 1 == 0:
-                    yield jqsh.values.String(right_output.value * int(left_output))
-                else:
-                    yield jqsh.values.JQSHException('integer')
-            elif isinstance(left_output, decimal.Decimal) and isinstance(right_output, jqsh.values.Array):
-                if left_output % 1 == 0:
-                    yield jqsh.values.Array(more_itertools.ncycles(right_output, int(left_output)))
-                else:
-                    yield jqsh.values.JQSHException('integer')
-            else:
-                yield jqsh.values.JQSHException('type')
 
 class Pair(Operator):
     operator_string = ': '
@@ -518,7 +929,7 @@ class Pair(Operator):
     def run(self, input_channel):
         left_input, right_input = input_channel / 2
         try:
-            right_output = next(self.right_operand.start(right_input))
+            right_output = self.right_operand.start(right_input).take_first()
         except StopIteration:
             yield jqsh.values.JQSHException('empty')
             return
@@ -528,15 +939,37 @@ class Pair(Operator):
 class Semicolon(Operator):
     operator_string = '; '
     
+    def changes_namespaces(self):
+        return True
+    
+    def evaluate(self, input_channel):
+        return (yield from Module(self.statements()).evaluate(input_channel)) # a chain of statements is as deep as it is long, so it is evaluated in a loop instead of recursively
+    
     def run_raw(self, input_channel, output_channel):
         left_input, right_input = input_channel / 2
         left_output = self.left_operand.start(left_input)
+        left_output.abandon() # only the namespaces are used
         right_input.get_namespaces(left_output)
         right_output = self.right_operand.start(right_input)
+        handle_namespaces = jqsh.pool.start(output_channel.get_namespaces, right_output) # while pushing the values, in case the reader waits for the namespaces first
         for value in right_output:
             output_channel.push(value)
+            if output_channel.abandoned:
+                right_output.abandon()
+                break
         output_channel.terminate()
-        output_channel.get_namespaces(right_output)
+        handle_namespaces.join()
+    
+    def statements(self):
+        """Yields the statements of a chain of semicolons, as (statement, last) pairs like jqsh.parser.parse_statements."""
+        statements = [self.right_operand]
+        the_filter = self.left_operand
+        while isinstance(the_filter, Semicolon):
+            statements.append(the_filter.right_operand)
+            the_filter = the_filter.left_operand
+        statements.append(the_filter)
+        for i, statement in enumerate(reversed(statements)):
+            yield statement, i == len(statements) - 1
 
 class UnaryOperator(Filter):
     """Abstract base class for unary-only operator filters."""
@@ -555,6 +988,8 @@ class Command(UnaryOperator):
     
     @staticmethod
     def run_command(command_name, input_channel):
+        """Yields the JSON values output by the command for the input values, decoding them as they arrive. With the threaded engine, the input is written on a worker meanwhile. If the generator is closed before the command has finished, the command is killed and the input abandoned."""
+        import jqsh.cli
         import jqsh.parser
         
         try:
@@ -565,15 +1000,39 @@ class Command(UnaryOperator):
         except PermissionError:
             yield jqsh.values.JQSHException('permission')
             return
-        for value in input_channel:
-            popen.stdin.write(str(value).encode('utf-8') + b'\n')
-        popen.stdin.write(b'\x04')
-        with contextlib.suppress(BrokenPipeError):
-            popen.stdin.close()
+        evaluation = jqsh.evaluation.current()
+        if evaluation is not None:
+            evaluation.add_process(popen) # killed if the evaluation is cancelled
+        
+        def write_input():
+            try:
+                for value in input_channel:
+                    popen.stdin.write(str(value).encode('utf-8') + b'\n')
+                popen.stdin.write(b'\x04')
+            except OSError: # the command has exited or been killed
+                input_channel.abandon()
+            with contextlib.suppress(OSError):
+                popen.stdin.close()
+        
+        if isinstance(input_channel, jqsh.channel.LazyChannel): # the generator engine runs everything on one thread
+            write_input()
+            writer = None
+        else:
+            writer = jqsh.pool.start(write_input)
+        finished = False
         try:
-            yield from jqsh.parser.parse_json_values(popen.stdout.read().decode('utf-8')) #TODO don't read everything before starting to decode
+            yield from jqsh.parser.parse_json_values(jqsh.parser.tokenize_chunks(jqsh.cli.read_chunks(popen.stdout, memory_map=False)))
+            finished = True
         except (UnicodeDecodeError, SyntaxError, jqsh.parser.Incomplete):
+            finished = True
             yield jqsh.values.JQSHException('commandOutput')
+        finally:
+            if not finished and popen.poll() is None:
+                popen.kill()
+            popen.stdout.close()
+            popen.wait()
+            if writer is not None:
+                writer.join()
     
     def run(self, input_channel):
         input_channel, attribute_input = input_channel / 2
@@ -582,52 +1041,92 @@ class Command(UnaryOperator):
         except (StopIteration, TypeError):
             yield jqsh.values.JQSHException('sensibleString')
             return
+        finally:
+            attribute_input.abandon()
         yield from self.run_command(command_name, input_channel)
 
 class GlobalVariable(UnaryOperator):
     operator_string = '$'
     
     def assign(self, value_channel, input_channel, output_channel):
-        handle_locals = threading.Thread(target=input_channel.push_attribute, args=('local_namespace', output_channel))
-        handle_format_strings = threading.Thread(target=input_channel.push_attribute, args=('format_strings', output_channel))
-        handle_context = threading.Thread(target=input_channel.push_attribute, args=('context', output_channel))
-        handle_values = threading.Thread(target=output_channel.pull, args=(input_channel,))
-        handle_locals.start()
-        handle_format_strings.start()
-        handle_context.start()
-        handle_values.start()
+        handle_locals = jqsh.pool.start(input_channel.push_attribute, 'local_namespace', output_channel)
+        handle_format_strings = jqsh.pool.start(input_channel.push_attribute, 'format_strings', output_channel)
+        handle_context = jqsh.pool.start(input_channel.push_attribute, 'context', output_channel)
+        handle_values = None
         input_globals = copy.copy(input_channel.global_namespace)
         try:
             variable_name = self.attribute.sensible_string(input_channel)
         except (StopIteration, TypeError):
             output_channel.throw('sensibleString')
+            input_channel.abandon()
         else:
             var = list(value_channel)
             for value in var:
                 if isinstance(value, jqsh.values.JQSHException):
                     output_channel.throw(value)
+                    input_channel.abandon()
                     break
             else:
                 input_globals[variable_name] = var
+                handle_values = jqsh.pool.start(output_channel.pull, input_channel) # only once the assignment has succeeded, since the output is terminated by throw otherwise
         output_channel.global_namespace = input_globals
-        output_channel.terminate()
         handle_locals.join()
         handle_format_strings.join()
         handle_context.join()
-        handle_values.join()
+        if handle_values is not None:
+            handle_values.join()
+    
+    def evaluate(self, input_channel):
+        try:
+            variable_name = self.attribute.sensible_string(input_channel)
+        except (StopIteration, TypeError):
+            yield jqsh.values.JQSHException('sensibleString')
+        else:
+            if variable_name in input_channel.global_namespace:
+                yield from input_channel.global_namespace[variable_name]
+                input_exception = input_channel.first_exception()
+                if input_exception is not None:
+                    yield input_exception
+            else:
+                yield jqsh.values.JQSHException('name', missing_name=variable_name)
+        return input_channel.namespaces(include_context=True)
+    
+    def evaluate_assign(self, value_channel, input_channel):
+        global_namespace, local_namespace, format_strings, context = input_channel.namespaces(include_context=True)
+        global_namespace = copy.copy(global_namespace)
+        input_channel, name_input = input_channel / 2
+        try:
+            variable_name = self.attribute.sensible_string(name_input)
+        except (StopIteration, TypeError):
+            yield jqsh.values.JQSHException('sensibleString')
+        else:
+            name_input.abandon()
+            var = list(value_channel)
+            for value in var:
+                if isinstance(value, jqsh.values.JQSHException):
+                    yield value
+                    break
+            else:
+                global_namespace[variable_name] = var
+                yield from input_channel
+        return global_namespace, local_namespace, format_strings, context
     
     def run_raw(self, input_channel, output_channel):
-        handle_namespaces = threading.Thread(target=input_channel.push_namespaces, args=(output_channel,))
-        handle_namespaces.start()
+        handle_namespaces = jqsh.pool.start(input_channel.push_namespaces, output_channel)
         try:
             variable_name = self.attribute.sensible_string(input_channel)
         except (StopIteration, TypeError):
             output_channel.throw('sensibleString')
+            input_channel.abandon()
         else:
             if variable_name in input_channel.global_namespace:
                 for value in input_channel.global_namespace[variable_name]:
                     output_channel.push(value)
+                input_exception = input_channel.first_exception(output_channel) # the input values are only used for the variable name, see Name.run_raw
+                if input_exception is not None:
+                    output_channel.push(input_exception)
             else:
                 output_channel.throw(jqsh.values.JQSHException('name', missing_name=variable_name))
+                input_channel.abandon()
         output_channel.terminate()
         handle_namespaces.join()
@@ -3,9 +3,9 @@ import decimal
 import functools
 import jqsh.channel
 import jqsh.filter
+import jqsh.pool
 import jqsh.values
 import builtins as python_builtins
-import threading
 
 builtin_functions = collections.defaultdict(dict)
 
@@ -37,25 +37,55 @@ def def_builtin(num_args=0, name=None):
 def wrap_builtin(f):
     @functools.wraps(f)
     def wrapper(*args, input_channel=None, output_channel=None):
+        input_abandoned = [] # did the builtin stop reading its input, like nth does once it has found its value?
+        
         def run_thread(bridge):
-            for value in f(*args, input_channel=bridge):
-                output_channel.push(value)
+            try:
+                output_values = f(*args, input_channel=bridge)
+                for value in output_values:
+                    if isinstance(value, jqsh.channel.Batch):
+                        output_channel.push_many(value)
+                    else:
+                        output_channel.push(value)
+                    if output_channel.abandoned:
+                        break
+                output_values.close() # if the output has been abandoned, this cancels whatever the builtin was reading, see jqsh.channel.Channel.close
+                if bridge.abandoned:
+                    input_abandoned.append(True)
+            finally:
+                bridge.abandon() # the builtin won't read any more input
         
-        bridge_channel = jqsh.channel.Channel()
-        helper_thread = threading.Thread(target=run_thread, kwargs={'bridge': bridge_channel})
-        handle_namespaces = threading.Thread(target=input_channel.push_namespaces, args=(bridge_channel, output_channel))
-        helper_thread.start()
-        handle_namespaces.start()
-        for value in input_channel:
-            if isinstance(value, jqsh.values.JQSHException):
-                output_channel.push(value)
+        bridge_channel = jqsh.channel.Channel(capacity=jqsh.channel.default_capacity)
+        helper_thread = jqsh.pool.start(run_thread, bridge=bridge_channel)
+        handle_namespaces = jqsh.pool.start(input_channel.push_namespaces, bridge_channel, output_channel)
+        input_exception = None
+        for values in input_channel.batches():
+            if bridge_channel.abandoned:
+                helper_thread.join() # whether the builtin abandoned its input is only known once it has returned
+                if len(input_abandoned) or output_channel.abandoned:
+                    input_channel.abandon()
+                    break
+            exception_indices = [index for index, value in enumerate(values) if isinstance(value, jqsh.values.JQSHException)]
+            if len(exception_indices):
+                if not bridge_channel.abandoned:
+                    bridge_channel.push_many(values[:exception_indices[0]])
+                input_exception = values[exception_indices[0]]
+                input_channel.abandon()
                 break
-            else:
-                bridge_channel.push(value)
+            if not bridge_channel.abandoned: # otherwise the rest of the input is only read for its first exception, see jqsh.filter.Filter.run_raw
+                bridge_channel.push_many(values)
         bridge_channel.terminate()
         helper_thread.join()
+        if input_exception is not None and len(input_abandoned) == 0: # after the builtin's output, see jqsh.filter.Filter.run_raw
+            output_channel.push(input_exception)
         handle_namespaces.join()
         output_channel.terminate()
+    
+    def evaluate(*args, input_channel):
+        """The generator engine's counterpart to wrapper, see jqsh.filter.Filter.evaluate."""
+        return input_channel.run_lazily(f, *args, break_on_exception=False, stop_if_abandoned=True)
+    
+    wrapper.evaluate = evaluate
     return wrapper
 
 @def_builtin(0)
@@ -68,7 +98,7 @@ def argv(input_channel):
 @wrap_builtin
 def argv(index, input_channel):
     try:
-        index = next(index.start(input_channel))
+        index = index.start(input_channel).take_first()
     except StopIteration:
         yield jqsh.values.JQSHException('empty')
         return
@@ -87,9 +117,12 @@ def argv(index, input_channel):
 @wrap_builtin
 def each(the_filter, input_channel):
     for value in input_channel:
-        value_input = jqsh.channel.Channel(value, terminated=True, empty_namespaces=False)
-        threading.Thread(target=value_input.get_namespaces, args=(input_channel,)).start()
-        yield from the_filter.start(value_input)
+        body_output = the_filter.start(input_channel.with_values(value))
+        try:
+            for values in body_output.batches():
+                yield jqsh.channel.Batch(values)
+        finally:
+            body_output.abandon() # cancels the body if this generator is closed early
 
 @def_builtin(0)
 @wrap_builtin
@@ -111,6 +144,45 @@ def explode(input_channel):
 def false(input_channel):
     yield jqsh.values.Boolean(False)
 
+@def_builtin(0)
+@wrap_builtin
+def fromStream(input_channel):
+    """Rebuilds values from [path, leaf] and [path] events, as produced by toStream or the --stream option. Only the value currently being rebuilt is kept in memory."""
+    ret = None
+    for event in input_channel:
+        if not isinstance(event, jqsh.values.Array) or len(event) not in (1, 2) or not isinstance(event[0], jqsh.values.Array) or not all(isinstance(key, (jqsh.values.Number, jqsh.values.String)) for key in event[0]):
+            yield jqsh.values.JQSHException('type')
+            return
+        path = [int(key.value) if isinstance(key, jqsh.values.Number) else key.value for key in event[0]]
+        if len(event) == 1:
+            if len(path) == 1: # a top-level array or object has been closed
+                yield jqsh.values.from_native(ret)
+                ret = None
+            continue
+        if len(path) == 0:
+            yield event[1]
+            continue
+        if ret is None:
+            ret = [] if isinstance(path[0], int) else {}
+        container = ret
+        try:
+            for key, next_key in zip(path, path[1:] + [None]):
+                if next_key is None:
+                    value = event[1]
+                elif isinstance(container, list) and key < len(container) or isinstance(container, dict) and key in container:
+                    container = container[key]
+                    continue
+                else:
+                    value = [] if isinstance(next_key, int) else {}
+                if isinstance(container, list) and key == len(container):
+                    container.append(value)
+                else:
+                    container[key] = value
+                container = value
+        except (IndexError, TypeError): # the events don't describe a value
+            yield jqsh.values.JQSHException('type')
+            return
+
 @def_builtin(0)
 @wrap_builtin
 def isMain(input_channel):
@@ -122,60 +194,68 @@ def jqsh_for(initial, body, input_channel):
     input_channel, initial_input = input_channel / 2
     output_channel = initial.start(initial_input)
     for value in input_channel:
-        output_channel = body.start(output_channel)
+        output_channel = body.start(output_channel).buffered()
         output_channel, current_output = output_channel / 2
         yield from current_output
 
 @def_builtin(0)
 @wrap_builtin
 def implode(input_channel):
-    ret = jqsh.values.String(terminated=False)
-    yield ret
+    ret = jqsh.values.String(terminated=False) # only output once it is complete, since the generator engine can't read it while it's being built on the same thread
     for value in input_channel:
         if not isinstance(value, jqsh.values.Number):
-            yield jqsh.values.JQSHException('type')
             ret.terminate()
+            yield ret
+            yield jqsh.values.JQSHException('type')
             return
         if value.value % 1 != 0:
-            yield jqsh.values.JQSHException('integer')
             ret.terminate()
+            yield ret
+            yield jqsh.values.JQSHException('integer')
             return
         try:
-            ret.push(chr(value.value))
+            ret.push(chr(int(value.value)))
         except ValueError:
-            yield jqsh.values.JQSHException('unicode')
             ret.terminate()
+            yield ret
+            yield jqsh.values.JQSHException('unicode')
             return
     ret.terminate()
+    yield ret
 
 @def_builtin(1)
 @wrap_builtin
 def nth(index, input_channel):
     input_channel, index_input = input_channel / 2
     try:
-        index_value = next(index.start(index_input))
-    except StopIteration:
-        yield jqsh.values.JQSHException('empty')
-        return
-    if isinstance(index_value, jqsh.values.Number):
-        if index_value.value % 1 == 0:
-            index_value = int(index_value.value)
+        try:
+            index_value = index.start(index_input).take_first()
+        except StopIteration:
+            yield jqsh.values.JQSHException('empty')
+            return
+        finally:
+            index_input.abandon() # otherwise the split channel buffers every value that is skipped
+        if isinstance(index_value, jqsh.values.Number):
+            if index_value.value % 1 == 0:
+                index_value = int(index_value.value)
+            else:
+                yield jqsh.values.JQSHException('integer')
+                return
         else:
-            yield jqsh.values.JQSHException('integer')
+            yield jqsh.values.JQSHException('type')
             return
-    else:
-        yield jqsh.values.JQSHException('type')
-        return
-    for i in python_builtins.range(index_value):
+        for i in python_builtins.range(index_value):
+            try:
+                next(input_channel)
+            except StopIteration:
+                yield jqsh.values.JQSHException('numValues')
+                return
         try:
-            next(input_channel)
+            yield next(input_channel)
         except StopIteration:
             yield jqsh.values.JQSHException('numValues')
-            return
-    try:
-        yield next(input_channel)
-    except StopIteration:
-        yield jqsh.values.JQSHException('numValues')
+    finally:
+        input_channel.abandon() # the values after the selected one, and an exception among them, are not read, so that the filters producing them are cancelled
 
 @def_builtin(0)
 @wrap_builtin
@@ -188,7 +268,8 @@ def range(input_channel):
     for value in input_channel:
         if isinstance(value, jqsh.values.Number):
             if value.value % 1 == 0:
-                yield from (jqsh.values.Number(number) for number in python_builtins.range(int(value.value)))
+                for start in python_builtins.range(0, int(value.value), jqsh.channel.batch_size):
+                    yield jqsh.channel.Batch(jqsh.values.Number(number) for number in python_builtins.range(start, min(start + jqsh.channel.batch_size, int(value.value))))
             else:
                 yield jqsh.values.JQSHException('integer')
         else:
@@ -200,10 +281,48 @@ def reduce(initial, body, input_channel):
     input_channel, initial_input = input_channel / 2
     output_channel = initial.start(initial_input)
     for value in input_channel:
-        output_channel = body.start(output_channel)
+        output_channel = body.start(output_channel).buffered()
     yield from output_channel
 
+@def_builtin(0)
+@wrap_builtin
+def toStream(input_channel):
+    """Converts each input value into [path, leaf] and [path] events, like the --stream option does for the input."""
+    def events(value, path):
+        if isinstance(value, jqsh.values.Array) and len(value) or isinstance(value, jqsh.values.Object) and len(value):
+            for key, item in (enumerate(value) if isinstance(value, jqsh.values.Array) else value.items()):
+                yield from events(item, path + [key])
+            yield jqsh.values.Array([jqsh.values.Array(path + [key])])
+        else:
+            yield jqsh.values.Array([jqsh.values.Array(path), value])
+    
+    for value in input_channel:
+        yield from events(value, [])
+
 @def_builtin(0)
 @wrap_builtin
 def true(input_channel):
     yield jqsh.values.Boolean(True)
+
+@def_builtin(1)
+@wrap_builtin
+def truncateStream(depth, input_channel):
+    """Removes the first depth path items from [path, leaf] and [path] events, dropping the events with shorter paths, so that fromStream rebuilds the values at that depth one at a time. The depth filter is evaluated without input values."""
+    try:
+        depth_value = depth.start(input_channel.with_values()).take_first()
+    except StopIteration:
+        yield jqsh.values.JQSHException('empty')
+        return
+    if not isinstance(depth_value, jqsh.values.Number):
+        yield jqsh.values.JQSHException('type')
+        return
+    if depth_value.value % 1 != 0:
+        yield jqsh.values.JQSHException('integer')
+        return
+    depth_value = int(depth_value.value)
+    for event in input_channel:
+        if not isinstance(event, jqsh.values.Array) or len(event) not in (1, 2) or not isinstance(event[0], jqsh.values.Array):
+            yield jqsh.values.JQSHException('type')
+            return
+        if len(event[0]) > depth_value:
+            yield jqsh.values.Array([event[0][depth_value:len(event[0])]] + list(event)[1:])
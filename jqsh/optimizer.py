@@ -0,0 +1,144 @@
+import copy
+import functools
+import jqsh.filter
+import jqsh.values
+
+enabled = True # whether jqsh.cli.start_filter optimizes filters before running them
+fuse_pipelines = True # whether operators which map each value are fused into one stage, see fuse
+max_folded_length = 4096 # strings longer than this are not folded into literals, so that e.g. a huge repetition in a branch that never runs doesn't use memory
+
+optimizers = {} # maps filter classes to functions rewriting a filter of that class, see optimizer
+
+def explain(the_filter):
+    """Returns the optimized filter and a list of the rewrites that produced it, as (filter, rewritten filter) pairs in the order they were made. For debugging, e.g. with jqsh --explain.
+
+    The statements of a jqsh.filter.Module are only optimized as they are parsed, so their rewrites are appended to the list while the module runs.
+    """
+    rewrites = []
+    return optimized(the_filter, rewrites), rewrites
+
+def fuse(the_filter):
+    """Returns a jqsh.filter.Fused for an operator which maps each value (see jqsh.filter.Filter.map_function), or the operator itself otherwise. Fused operands are unwrapped, so that a whole pipeline becomes a single Fused stage."""
+    if not fuse_pipelines or the_filter.map_function() is None:
+        return the_filter
+    ret = copy.copy(the_filter)
+    for operand_name in ('left_operand', 'right_operand'):
+        operand = getattr(ret, operand_name)
+        if operand.__class__ == jqsh.filter.Fused:
+            setattr(ret, operand_name, operand.attribute)
+    return jqsh.filter.Fused(ret)
+
+def is_decimal(the_filter):
+    return the_filter.__class__ == jqsh.filter.Apply and len(the_filter.attributes) == 2 and all(attribute.__class__ == jqsh.filter.NumberLiteral for attribute in the_filter.attributes)
+
+def is_identity(the_filter):
+    return the_filter.__class__ == jqsh.filter.Apply and all(attribute.__class__ == jqsh.filter.Filter for attribute in the_filter.attributes)
+
+def is_unwrappable(the_filter):
+    """Returns whether removing a Parens or Pipe around the filter changes neither its output nor its namespaces. This is the case for filters which are evaluated by their run method: like Parens, they don't change namespaces, and their output for the values before an input exception is followed by that exception, see jqsh.filter.Filter.run_raw. Apply is not one of them, since e.g. the identity passes on the values after an exception as well, and a decimal number ignores its input."""
+    return not the_filter.changes_namespaces() and the_filter.__class__.evaluate is jqsh.filter.Filter.evaluate and the_filter.__class__.run_raw is jqsh.filter.Filter.run_raw
+
+def literal(value):
+    """Returns a literal filter which outputs the given value, or None if the value has no literal."""
+    if isinstance(value, jqsh.values.Number):
+        return jqsh.filter.NumberLiteral(value)
+    elif isinstance(value, jqsh.values.String) and len(value.value) <= max_folded_length:
+        return jqsh.filter.StringLiteral(value.value)
+
+def literal_value(the_filter):
+    """Returns the value a literal filter or a decimal number outputs, or None if the filter is neither."""
+    if the_filter.__class__ == jqsh.filter.NumberLiteral:
+        return the_filter.number
+    elif is_decimal(the_filter):
+        return jqsh.values.Number(str(the_filter.attributes[0]) + '.' + str(the_filter.attributes[1]))
+    elif the_filter.__class__ == jqsh.filter.StringLiteral:
+        return jqsh.values.String(the_filter.text)
+
+@functools.lru_cache(maxsize=1024)
+def optimize(the_filter):
+    """Returns an optimized copy of the parse tree, which outputs the same values and namespaces. Constant subtrees are folded into literals, redundant Parens are removed, and so is the identity side of a Pipe. Pipelines and arithmetic which map each value are fused into one stage.
+
+    Like compiled trees (see jqsh.compiler.compile_filter), optimized trees are cached, and the parse tree is not modified.
+    """
+    return optimized(the_filter)
+
+def optimized(the_filter, rewrites=None):
+    """Returns an optimized copy of the parse tree without caching it, see optimize. If a list is given, the rewrites are appended to it, see explain."""
+    if the_filter.__class__ == jqsh.filter.Module:
+        return jqsh.filter.Module((optimized(statement, rewrites), last) for statement, last in the_filter.statements) # optimized as they are parsed
+    if the_filter.__class__ == jqsh.filter.Semicolon: # a chain of statements is as deep as it is long, so it is optimized in a loop instead of recursively
+        return functools.reduce(lambda left, right: jqsh.filter.Semicolon(left=left, right=right), (optimized(statement, rewrites) for statement, last in the_filter.statements()))
+    ret = copy.copy(the_filter)
+    for attribute_name, attribute_value in vars(the_filter).items():
+        setattr(ret, attribute_name, optimized_attribute(attribute_value, rewrites))
+    if ret.__class__ not in optimizers:
+        return ret
+    rewritten = optimizers[ret.__class__](ret) # the children are already optimized, so one rewrite per node is enough
+    if rewritten is not ret and rewrites is not None:
+        rewrites.append((ret, rewritten))
+    return rewritten
+
+def optimized_attribute(value, rewrites=None):
+    """Optimizes the filters in an attribute value of a filter, looking into lists, tuples and dicts like jqsh.cache.child_filters."""
+    if isinstance(value, jqsh.filter.Filter):
+        return optimized(value, rewrites)
+    elif isinstance(value, dict):
+        return {key: optimized_attribute(item, rewrites) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [optimized_attribute(item, rewrites) for item in value]
+    elif isinstance(value, tuple):
+        return tuple(optimized_attribute(item, rewrites) for item in value)
+    else:
+        return value
+
+def optimizer(filter_class):
+    """Registers a function which is called with a copy of a filter of the given class, with optimized child filters, and returns the rewritten filter, or the filter itself to leave it as it is."""
+    def ret(f):
+        optimizers[filter_class] = f
+        return f
+
+    return ret
+
+@optimizer(jqsh.filter.Add)
+def fold_add(the_filter):
+    left_value = literal_value(the_filter.left_operand)
+    right_value = literal_value(the_filter.right_operand)
+    if left_value is None or right_value is None:
+        return fuse(the_filter)
+    return fold_operator(the_filter, left_value, right_value)
+
+@optimizer(jqsh.filter.Multiply)
+def fold_multiply(the_filter):
+    left_value = literal_value(the_filter.left_operand)
+    right_value = literal_value(the_filter.right_operand)
+    if left_value is None or right_value is None:
+        return fuse(the_filter)
+    if isinstance(left_value, jqsh.values.String) or isinstance(right_value, jqsh.values.String):
+        sequence, count = (left_value, right_value) if isinstance(left_value, jqsh.values.String) else (right_value, left_value)
+        if isinstance(count, jqsh.values.Number) and len(sequence.value) * count > max_folded_length:
+            return the_filter
+    return fold_operator(the_filter, left_value, right_value)
+
+def fold_operator(the_filter, left_value, right_value):
+    """Returns a literal for the result of an operator with constant operands, or the operator itself if the result is an exception or has no literal, so that it is reported when the filter runs."""
+    try:
+        ret = literal(the_filter.operate(left_value, right_value))
+    except Exception:
+        return the_filter
+    return the_filter if ret is None else ret
+
+@optimizer(jqsh.filter.Parens)
+def remove_parens(the_filter):
+    if is_unwrappable(the_filter.attribute):
+        return the_filter.attribute
+    return the_filter
+
+@optimizer(jqsh.filter.Pipe)
+def rewrite_pipe(the_filter):
+    if is_identity(the_filter.left_operand) and is_unwrappable(the_filter.right_operand):
+        return the_filter.right_operand
+    elif is_identity(the_filter.right_operand) and is_unwrappable(the_filter.left_operand):
+        return the_filter.left_operand
+    elif fuse_pipelines and the_filter.right_operand.__class__ == jqsh.filter.Pipe and the_filter.left_operand.map_function() is not None and the_filter.right_operand.left_operand.map_function() is not None: # pipes are parsed right to left, so the mapping stages at the start of a pipeline are regrouped to fuse them
+        return jqsh.filter.Pipe(left=fuse(jqsh.filter.Pipe(left=the_filter.left_operand, right=the_filter.right_operand.left_operand)), right=the_filter.right_operand.right_operand)
+    return fuse(the_filter)
@@ -1,14 +1,196 @@
+import collections
 import decimal
 import enum
 import jqsh.context
 import jqsh.filter
+import itertools
 import jqsh.values
+import json
+import re
 import string
 import unicodedata
 
+class ChunkTokenizer:
+    """A resumable tokenizer for jqsh code (or JSON) arriving in text chunks, for readers that can't be iterated, like the output of a command run by jqsh.asynchronous.
+    
+    A token is returned as soon as a later chunk proves it complete, so the input is only tokenized once except for the tokens at chunk boundaries. A string literal spanning many chunks is not tokenized again for each of them: while the rest of the input is an unterminated string, each chunk is only checked for the end of the string, and the string is tokenized once that has arrived.
+    """
+    def __init__(self):
+        self.rest_string = ''
+        self.line = 1
+        self.column = 0
+        self.open_string = None # the chunks of an unterminated string literal which is the rest of the input, see feed
+        self.open_string_tail = '' # an escape sequence at the end of the open string, which the next chunk may complete
+    
+    def close(self):
+        """Returns the tokens of the rest of the input, once all chunks have been fed."""
+        if self.open_string is not None:
+            self.rest_string = ''.join(self.open_string) + self.open_string_tail
+            self.open_string = None
+        ret = list(tokenize(self.rest_string, line=self.line, column=self.column))
+        self.rest_string = ''
+        return ret
+    
+    def feed(self, chunk):
+        """Returns the list of tokens which are complete after adding the chunk to the input."""
+        if self.open_string is None:
+            self.rest_string += chunk
+        else:
+            chunk = self.open_string_tail + chunk
+            match = string_continuation_pattern.match(chunk)
+            tail = chunk[match.end():]
+            if len(tail) == 0 or incomplete_escape_pattern.fullmatch(tail):
+                self.open_string.append(chunk[:match.end()])
+                self.open_string_tail = tail
+                return []
+            self.rest_string = ''.join(self.open_string) + chunk # the string ends, or continues with something other than characters and escapes, like an interpolation
+            self.open_string = None
+        tokens = list(tokenize(self.rest_string, line=self.line, column=self.column))
+        num_complete = 0
+        interpolation_depth = 0
+        for i, token in enumerate(tokens[:-1]): # the last token may continue in the next chunk
+            if token.type in (TokenType.illegal, TokenType.string_end_incomplete, TokenType.string_incomplete): # these can become legal or complete with more input
+                break
+            elif token.type is TokenType.string_start:
+                interpolation_depth += 1
+            elif token.type is TokenType.string_end:
+                interpolation_depth -= 1
+            if interpolation_depth == 0: # only split the input outside of string interpolations, where the tokenizer has no state
+                num_complete = i + 1
+        consumed = ''.join(token.string for token in tokens[:num_complete])
+        self.rest_string = self.rest_string[len(consumed):]
+        if self.line == 1 and self.column == 0 and consumed.startswith('\ufeff'):
+            consumed = consumed[1:] # the byte order mark doesn't count towards the column
+        newlines = consumed.count('\n')
+        if newlines:
+            self.line += newlines
+            self.column = len(consumed) - consumed.rindex('\n') - 1
+        else:
+            self.column += len(consumed)
+        rest_tokens = tokens[num_complete:]
+        if len(rest_tokens) and rest_tokens[0].type is TokenType.string_incomplete:
+            string_length = len(rest_tokens[0].string)
+            tail = self.rest_string[string_length:]
+            if len(rest_tokens) == 1 or len(rest_tokens) == 2 and incomplete_escape_pattern.fullmatch(tail):
+                self.open_string = [self.rest_string[:string_length]]
+                self.open_string_tail = tail
+                self.rest_string = ''
+        return tokens[:num_complete]
+
 class Incomplete(Exception):
     pass
 
+JSONDecoderState = enum.Enum('JSONDecoderState', [
+    'after_value', # in an array or object, expecting a comma or the closing bracket
+    'array_start', # expecting an array item or a closing bracket
+    'colon',
+    'key', # expecting an object key after a comma
+    'object_start', # expecting an object key or a closing brace
+    'value'
+], module=__name__)
+
+class JSONDecoder:
+    """A resumable decoder for concatenated JSON values.
+    
+    Tokens can be passed to decode in any number of batches, each token is looked at exactly once. Top-level values are yielded as soon as their last token has been decoded, so the decoder never needs to see the entire input at once.
+    """
+    def __init__(self, allow_extension_types=False):
+        self.allow_extension_types = allow_extension_types
+        self.containers = [] # the arrays and objects which are currently open, innermost last
+        self.key = None # the key of the next object member
+        self.state = JSONDecoderState.value
+        self.token_index = 0 # the number of tokens decoded so far, used in error messages
+    
+    def add_value(self, value):
+        """Adds a value to the innermost open container. Returns True if the value was added, False if it's a top-level value."""
+        if len(self.containers) == 0:
+            return False
+        elif isinstance(self.containers[-1], jqsh.values.Object):
+            self.containers[-1].push((self.key, value))
+        else:
+            self.containers[-1].push(value)
+        return True
+    
+    def close(self):
+        """Raises Incomplete if the input decoded so far ends in the middle of a value."""
+        if len(self.containers):
+            raise Incomplete('Unclosed JSON ' + ('object' if isinstance(self.containers[-1], jqsh.values.Object) else 'array') + ' at position ' + str(self.token_index))
+    
+    def decode(self, tokens):
+        """Decodes the given tokens, yielding each top-level value that is completed by them."""
+        for token in tokens:
+            position = self.token_index
+            self.token_index += 1
+            if self.allow_extension_types and isinstance(token, jqsh.values.Value):
+                if self.state not in (JSONDecoderState.value, JSONDecoderState.array_start):
+                    raise SyntaxError('Unexpected ' + token.__class__.__name__ + ' value at position ' + repr(position))
+                if self.add_value(token):
+                    self.state = JSONDecoderState.after_value
+                else:
+                    yield token
+                continue
+            if token.type is TokenType.trailing_whitespace:
+                continue
+            if self.state is JSONDecoderState.after_value:
+                if token.type is TokenType.comma:
+                    self.state = JSONDecoderState.key if isinstance(self.containers[-1], jqsh.values.Object) else JSONDecoderState.value
+                    continue
+                closing_token_type = TokenType.close_object if isinstance(self.containers[-1], jqsh.values.Object) else TokenType.close_array
+                if token.type is not closing_token_type:
+                    raise illegal_token_exception(token, position=position, expected={closing_token_type, TokenType.comma})
+            elif self.state is JSONDecoderState.array_start:
+                if token.type is not TokenType.close_array:
+                    self.state = JSONDecoderState.value
+            elif self.state is JSONDecoderState.colon:
+                if token.type is not TokenType.colon:
+                    raise illegal_token_exception(token, position=position, expected={TokenType.colon})
+                self.state = JSONDecoderState.value
+                continue
+            elif self.state is JSONDecoderState.key or self.state is JSONDecoderState.object_start:
+                if token.type is TokenType.string:
+                    self.key = token.text
+                    self.state = JSONDecoderState.colon
+                    continue
+                elif self.state is JSONDecoderState.key or token.type is not TokenType.close_object:
+                    raise illegal_token_exception(token, position=position, expected={TokenType.string} if self.state is JSONDecoderState.key else {TokenType.close_object, TokenType.string})
+            if self.state is not JSONDecoderState.value: # the token closes the innermost container
+                value = self.containers.pop()
+                value.terminate()
+            elif token.type is TokenType.name:
+                if token.text == 'false':
+                    value = jqsh.values.Boolean(False)
+                elif token.text == 'null':
+                    value = jqsh.values.Null()
+                elif token.text == 'true':
+                    value = jqsh.values.Boolean(True)
+                else:
+                    raise SyntaxError('Illegal name token ' + repr(token.text) + ' at position ' + repr(position) + ' (expected false, null, or true)')
+            elif token.type is TokenType.number:
+                value = jqsh.values.Number(token.text)
+            elif token.type is TokenType.open_array:
+                array = jqsh.values.Array(terminated=False)
+                self.add_value(array)
+                self.containers.append(array)
+                self.state = JSONDecoderState.array_start
+                continue
+            elif token.type is TokenType.open_object:
+                obj = jqsh.values.Object(terminated=False)
+                self.add_value(obj)
+                self.containers.append(obj)
+                self.state = JSONDecoderState.object_start
+                continue
+            elif token.type is TokenType.string:
+                value = jqsh.values.String(token.text)
+            else:
+                raise illegal_token_exception(token, position=position, expected={TokenType.name, TokenType.number, TokenType.open_array, TokenType.open_object, TokenType.string, TokenType.trailing_whitespace})
+            if len(self.containers) == 0: # a top-level value has been completed
+                self.state = JSONDecoderState.value
+                yield value
+            else:
+                if self.state is JSONDecoderState.value: # closed containers have already been added when they were opened
+                    self.add_value(value)
+                self.state = JSONDecoderState.after_value
+
 TokenType = enum.Enum('TokenType', [
     'assign',
     'close_array',
@@ -141,12 +323,20 @@ operators = [
     }
 ]
 
+operator_levels = { # a dictionary that maps operator token types to their index in the operators list
+    token_type: level
+    for level, precedence_group in enumerate(operators) if isinstance(precedence_group, dict)
+    for token_type in precedence_group if isinstance(token_type, TokenType)
+}
+
 paren_filters = {
     TokenType.open_array: jqsh.filter.Array,
     TokenType.open_object: jqsh.filter.Object,
     TokenType.open_paren: jqsh.filter.Parens
 }
 
+variadic_apply_level = operators.index('variadic apply')
+
 symbols = {
     '!': TokenType.command,
     '$': TokenType.global_variable,
@@ -169,6 +359,40 @@ symbols = {
     '}': TokenType.close_object
 }
 
+comment_pattern = re.compile('#[^\\n]*')
+incomplete_escape_pattern = re.compile('\\\\(?:u[0-9A-Fa-f]{0,3})?') # the start of a string literal escape sequence other than \(, see ChunkTokenizer
+name_characters = frozenset(string.ascii_letters)
+name_pattern = re.compile('[' + re.escape(string.ascii_letters) + ']+')
+number_characters = frozenset(string.digits)
+number_pattern = re.compile('[' + re.escape(string.digits) + ']+')
+string_characters_pattern = re.compile('[^"\\\\]+') # a run of string literal characters that need no special handling
+scalar_token_pattern = re.compile('([' + re.escape(string.whitespace) + ']*)(?:"(?P<string>[^"\\\\\\n]*)"|(?P<name>[' + re.escape(string.ascii_letters) + ']+)|(?P<number>[' + re.escape(string.digits) + ']+)|(?P<symbol>[' + re.escape(''.join(symbol for symbol in symbols if symbol not in '()')) + ']))') # whitespace and the following token, for the tokens which need no special handling, see tokenize
+string_continuation_pattern = re.compile('(?:[^"\\\\]+|\\\\[' + re.escape(''.join(escapes)) + ']|\\\\u[0-9A-Fa-f]{4})*') # string literal characters and escape sequences other than \(, which don't end the string
+symbol_pattern = re.compile('|'.join(re.escape(symbol) for symbol in sorted(symbols, key=lambda symbol: -len(symbol))))
+plain_json_decoder = json.JSONDecoder(parse_constant=lambda name: reject_json_constant(name), parse_float=decimal.Decimal, parse_int=decimal.Decimal)
+plain_json_number_continuation_pattern = re.compile('[-+.0-9Ee]*\\Z') # matches if all remaining input could still be part of the preceding number
+plain_json_whitespace_pattern = re.compile('[ \\t\\n\\r]*')
+unicode_escape_pattern = re.compile('u([0-9A-Fa-f]{4})')
+whitespace_characters = frozenset(string.whitespace)
+whitespace_pattern = re.compile('[' + re.escape(string.whitespace) + ']+')
+
+def decode_json_records(records):
+    """Decodes a batch of JSON records using the json module. Returns a list with the decoded Python object for each record, or the exception if the record is not a single plain JSON value.
+    
+    Only picklable objects are used, so that batches can be decoded by a process pool.
+    """
+    ret = []
+    for record in records:
+        try:
+            value, end = plain_json_decoder.raw_decode(record, plain_json_whitespace_pattern.match(record).end())
+            if plain_json_whitespace_pattern.match(record, end).end() != len(record):
+                raise json.JSONDecodeError('Extra data', record, end)
+        except ValueError as e: # includes json.JSONDecodeError
+            ret.append(e)
+        else:
+            ret.append(value)
+    return ret
+
 def illegal_token_exception(token, position=None, expected=None, line_numbers=False):
     if token.type is TokenType.illegal and token.text:
         return SyntaxError('illegal character' + ((' in line ' + str(token.line) if line_numbers and token.line is not None else '') if position is None else ' at position ' + repr(position)) + ': ' + repr(token.text[0]) + ' (U+' + format(ord(token.text[0]), 'x').upper() + ' ' + unicodedata.name(token.text[0], 'unknown character') + ')')
@@ -176,6 +400,10 @@ def illegal_token_exception(token, position=None, expected=None, line_numbers=Fa
         return SyntaxError('illegal ' + ('' if token.type is TokenType.illegal else token.type.name + ' ') + 'token' + ((' in line ' + str(token.line) if line_numbers and token.line is not None else '') if position is None else ' at position ' + repr(position)) + ('' if expected is None else ' (expected ' + ' or '.join(sorted(expected_token_type.name for expected_token_type in expected)) + ')'))
 
 def parse(tokens, *, line_numbers=False, allowed_filters={'default': True}, context=jqsh.context.FilterContext()):
+    """Parses jqsh code (a string or a list of tokens) into a filter.
+    
+    This is an operator precedence parser which looks at each token once. Its precedence levels are the entries of the operators list. Operators are combined on an explicit stack, so only nested parens recurse.
+    """
     def filter_is_allowed(the_filter):
         if isinstance(allowed_filters, dict):
             if the_filter.__class__ in allowed_filters:
@@ -193,9 +421,127 @@ def parse(tokens, *, line_numbers=False, allowed_filters={'default': True}, cont
         else:
             return False
     
-    def make_keyword_paren_filter(attributes):
-        attributes = list(attributes)
-        return keyword_paren_filters[attributes[0][0]]((attribute_name, parse(attribute_tokens, line_numbers=line_numbers, allowed_filters=allowed_filters, context=context)) for attribute_name, attribute_tokens in attributes)
+    def next_token():
+        """Returns the next token, or None at the end of the token list."""
+        if position < len(tokens):
+            return tokens[position]
+    
+    def parse_keyword_paren(keywords):
+        """Parses a keyword paren like if ... then ... end, starting at the opening keyword."""
+        nonlocal position
+        start_token = tokens[position]
+        position += 1
+        attribute_name = start_token.text
+        attributes = []
+        while True:
+            attributes.append((attribute_name, parse_sequence(keyword_parens[start_token.text])))
+            token = next_token()
+            if token is None:
+                raise Incomplete('too many opening parens of type ' + repr(start_token.text))
+            elif isinstance(token, Token) and token.type is TokenType.name and (token.text == 'end' or token.text in keyword_parens[start_token.text]):
+                position += 1
+                if token.text == 'end':
+                    return raise_for_filter(keyword_paren_filters[start_token.text](attributes))
+                attribute_name = token.text
+            else:
+                raise unexpected_token_exception(token, opening_token=start_token)
+    
+    def parse_primary(keywords):
+        """Parses an atomic filter or a paren, or returns None if the next token can't start a filter."""
+        nonlocal position
+        token = next_token()
+        if isinstance(token, jqsh.filter.Filter):
+            position += 1
+            return token
+        elif token is None:
+            return None
+        elif token.type in atomic_tokens:
+            if token.type is TokenType.name:
+                if token.text == 'end' or token.text in keywords:
+                    return None
+                elif token.text in keyword_parens:
+                    return parse_keyword_paren(keywords)
+            position += 1
+            return raise_for_filter(atomic_tokens[token.type](token.text))
+        elif token.type in matching_parens:
+            position += 1
+            attribute = parse_sequence(set())
+            closing_token = next_token()
+            if closing_token is None:
+                raise Incomplete('too many opening parens of type ' + repr(token.type))
+            elif not isinstance(closing_token, Token) or closing_token.type is not matching_parens[token.type]:
+                raise unexpected_token_exception(closing_token, opening_token=token)
+            position += 1
+            return raise_for_filter(paren_filters[token.type](attribute=attribute))
+        else:
+            return None
+    
+    def parse_sequence(keywords):
+        """Parses tokens up to the end of the token list, a closing paren, or one of the given keywords. Returns the empty filter if there are no such tokens.
+        
+        A missing operand of a binary operator is the empty filter, and adjacent operands are collected into a single variadic apply.
+        """
+        nonlocal position
+        operands = [] # None stands for a missing operand
+        pending = [] # operators waiting for their last operand, as [level, token, number of operands] lists
+        
+        def reduce(level=len(operators), rtl=False):
+            """Combines the pending operators which bind more tightly than an operator at the given level."""
+            while len(pending) and (pending[-1][0] < level or pending[-1][0] == level and not rtl):
+                operator_level, token, num_operands = pending.pop()
+                precedence_group = operators[operator_level]
+                attributes = operands[-num_operands:]
+                del operands[-num_operands:]
+                if precedence_group == 'variadic apply':
+                    operands.append(raise_for_filter(jqsh.filter.Apply(*attributes)))
+                elif not precedence_group.get('binary', True):
+                    operands.append(raise_for_filter(precedence_group[token.type](attribute=attributes[0])))
+                else:
+                    left, right = (raise_for_filter(jqsh.filter.Filter()) if operand is None else operand for operand in attributes)
+                    operands.append(raise_for_filter(precedence_group[token.type](left=left, right=right)))
+        
+        expect_operand = True
+        while True:
+            token = next_token()
+            level = operator_levels.get(token.type) if isinstance(token, Token) else None
+            if expect_operand:
+                if level is not None and not operators[level].get('binary', True):
+                    pending.append([level, token, 1])
+                    position += 1
+                    continue
+                operand = parse_primary(keywords)
+                if operand is None and len(pending) and not operators[pending[-1][0]].get('binary', True):
+                    if position == len(tokens):
+                        raise SyntaxError('expected a filter after ' + repr(pending[-1][1]) + ', nothing found')
+                    else:
+                        raise SyntaxError('expected a filter after ' + repr(pending[-1][1]) + ', found ' + repr(tokens[position]) + ' instead')
+                operands.append(operand)
+                expect_operand = False
+            elif level is not None and operators[level].get('binary', True):
+                reduce(level, rtl=operators[level].get('rtl', False))
+                pending.append([level, token, 2])
+                position += 1
+                expect_operand = True
+            elif operands[-1] is not None:
+                if level is None:
+                    operand = parse_primary(keywords)
+                    if operand is None:
+                        break
+                reduce(variadic_apply_level, rtl=True)
+                if len(pending) and pending[-1][0] == variadic_apply_level:
+                    pending[-1][2] += 1
+                else:
+                    pending.append([variadic_apply_level, None, 2])
+                if level is None:
+                    operands.append(operand)
+                else:
+                    expect_operand = True # a prefix operator starts the next operand
+            else:
+                break
+        reduce()
+        if operands[0] is None:
+            return raise_for_filter(jqsh.filter.Filter())
+        return operands[0]
     
     def raise_for_filter(the_filter):
         if filter_is_allowed(the_filter):
@@ -203,405 +549,438 @@ def parse(tokens, *, line_numbers=False, allowed_filters={'default': True}, cont
         else:
             raise jqsh.filter.NotAllowed('disallowed filter: ' + str(the_filter))
     
+    def unexpected_token_exception(token, opening_token=None):
+        if isinstance(token, Token) and (token.type in matching_parens.values() or token.type is TokenType.name and token.text == 'end'):
+            if opening_token is None:
+                return SyntaxError('mismatched parens')
+            else:
+                return SyntaxError('opening paren of type ' + repr(opening_token.text if opening_token.type is TokenType.name else opening_token.type) + ' does not match closing paren of type ' + repr(token.text if token.type is TokenType.name else token.type))
+        elif isinstance(token, Token):
+            return illegal_token_exception(token, line_numbers=line_numbers)
+        else:
+            return SyntaxError('Could not parse token list: unexpected ' + repr(token))
+    
     if isinstance(tokens, str):
-        tokens = list(tokenize(tokens))
+        tokens = tokenize(tokens)
     tokens = [token for token in tokens if isinstance(token, jqsh.filter.Filter) or token.type is not TokenType.comment]
     if not len(tokens):
         return raise_for_filter(jqsh.filter.Filter()) # token list is empty, return an empty filter
     for token in tokens:
-        if token.type is TokenType.illegal:
+        if isinstance(token, Token) and token.type is TokenType.illegal:
             raise illegal_token_exception(token, line_numbers=line_numbers)
     if isinstance(tokens[-1], Token) and tokens[-1].type is TokenType.trailing_whitespace:
         if len(tokens) == 1:
             return raise_for_filter(jqsh.filter.Filter()) # token list consists entirely of whitespace, return an empty filter
         else:
-            tokens[-2].string += tokens[-1].string # merge the trailing whitespace into the second-to-last token
+            if isinstance(tokens[-2], Token):
+                tokens[-2].string += tokens[-1].string # merge the trailing whitespace into the second-to-last token
             tokens.pop() # remove the trailing_whitespace token
-    
-    # parenthesis-like filters
-    paren_balance = 0
-    paren_start = None
-    middle_keywords = []
-    for i, token in reversed(list(enumerate(tokens))): # iterating over the token list in reverse because we modify it in the process
+    closing_tokens = []
+    for token in reversed(tokens): # an opening paren without a closing paren after it means more input is needed, even if the tokens inside are invalid
         if not isinstance(token, Token):
             continue
-        elif token.type in matching_parens.values() or token == Token(TokenType.name, text='end'):
-            if paren_balance == 0:
-                paren_start = i
-                if token == Token(TokenType.name, text='end'):
-                    middle_keywords = []
-            paren_balance += 1
-        elif token.type in matching_parens.keys() or token.type is TokenType.name and token.text in keyword_parens.keys():
-            paren_balance -= 1
-            if paren_balance < 0:
+        elif token.type in matching_parens.values() or token.type is TokenType.name and token.text == 'end':
+            closing_tokens.append(token)
+        elif token.type in matching_parens or token.type is TokenType.name and token.text in keyword_parens:
+            if len(closing_tokens) == 0:
                 raise Incomplete('too many opening parens of type ' + repr(token.text if token.type is TokenType.name else token.type))
-            elif paren_balance == 0:
-                if token.type is TokenType.name:
-                    middle_keywords = [index for index in middle_keywords if tokens[index].text in keyword_parens[token.text]]
-                    attributes = []
-                    last_index = paren_start
-                    for index in middle_keywords:
-                        attributes.append((tokens[index].text, tokens[index + 1:last_index]))
-                        last_index = index
-                    attributes.append((token.text, tokens[i + 1:last_index]))
-                    tokens[i:paren_start + 1] = [raise_for_filter(make_keyword_paren_filter(reversed(attributes)))]
-                else:
-                    if matching_parens[token.type] is tokens[paren_start].type:
-                        tokens[i:paren_start + 1] = [raise_for_filter(paren_filters[token.type](attribute=parse(tokens[i + 1:paren_start], line_numbers=line_numbers, allowed_filters=allowed_filters)))] # parse the inside of the parens
-                    else:
-                        raise SyntaxError('opening paren of type ' + repr(token.type) + ' does not match closing paren of type ' + repr(tokens[paren_start].type))
-                paren_start = None
-        elif paren_balance == 1 and token.type is TokenType.name:
-            middle_keywords.append(i)
-    if paren_balance != 0:
-        raise SyntaxError('mismatched parens')
+            closing_token = closing_tokens.pop()
+            if token.type in matching_parens and closing_token.type is not matching_parens[token.type]:
+                raise unexpected_token_exception(closing_token, opening_token=token)
+    position = 0
+    ret = parse_sequence(set())
+    if position < len(tokens):
+        raise unexpected_token_exception(tokens[position])
+    return ret
+
+def parse_json(tokens, allow_extension_types=False):
+    if isinstance(tokens, str):
+        tokens = tokenize(tokens)
+    decoder = JSONDecoder(allow_extension_types=allow_extension_types)
+    ret = None
+    for value in decoder.decode(tokens):
+        if ret is not None:
+            raise SyntaxError('Multiple top-level JSON values found')
+        ret = value
+    decoder.close()
+    if ret is None:
+        raise Incomplete('JSON is empty')
+    return ret
+
+def parse_json_chunks(chunks, fast=True):
+    """Decodes concatenated JSON values from an iterable of text chunks, yielding each value as soon as the chunk which completes it has been read.
     
-    # atomic filters
-    for i, token in reversed(list(enumerate(tokens))):
-        if isinstance(token, Token) and token.type in atomic_tokens:
-            tokens[i] = raise_for_filter(atomic_tokens[token.type](token.text))
+    If fast is true, the input is decoded using the json module's C scanner for as long as it is plain JSON, falling back to the jqsh tokenizer for the rest of the input otherwise.
+    """
+    chunks = iter(chunks)
+    if fast:
+        rest_string = yield from parse_plain_json_chunks(chunks)
+        chunks = itertools.chain([rest_string], chunks)
+    decoder = JSONDecoder()
+    yield from decoder.decode(tokenize_chunks(chunks))
+    decoder.close()
+
+def parse_json_events(tokens):
+    """Decodes concatenated JSON values into a stream of events like jq's --stream option, using memory proportional to the nesting depth instead of the size of the values.
     
-    # operators
-    for precedence_group in operators:
-        if precedence_group == 'variadic apply':
-            start = None
-            for i, token in reversed(list(enumerate(tokens))):
-                if isinstance(token, jqsh.filter.Filter):
-                    if start is None:
-                        start = i
+    Each scalar and each empty array or object yields a [path, leaf] event. Each nonempty array or object yields a [path] event with the path of its last item when it is closed, so a top-level value is complete at an event whose path has length 1 or at a [[], leaf] event.
+    """
+    def event(*items):
+        return jqsh.values.Array.lazily((jqsh.values.Array.lazily(path[:]),) + items) # the path keys are only converted when the event is read
+    
+    if isinstance(tokens, str):
+        tokens = tokenize(tokens)
+    containers = [] # the types of the containers which are currently open, innermost last
+    path = [] # the index or key of the current item in each open container, None for an object before its first key
+    state = JSONDecoderState.value
+    for position, token in enumerate(tokens):
+        if token.type is TokenType.trailing_whitespace:
+            continue
+        if state is JSONDecoderState.after_value:
+            if token.type is TokenType.comma:
+                if containers[-1] is TokenType.open_array:
+                    path[-1] += 1
+                    state = JSONDecoderState.value
                 else:
-                    if start is not None and start > i + 1:
-                        tokens[i + 1:start + 1] = [raise_for_filter(jqsh.filter.Apply(*tokens[i + 1:start + 1]))]
-                    start = None
-            if start is not None and start > 0:
-                tokens[:start + 1] = [raise_for_filter(jqsh.filter.Apply(*tokens[:start + 1]))]
+                    state = JSONDecoderState.key
+                continue
+            closing_token_type = matching_parens[containers[-1]]
+            if token.type is not closing_token_type:
+                raise illegal_token_exception(token, position=position, expected={closing_token_type, TokenType.comma})
+            yield event()
+            containers.pop()
+            path.pop()
+        elif state is JSONDecoderState.colon:
+            if token.type is not TokenType.colon:
+                raise illegal_token_exception(token, position=position, expected={TokenType.colon})
+            state = JSONDecoderState.value
+            continue
+        elif state is JSONDecoderState.key or state is JSONDecoderState.object_start and token.type is not TokenType.close_object:
+            if token.type is not TokenType.string:
+                raise illegal_token_exception(token, position=position, expected={TokenType.string} if state is JSONDecoderState.key else {TokenType.close_object, TokenType.string})
+            path[-1] = token.text
+            state = JSONDecoderState.colon
             continue
-        if not precedence_group.get('binary', True):
-            for i, token in reversed(list(enumerate(tokens))):
-                if isinstance(token, Token) and token.type in precedence_group:
-                    if len(tokens) == i + 1:
-                        raise SyntaxError('expected a filter after ' + repr(token) + ', nothing found')
-                    elif isinstance(tokens[i + 1], Token):
-                        raise SyntaxError('expected a filter after ' + repr(token) + ', found ' + repr(tokens[i + 1]) + ' instead')
-                    tokens[i:i + 2] = [raise_for_filter(precedence_group[token.type](attribute=tokens[i + 1]))]
+        elif state is JSONDecoderState.array_start and token.type is TokenType.close_array or state is JSONDecoderState.object_start: # an empty container is a leaf
+            containers.pop()
+            path.pop()
+            yield event(jqsh.values.Array() if token.type is TokenType.close_array else jqsh.values.Object())
+        elif token.type in (TokenType.open_array, TokenType.open_object):
+            containers.append(token.type)
+            path.append(0 if token.type is TokenType.open_array else None)
+            state = JSONDecoderState.array_start if token.type is TokenType.open_array else JSONDecoderState.object_start
             continue
-        ltr = not precedence_group.get('rtl', False)
-        if ltr:
-            tokens.reverse()
-        left_operand = None
-        right_operand = None
-        has_previous_operand = False
-        has_next_operand = False
-        for i, token in reversed(list(enumerate(tokens))):
-            if isinstance(token, jqsh.filter.Filter) and has_next_operand:
-                tokens[i:i + (3 if has_previous_operand else 2)] = [precedence_group[tokens[i + 1].type](left=left_operand, right=right_operand)]
-                has_next_operand = False
-            elif isinstance(token, Token) and token.type in precedence_group:
-                left_operand, has_left_operand = (tokens[i - 1], True) if i > 0 and isinstance(tokens[i - 1], jqsh.filter.Filter) else (raise_for_filter(jqsh.filter.Filter()), False)
-                right_operand, has_right_operand = (tokens[i + 1], True) if i + 1 < len(tokens) and isinstance(tokens[i + 1], jqsh.filter.Filter) else (raise_for_filter(jqsh.filter.Filter()), False)
-                has_previous_operand = has_right_operand
-                has_next_operand = has_left_operand
-                if ltr:
-                    left_operand, right_operand = right_operand, left_operand
-                    has_left_operand, has_right_operand = has_right_operand, has_left_operand
-                if not has_next_operand:
-                    tokens[i:i + (2 if has_previous_operand else 1)] = [precedence_group[token.type](left=left_operand, right=right_operand)]
+        elif token.type is TokenType.name and token.text in ('false', 'null', 'true'):
+            yield event(jqsh.values.Null() if token.text == 'null' else jqsh.values.Boolean(token.text == 'true'))
+        elif token.type is TokenType.number:
+            yield event(jqsh.values.Number(token.text))
+        elif token.type is TokenType.string:
+            yield event(jqsh.values.String(token.text))
+        elif token.type is TokenType.name:
+            raise SyntaxError('Illegal name token ' + repr(token.text) + ' at position ' + repr(position) + ' (expected false, null, or true)')
+        else:
+            raise illegal_token_exception(token, position=position, expected={TokenType.name, TokenType.number, TokenType.open_array, TokenType.open_object, TokenType.string, TokenType.trailing_whitespace})
+        state = JSONDecoderState.after_value if len(containers) else JSONDecoderState.value
+    if len(containers):
+        raise Incomplete('Unclosed JSON ' + ('object' if containers[-1] is TokenType.open_object else 'array') + ' in event stream')
+
+def parse_json_records(chunks, separator='\n', *, batch_size=1024, executor=None, max_pending_batches=8):
+    """Decodes a sequence of JSON records from an iterable of text chunks: newline-delimited JSON if separator is a newline, or an RFC 7464 JSON text sequence if it's the record separator '\x1e'.
+    
+    Each record is decoded on its own, so a malformed record yields an input exception instead of ending the input. Records are decoded in batches of those which have arrived with the same chunk. If an executor (like a concurrent.futures.ProcessPoolExecutor) is given, the batches are decoded in parallel by decode_json_records, and the values are still yielded in input order.
+    """
+    def record_values(batch, decoded_batch):
+        for (record_number, record), value in zip(batch, decoded_batch):
+            if isinstance(value, Exception):
+                try:
+                    yield parse_json(record) # the record may still be valid for the jqsh tokenizer
+                except (SyntaxError, Incomplete) as e:
+                    yield jqsh.values.JQSHException('input', python_exception=e, record=record_number)
             else:
-                has_next_operand = False
-        if ltr:
-            tokens.reverse()
+                yield jqsh.values.from_native(value)
     
-    if len(tokens) == 1 and isinstance(tokens[0], jqsh.filter.Filter):
-        return tokens[0] # finished parsing
-    else:
-        raise SyntaxError('Could not parse token list: ' + repr(tokens))
+    pending = collections.deque() # (batch, future) pairs, oldest first
+    for batch in split_records(chunks, separator, batch_size=batch_size):
+        if executor is None:
+            yield from record_values(batch, decode_json_records([record for record_number, record in batch]))
+            continue
+        pending.append((batch, executor.submit(decode_json_records, [record for record_number, record in batch])))
+        while len(pending) and (len(pending) > max_pending_batches or pending[0][1].done()):
+            done_batch, future = pending.popleft()
+            yield from record_values(done_batch, future.result())
+    for batch, future in pending:
+        yield from record_values(batch, future.result())
 
-def parse_json(tokens, allow_extension_types=False):
+def parse_json_values(tokens):
     if isinstance(tokens, str):
-        tokens = list(tokenize(tokens))
-    if len(tokens) == 0 or len(tokens) == 1 and isinstance(tokens[0], Token) and tokens[0].type is TokenType.trailing_whitespace:
-        raise Incomplete('JSON is empty')
-    if isinstance(tokens[-1], Token) and tokens[-1].type is TokenType.trailing_whitespace:
-        tokens.pop()
-    ret_path = []
-    key = None
-    token_index = 0
-    while token_index < len(tokens):
-        token = tokens[token_index]
-        if allow_extension_types and isinstance(token, jqsh.values.Value):
-            ret_path = set_value_at_ret_path(ret_path, key, token)
-            token_index += 1
-        elif token.type is TokenType.name:
-            if token.text == 'false':
-                ret_path = set_value_at_ret_path(ret_path, key, jqsh.values.Boolean(False))
-                token_index += 1
-            elif token.text == 'null':
-                ret_path = set_value_at_ret_path(ret_path, key, jqsh.values.Null())
-                token_index += 1
-            elif token.text == 'true':
-                ret_path = set_value_at_ret_path(ret_path, key, jqsh.values.Boolean(True))
-                token_index += 1
-            else:
-                raise SyntaxError('Illegal name token ' + repr(token.text) + ' at position ' + repr(token_index) + ' (expected false, null, or true)')
-        elif token.type is TokenType.number:
-            ret_path = set_value_at_ret_path(ret_path, key, jqsh.values.Number(token.text))
-            token_index += 1
-        elif token.type is TokenType.open_array:
-            array = jqsh.values.Array(terminated=False)
-            ret_path = set_value_at_ret_path(ret_path, key, array)
-            token_index += 1
-            if token_index >= len(tokens):
-                raise Incomplete('Unclosed JSON array at position ' + str(token_index))
-            if tokens[token_index].type is TokenType.close_array: # empty array parsed
-                array.terminate()
-                token_index += 1
+        tokens = tokenize(tokens)
+    decoder = JSONDecoder()
+    yield from decoder.decode(tokens)
+    decoder.close()
+
+def parse_plain_json_chunks(chunks):
+    """Decodes plain JSON values from an iterator of text chunks using the json module, yielding them as jqsh values.
+    
+    Returns the undecoded rest of the input when it encounters something that is not plain JSON. The caller should decode that rest, followed by the remaining chunks, using the jqsh tokenizer.
+    """
+    rest_string = ''
+    position = 0
+    failed_length = 0 # the length of the undecoded input when decoding it last failed because it was incomplete
+    read_length = 0 # the length of the input read since then
+    exhausted = False
+    while True:
+        position = plain_json_whitespace_pattern.match(rest_string, position).end()
+        if failed_length > 0 and not exhausted and read_length < failed_length and '\n' not in rest_string[len(rest_string) - read_length:]:
+            needs_input = True # retrying on every chunk would be quadratic for large values, wait until the input has doubled or a line has ended
+        elif position == len(rest_string):
+            needs_input = not exhausted
+            if exhausted:
+                return ''
+        else:
+            try:
+                value, end = plain_json_decoder.raw_decode(rest_string, position)
+            except json.JSONDecodeError as e:
+                if exhausted or not plain_json_incomplete(rest_string, e):
+                    return rest_string[position:]
+                failed_length = len(rest_string) - position
+                read_length = 0
+                needs_input = True
+            except ValueError: # a NaN or Infinity constant
+                return rest_string[position:]
             else:
-                ret_path.append(array)
-                continue
-        elif token.type is TokenType.open_object:
-            obj = jqsh.values.Object(terminated=False)
-            ret_path = set_value_at_ret_path(ret_path, key, obj)
-            token_index += 1
-            if token_index >= len(tokens):
-                raise Incomplete('Unclosed JSON object at position ' + str(token_index))
-            token = tokens[token_index]
-            if token.type is TokenType.close_object: # empty object parsed
-                obj.terminate()
-                token_index += 1
-            elif token.type is TokenType.string:
-                ret_path.append(obj)
-                key = token.text
-                token_index += 1
-                if token_index >= len(tokens):
-                    raise Incomplete('Unclosed JSON object at position ' + str(token_index))
-                elif tokens[token_index].type is not TokenType.colon:
-                    raise illegal_token_exception(token, position=token_index, expected={TokenType.colon})
+                if isinstance(value, decimal.Decimal) and not exhausted and plain_json_number_continuation_pattern.match(rest_string, end): # the number might continue in the next chunk
+                    failed_length = len(rest_string) - position
+                    read_length = 0
+                    needs_input = True
                 else:
-                    token_index += 1
-                    if token_index >= len(tokens):
-                        raise Incomplete('Unclosed JSON object at position ' + str(token_index))
+                    failed_length = 0
+                    position = end
+                    yield jqsh.values.from_native(value)
                     continue
+        if needs_input:
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                exhausted = True
+                failed_length = 0
             else:
-                raise illegal_token_exception(token, position=token_index, expected={TokenType.close_object, TokenType.string})
-        elif token.type is TokenType.string:
-            ret_path = set_value_at_ret_path(ret_path, key, token.text)
-            token_index += 1
-        else:
-            raise illegal_token_exception(token, position=token_index, expected={TokenType.name, TokenType.number, TokenType.open_array, TokenType.open_object, TokenType.string, TokenType.trailing_whitespace})
-        keep_closing = True
-        while keep_closing and len(ret_path) > 1:
-            if isinstance(ret_path[-1], jqsh.values.Object): # we are in an object, get the next key or close it
-                if token_index >= len(tokens):
-                    raise Incomplete('Unclosed JSON object at position ' + str(token_index))
-                token = tokens[token_index]
-                if token.type is TokenType.close_object:
-                    ret_path[-1].terminate()
-                    if len(ret_path) == 1:
-                        keep_closing = False
-                    else:
-                        ret_path.pop()
-                    token_index += 1
-                elif token.type is TokenType.comma:
-                    token_index += 1
-                    if token_index >= len(tokens):
-                        raise Incomplete('Unclosed JSON object at position ' + str(token_index))
-                    token = tokens[token_index]
-                    if token.type is TokenType.string:
-                        key = token.text
-                        token_index += 1
-                        if token_index >= len(tokens):
-                            raise Incomplete('Unclosed JSON object at position ' + str(token_index))
-                        elif tokens[token_index].type is not TokenType.colon:
-                            raise illegal_token_exception(token, position=token_index, expected={TokenType.colon})
-                        else:
-                            token_index += 1
-                            if token_index >= len(tokens):
-                                raise Incomplete('Unclosed JSON object at position ' + str(token_index))
-                            keep_closing = False
-                    else:
-                        raise illegal_token_exception(token, position=token_index, expected={TokenType.string})
-                else:
-                    raise illegal_token_exception(token, position=token_index, expected={TokenType.close_object, TokenType.comma})
-            else: # we are in an array, check if it continues
-                if token_index >= len(tokens):
-                    raise Incomplete('Unclosed JSON array at position ' + str(token_index))
-                token = tokens[token_index]
-                if token.type is TokenType.close_array:
-                    ret_path[-1].terminate()
-                    if len(ret_path) == 1:
-                        keep_closing = False
-                    else:
-                        ret_path.pop()
-                    token_index += 1
-                elif token.type is TokenType.comma:
-                    token_index += 1
-                    if token_index >= len(tokens):
-                        raise Incomplete('Unclosed JSON array at position ' + str(token_index))
-                    keep_closing = False
-                else:
-                    raise illegal_token_exception(token, position=token_index, expected={TokenType.close_array, TokenType.comma})
-    if token_index < len(tokens):
-        raise SyntaxError('Multiple top-level JSON values found')
-    return ret_path[0]
+                if len(rest_string) == 0 and chunk.startswith('\ufeff'):
+                    chunk = chunk[1:] # byte order mark at the start of the input
+                rest_string = rest_string[position:] + chunk
+                position = 0
+                read_length += len(chunk)
 
-def parse_json_values(tokens):
+def parse_statements(tokens, *, line_numbers=False):
+    """Parses jqsh code (a string or an iterable of tokens) one top-level statement at a time, yielding (statement, last) pairs.
+    
+    Statements are separated by semicolons outside of parens, and each one is parsed as soon as the semicolon after it has been read, so tokens can come from a file that is still being read. Joining the statements with jqsh.filter.Semicolon gives the same filter as parse.
+    """
     if isinstance(tokens, str):
-        tokens = list(tokenize(tokens))
-    if len(tokens) and tokens[-1].type is TokenType.trailing_whitespace:
-        tokens = tokens[:-1]
-    prefix_length = 1
-    last_exception = None
-    while len(tokens):
-        if prefix_length > len(tokens):
-            raise last_exception
-        try:
-            yield parse_json(tokens[:prefix_length])
-            tokens = tokens[prefix_length:]
-            prefix_length = 1
-        except Incomplete as e:
-            last_exception = e
-            prefix_length += 1
-
-def set_value_at_ret_path(ret_path, key, value):
-    if len(ret_path):
-        if isinstance(ret_path[-1], jqsh.values.Object):
-            ret_path[-1].push((key, value))
-        else:
-            ret_path[-1].push(value)
-        return ret_path
+        tokens = tokenize(tokens)
+    depth = 0
+    statement_tokens = []
+    for token in tokens:
+        if token.type is TokenType.semicolon and depth == 0:
+            yield parse(statement_tokens, line_numbers=line_numbers), False
+            statement_tokens = []
+            continue
+        if token.type in matching_parens or token.type is TokenType.string_start or token.type is TokenType.name and token.text in keyword_parens:
+            depth += 1
+        elif token.type in matching_parens.values() or token.type is TokenType.string_end or token.type is TokenType.name and token.text == 'end':
+            depth -= 1
+        statement_tokens.append(token)
+    yield parse(statement_tokens, line_numbers=line_numbers), True
+
+def plain_json_incomplete(json_string, error):
+    """Returns whether the json module's error could go away if more input was appended to json_string."""
+    rest_string = json_string[error.pos:]
+    if error.pos >= len(json_string) or error.msg.startswith('Unterminated string'):
+        return True
+    elif error.msg == 'Expecting value':
+        return any(literal.startswith(rest_string) for literal in ('-', 'false', 'null', 'true'))
+    elif error.msg.startswith('Invalid \\uXXXX escape'):
+        return len(rest_string) < len('ud83d\\ude00') # the escape, or the second half of a surrogate pair, might be cut off
     else:
-        return [value]
-
-def tokenize(jqsh_string):
-    def shift(rest_string, line, column, amount=1):
-        for _ in range(amount):
-            removed_character = rest_string[0]
-            rest_string = rest_string[1:]
-            if removed_character == '\n':
-                line += 1
-                column = 0
-            else:
-                column += 1
-        return rest_string, line, column
-    
+        return False
+
+def reject_json_constant(name):
+    raise ValueError('not a plain JSON constant: ' + name)
+
+def split_records(chunks, separator, batch_size=1024):
+    """Splits text chunks into records at the separator, yielding lists of up to batch_size (record number, record) pairs. Records which are empty or contain only whitespace are skipped, record numbers start at 1 and count them too, so they are line numbers for newline-delimited input."""
+    rest_pieces = [] # the chunks of the last record, which may continue in the next chunk
+    rest_tail = '' # the end of the last record, where a separator that ends in the next chunk could start
+    record_number = 0
+    for chunk in chunks:
+        if record_number == 0 and not any(rest_pieces) and chunk.startswith('\ufeff'):
+            chunk = chunk[1:] # byte order mark at the start of the input
+        if separator not in rest_tail + chunk: # the pieces of a long record are only joined once it is complete
+            rest_pieces.append(chunk)
+            rest_tail = (rest_tail + chunk)[-(len(separator) - 1):] if len(separator) > 1 else ''
+            continue
+        records = ''.join(rest_pieces + [chunk]).split(separator)
+        rest_pieces = [records.pop()]
+        rest_tail = rest_pieces[0][-(len(separator) - 1):] if len(separator) > 1 else ''
+        batch = []
+        for record in records:
+            record_number += 1
+            if len(record) and not record.isspace():
+                batch.append((record_number, record))
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+        if len(batch):
+            yield batch
+    rest_string = ''.join(rest_pieces)
+    if len(rest_string) and not rest_string.isspace():
+        yield [(record_number + 1, rest_string)]
+
+def tokenize(jqsh_string, line=1, column=0):
+    """Splits jqsh code (or JSON) into tokens. The optional line and column are those of the first character, for when jqsh_string is a part of a larger text."""
     rest_string = jqsh_string
     if not isinstance(rest_string, str):
         rest_string = rest_string.decode('utf-8')
+    length = len(rest_string)
+    position = 0 # the scanner's cursor into rest_string, everything before it has been tokenized
     whitespace_prefix = ''
-    if rest_string.startswith('\ufeff'):
+    if line == 1 and column == 0 and rest_string.startswith('\ufeff'):
         whitespace_prefix += rest_string[0]
-        rest_string = rest_string[1:]
-    line = 1
-    column = 0
+        position = 1
+    line_start = position - column # the position of the first character of the current line, used to compute columns
     parens_stack = []
-    while len(parens_stack) and parens_stack[-1] < 0 or len(rest_string):
-        if len(parens_stack) and parens_stack[-1] < 0 or rest_string[0] == '"':
+    while len(parens_stack) and parens_stack[-1] < 0 or position < length:
+        if len(parens_stack) == 0:
+            match = scalar_token_pattern.match(rest_string, position)
+            if match is not None: # the common case of a name, number, string without escapes or symbol other than a paren, after optional whitespace, as in JSON
+                token_start = match.end(1)
+                if token_start > position:
+                    whitespace = match.group(1)
+                    whitespace_prefix += whitespace
+                    newlines = whitespace.count('\n')
+                    if newlines:
+                        line += newlines
+                        line_start = rest_string.rindex('\n', position, token_start) + 1
+                    position = token_start
+                token_kind = match.lastgroup
+                if token_kind == 'symbol':
+                    yield Token(symbols[match.group(token_kind)], token_string=whitespace_prefix + match.group(token_kind), line=line, column=position - line_start)
+                elif token_kind == 'string':
+                    yield Token(TokenType.string, token_string=whitespace_prefix + rest_string[position:match.end()], text=match.group(token_kind), line=line, column=position - line_start + 1)
+                else:
+                    yield Token(TokenType.name if token_kind == 'name' else TokenType.number, token_string=whitespace_prefix + match.group(token_kind), text=match.group(token_kind), line=line, column=position - line_start)
+                whitespace_prefix = ''
+                position = match.end()
+                continue
+        if len(parens_stack) and parens_stack[-1] < 0 or rest_string[position] == '"':
             if len(parens_stack) and parens_stack[-1] < 0:
                 token_type = TokenType.string_end_incomplete
-                string_literal = ')'
+                string_literal = [')']
                 parens_stack.pop()
                 string_start_line = line
-                string_start_column = column - 1
+                string_start_column = position - line_start - 1
             else:
-                rest_string, line, column = shift(rest_string, line, column)
+                position += 1
                 token_type = TokenType.string_incomplete
-                string_literal = '"'
+                string_literal = ['"']
                 string_start_line = line
-                string_start_column = column
-            string_content = ''
-            while len(rest_string):
-                if rest_string[0] == '"':
+                string_start_column = position - line_start
+            string_content = []
+            while position < length:
+                match = string_characters_pattern.match(rest_string, position)
+                if match is not None:
+                    characters = match.group()
+                    string_literal.append(characters)
+                    string_content.append(characters)
+                    newlines = characters.count('\n')
+                    if newlines:
+                        line += newlines
+                        line_start = rest_string.rindex('\n', position, match.end()) + 1
+                    position = match.end()
+                elif rest_string[position] == '"':
                     token_type = {
                         TokenType.string_end_incomplete: TokenType.string_end,
                         TokenType.string_incomplete: TokenType.string
                     }[token_type]
-                    string_literal += '"'
-                    rest_string, line, column = shift(rest_string, line, column)
+                    string_literal.append('"')
+                    position += 1
                     break
-                elif rest_string[0] == '\\':
-                    rest_string, line, column = shift(rest_string, line, column)
-                    if rest_string[0] in escapes:
-                        string_literal += '\\' + rest_string[0]
-                        string_content += escapes[rest_string[0]]
-                        rest_string, line, column = shift(rest_string, line, column)
-                    elif rest_string[0] == 'u':
-                        try:
-                            escape_sequence = int(rest_string[1:5], 16)
-                        except (IndexError, ValueError):
-                            yield Token(token_type, token_string=whitespace_prefix + string_literal, text=string_content, line=string_start_line, column=string_start_column)
-                            yield Token(TokenType.illegal, token_string=whitespace_prefix + rest_string, text=rest_string, line=line, column=column)
+                else: # backslash
+                    position += 1
+                    if position < length and rest_string[position] in escapes:
+                        string_literal.append('\\' + rest_string[position])
+                        string_content.append(escapes[rest_string[position]])
+                        position += 1
+                    elif rest_string.startswith('u', position):
+                        match = unicode_escape_pattern.match(rest_string, position)
+                        if match is None:
+                            yield Token(token_type, token_string=whitespace_prefix + ''.join(string_literal), text=''.join(string_content), line=string_start_line, column=string_start_column)
+                            yield Token(TokenType.illegal, token_string=whitespace_prefix + rest_string[position:], text=rest_string[position:], line=line, column=position - line_start)
                             return
-                        else:
-                            string_literal += '\\' + rest_string[:5]
-                            string_content += chr(escape_sequence) #TODO check for UTF-16 surrogate characters
-                            rest_string, line, column = shift(rest_string, line, column, amount=5)
-                    elif rest_string[0] == '(':
-                        string_literal += '\\('
+                        string_literal.append('\\' + match.group())
+                        string_content.append(chr(int(match.group(1), 16))) #TODO check for UTF-16 surrogate characters
+                        position = match.end()
+                    elif rest_string.startswith('(', position):
+                        string_literal.append('\\(')
                         parens_stack.append(0)
                         token_type = {
                             TokenType.string_end_incomplete: TokenType.string_middle,
                             TokenType.string_incomplete: TokenType.string_start
                         }[token_type]
-                        rest_string, line, column = shift(rest_string, line, column)
+                        position += 1
                         break
                     else:
-                        yield Token(token_type, token_string=whitespace_prefix + string_literal, text=string_content, line=string_start_line, column=string_start_column)
-                        yield Token(TokenType.illegal, token_string=whitespace_prefix + '\\' + rest_string, text='\\' + rest_string, line=line, column=column)
+                        yield Token(token_type, token_string=whitespace_prefix + ''.join(string_literal), text=''.join(string_content), line=string_start_line, column=string_start_column)
+                        yield Token(TokenType.illegal, token_string=whitespace_prefix + '\\' + rest_string[position:], text='\\' + rest_string[position:], line=line, column=position - line_start)
                         return
-                else:
-                    string_literal += rest_string[0]
-                    string_content += rest_string[0]
-                    rest_string, line, column = shift(rest_string, line, column)
-            yield Token(token_type, token_string=whitespace_prefix + string_literal, text=string_content, line=string_start_line, column=string_start_column)
+            yield Token(token_type, token_string=whitespace_prefix + ''.join(string_literal), text=''.join(string_content), line=string_start_line, column=string_start_column)
             whitespace_prefix = ''
-        elif rest_string[0] in string.whitespace:
-            whitespace_prefix += rest_string[0]
-            rest_string, line, column = shift(rest_string, line, column)
-        elif rest_string[0] == '#':
-            comment_start_line = line
-            comment_start_column = column
-            rest_string, line, column = shift(rest_string, line, column)
-            comment = ''
-            while len(rest_string):
-                if rest_string[0] == '\n':
-                    break
-                comment += rest_string[0]
-                rest_string, line, column = shift(rest_string, line, column)
-            yield Token(TokenType.comment, token_string=whitespace_prefix + '#' + comment, text=comment, line=comment_start_line, column=comment_start_column)
+            continue
+        character = rest_string[position]
+        if character in whitespace_characters:
+            match = whitespace_pattern.match(rest_string, position)
+            whitespace = match.group()
+            whitespace_prefix += whitespace
+            newlines = whitespace.count('\n')
+            if newlines:
+                line += newlines
+                line_start = rest_string.rindex('\n', position, match.end()) + 1
+            position = match.end()
+        elif character == '#':
+            match = comment_pattern.match(rest_string, position)
+            yield Token(TokenType.comment, token_string=whitespace_prefix + match.group(), text=match.group()[1:], line=line, column=position - line_start)
             whitespace_prefix = ''
-        elif rest_string[0] in string.ascii_letters:
-            name_start_line = line
-            name_start_column = column
-            name = ''
-            while len(rest_string) and rest_string[0] in string.ascii_letters:
-                name += rest_string[0]
-                rest_string, line, column = shift(rest_string, line, column)
-            yield Token(TokenType.name, token_string=whitespace_prefix + name, text=name, line=name_start_line, column=name_start_column)
+            position = match.end()
+        elif character in name_characters:
+            match = name_pattern.match(rest_string, position)
+            yield Token(TokenType.name, token_string=whitespace_prefix + match.group(), text=match.group(), line=line, column=position - line_start)
             whitespace_prefix = ''
-        elif rest_string[0] in string.digits:
-            number_start_line = line
-            number_start_column = column
-            number = ''
-            while len(rest_string) and rest_string[0] in string.digits:
-                number += rest_string[0]
-                rest_string, line, column = shift(rest_string, line, column)
-            yield Token(TokenType.number, token_string=whitespace_prefix + number, text=number, line=number_start_line, column=number_start_column)
+            position = match.end()
+        elif character in number_characters:
+            match = number_pattern.match(rest_string, position)
+            yield Token(TokenType.number, token_string=whitespace_prefix + match.group(), text=match.group(), line=line, column=position - line_start)
             whitespace_prefix = ''
-        elif any(rest_string.startswith(symbol) for symbol in symbols):
-            for symbol, token_type in sorted(symbols.items(), key=lambda pair: -len(pair[0])): # look at longer symbols first, so that a += is not mistakenly tokenized as a +
-                if rest_string.startswith(symbol):
-                    if len(parens_stack):
-                        if token_type is TokenType.open_paren:
-                            parens_stack[-1] += 1
-                        elif token_type is TokenType.close_paren:
-                            parens_stack[-1] -= 1
-                    if len(parens_stack) == 0 or parens_stack[-1] >= 0:
-                        yield Token(token_type, token_string=whitespace_prefix + rest_string[:len(symbol)], line=line, column=column)
-                        whitespace_prefix = ''
-                    rest_string, line, column = shift(rest_string, line, column, amount=len(symbol))
-                    break
+            position = match.end()
         else:
-            yield Token(TokenType.illegal, token_string=whitespace_prefix + rest_string, text=rest_string, line=line, column=column)
-            return
+            match = symbol_pattern.match(rest_string, position) # longer symbols come first in the pattern, so that a += is not mistakenly tokenized as a +
+            if match is None:
+                yield Token(TokenType.illegal, token_string=whitespace_prefix + rest_string[position:], text=rest_string[position:], line=line, column=position - line_start)
+                return
+            token_type = symbols[match.group()]
+            if len(parens_stack):
+                if token_type is TokenType.open_paren:
+                    parens_stack[-1] += 1
+                elif token_type is TokenType.close_paren:
+                    parens_stack[-1] -= 1
+            if len(parens_stack) == 0 or parens_stack[-1] >= 0:
+                yield Token(token_type, token_string=whitespace_prefix + match.group(), line=line, column=position - line_start)
+                whitespace_prefix = ''
+            position = match.end()
     if len(whitespace_prefix):
         yield Token(TokenType.trailing_whitespace, token_string=whitespace_prefix)
+
+def tokenize_chunks(chunks):
+    """Tokenizes jqsh code (or JSON) arriving as an iterable of text chunks, see ChunkTokenizer."""
+    tokenizer = ChunkTokenizer()
+    for chunk in chunks:
+        yield from tokenizer.feed(chunk)
+    yield from tokenizer.close()
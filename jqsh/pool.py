@@ -0,0 +1,105 @@
+import sys
+
+import jqsh.evaluation
+import queue
+import threading
+import traceback
+
+class Job:
+    """A function call submitted to a WorkerPool. Can be joined like a thread. It works for the evaluation of the thread that submitted it, see jqsh.evaluation.Evaluation."""
+    def __init__(self, target, args=(), kwargs=None):
+        self.target = target
+        self.args = args
+        self.kwargs = {} if kwargs is None else kwargs
+        self.done = threading.Event()
+        self.evaluation = jqsh.evaluation.current()
+        if self.evaluation is not None:
+            self.evaluation.add_job(self)
+    
+    def join(self, timeout=None):
+        self.done.wait(timeout)
+    
+    def run(self):
+        """Calls the function. Its exceptions are printed, like those of a thread. The worker sets the done event afterwards."""
+        previous = jqsh.evaluation.switch(self.evaluation)
+        try:
+            self.target(*self.args, **self.kwargs)
+        except Exception:
+            print('Exception in jqsh worker running ' + getattr(self.target, '__qualname__', repr(self.target)) + ':', file=sys.stderr)
+            traceback.print_exc()
+        finally:
+            jqsh.evaluation.switch(previous)
+
+class WorkerPool:
+    """Runs the short-lived plumbing jobs of channels and filters, such as passing namespaces on or copying values into split channels, on reusable worker threads.
+    
+    These jobs often block until another job has made progress, so a job never waits for a free worker: if none is idle, a new one is started. Workers that have finished a job wait idle_timeout seconds for the next one, and at most max_idle_workers of them are kept, so the number of threads is bounded by the number of jobs that are actually running at the same time.
+    Only idle workers are capped: running workers are not, since a cap could deadlock jobs that wait for each other. A deep pipeline on the threads engine still has one thread per running job, i.e. a few per filter, see peak_workers in stats.
+    Workers are daemon threads. Everything that waits for the output of a job joins it, so the only jobs that can be cut off at exit are those whose results nobody is waiting for, e.g. copying an endless input into a split channel.
+    """
+    def __init__(self, max_idle_workers=64, idle_timeout=5.0):
+        self.max_idle_workers = max_idle_workers
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.job_queue = queue.SimpleQueue()
+        self.busy_workers = 0
+        self.idle_workers = 0
+        self.jobs_started = 0
+        self.jobs_reused_worker = 0
+        self.peak_workers = 0
+        self.workers_started = 0
+    
+    def start(self, target, *args, **kwargs):
+        """Runs target(*args, **kwargs) on a worker and returns the Job."""
+        job = Job(target, args, kwargs)
+        with self.lock:
+            self.jobs_started += 1
+            self.busy_workers += 1
+            if self.idle_workers > 0:
+                self.idle_workers -= 1
+                self.jobs_reused_worker += 1
+                self.job_queue.put(job)
+                return job
+            self.workers_started += 1
+            self.peak_workers = max(self.peak_workers, self.busy_workers + self.idle_workers)
+        threading.Thread(target=self.work, args=(job,), name='jqsh worker', daemon=True).start()
+        return job
+    
+    def stats(self):
+        """Returns a dict of metrics: the numbers of jobs started, of those that reused an idle worker, of worker threads started, the peak number of worker threads, and the current numbers of busy and idle workers."""
+        with self.lock:
+            return {
+                'jobs_started': self.jobs_started,
+                'jobs_reused_worker': self.jobs_reused_worker,
+                'workers_started': self.workers_started,
+                'peak_workers': self.peak_workers,
+                'busy_workers': self.busy_workers,
+                'idle_workers': self.idle_workers
+            }
+    
+    def work(self, job):
+        while True:
+            job.run()
+            with self.lock:
+                self.busy_workers -= 1
+                keep_worker = self.idle_workers < self.max_idle_workers
+                if keep_worker:
+                    self.idle_workers += 1
+            job.done.set() # only now, so that a job started after joining this one can reuse this worker
+            if not keep_worker:
+                return
+            try:
+                job = self.job_queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self.lock:
+                    try:
+                        job = self.job_queue.get_nowait() # a job may have been handed to this worker while the timeout expired
+                    except queue.Empty:
+                        self.idle_workers -= 1
+                        return
+
+default_pool = WorkerPool()
+
+def start(target, *args, **kwargs):
+    """Runs target(*args, **kwargs) on a worker of the default pool and returns the Job, which can be joined like a thread."""
+    return default_pool.start(target, *args, **kwargs)
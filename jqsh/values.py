@@ -23,7 +23,7 @@ def from_native(python_object):
     elif isinstance(python_object, bool):
         return Boolean(python_object)
     elif isinstance(python_object, dict):
-        return Object(python_object)
+        return Object.lazily(python_object.items()) # nested values are only converted when the object is read
     elif isinstance(python_object, str):
         return String(python_object)
     try:
@@ -34,7 +34,7 @@ def from_native(python_object):
         except (TypeError, decimal.InvalidOperation) as e:
             raise TypeError('cannot convert Python object of type ' + repr(python_object.__class__) + ' to a jqsh value') from e
     else:
-        return Array(python_object)
+        return Array.lazily(python_object) # items are only converted when the array is read
 
 @functools.total_ordering
 class Value(abc.ABC):
@@ -53,6 +53,10 @@ class Value(abc.ABC):
     def __repr__(self):
         return 'jqsh.values.' + self.__class__.__name__ + '(' + repr(self.value) + ')'
     
+    def close(self):
+        """Values are shared by all their readers, so unlike a channel (see jqsh.channel.Channel.close), a string, array or object is not abandoned when a generator reading it with yield from is closed."""
+        pass
+    
     def print_to_terminal(self, terminal, output_file):
         for line in self.syntax_highlight_lines(terminal):
             print(line, file=output_file, flush=True)
@@ -102,6 +106,8 @@ class JQSHException(Value):
         yield '\rjqsh: uncaught exception: ' + self.name
         if self.name == 'assignment' and 'target_filter' in self.kwargs:
             yield 'cannot assign to filter of type ' + self.kwargs['target_filter'].__class__.__name__
+        elif self.name == 'input' and 'python_exception' in self.kwargs:
+            yield 'could not decode input' + (' record ' + str(self.kwargs['record']) if 'record' in self.kwargs else '') + ': ' + str(self.kwargs['python_exception'])
         elif self.name == 'internal' and 'exc_info' in self.kwargs:
             yield from self.kwargs['traceback_string'].strip('\n').split('\n')
         elif self.name == 'name' and 'missing_name' in self.kwargs:
@@ -110,6 +116,8 @@ class JQSHException(Value):
             yield 'filter ' + self.kwargs['filter'].__class__.__name__ + ' not yet implemented' + (' for attributes ' + repr(self.kwargs['attributes']) if 'attributes' in self.kwargs else '')
         elif self.name == 'numArgs' and 'expected' in self.kwargs:
             yield 'wrong number of function arguments: ' + ('received ' + str(self.kwargs['received']) + ', ') + 'expected ' + ('any of ' if len(self.kwargs['expected']) > 1 else '') + ', '.join(str(num_args) for num_args in sorted(self.kwargs['expected']))
+        elif self.name == 'syntax' and 'python_exception' in self.kwargs:
+            yield 'syntax error: ' + str(self.kwargs['python_exception'])
 
 class Null(Value):
     value = None
@@ -266,7 +274,7 @@ class String(Value, jqsh.channel.Channel, collections.abc.Sequence):
             if len(self.value_store) > key:
                 return self.value_store[key]
             try:
-                self.pop()
+                self.pop_many()
             except StopIteration as e:
                 if len(self.value_store) > key:
                     return self.value_store[key]
@@ -283,8 +291,8 @@ class String(Value, jqsh.channel.Channel, collections.abc.Sequence):
         for index in itertools.count():
             try:
                 yield self[index]
-            except IndexError as e:
-                raise StopIteration('Reached end of jqsh string') from e
+            except IndexError:
+                return # reached end of jqsh string (raising StopIteration inside a generator is an error since PEP 479)
     
     def __len__(self):
         while not self.terminated:
@@ -332,16 +340,16 @@ class String(Value, jqsh.channel.Channel, collections.abc.Sequence):
             value.encode('utf-16')
         except UnicodeEncodeError as e:
             raise ValueError(error_message) from e
-        with self.input_lock:
-            if self.input_terminated:
-                raise RuntimeError('jqsh channel has terminated')
-            self.value_queue.put(value)
+        with self.lock:
+            self.accept_input()
+            self.put_values([value])
     
     def serializable(self):
         return True #TODO add support for extended strings(regex), mark them as unserializable
     
     def store_value(self, value):
         self.value_store += value
+        return value
     
     def syntax_highlight_lines(self, terminal):
         import jqsh.filter
@@ -391,7 +399,7 @@ class Array(Value, jqsh.channel.Channel, collections.abc.Sequence):
             if len(self.value_store) > key:
                 return self.value_store[key]
             try:
-                self.pop()
+                self.pop_many()
             except StopIteration as e:
                 if len(self.value_store) > key:
                     return self.value_store[key]
@@ -405,19 +413,26 @@ class Array(Value, jqsh.channel.Channel, collections.abc.Sequence):
     
     def __init__(self, values=(), terminated=True):
         self.value_store = []
-        super().__init__(*values, terminated=terminated)
+        super().__init__(terminated=False)
+        if isinstance(values, jqsh.channel.Channel) and not isinstance(values, Value): # the output of a filter, which can be read in batches
+            for batch in values.batches():
+                self.push_many(batch)
+        else:
+            self.push_many(values)
+        if terminated:
+            self.terminate()
     
     def __iter__(self):
         for index in itertools.count():
             try:
                 yield self[index]
-            except IndexError as e:
-                raise StopIteration('Reached end of jqsh array') from e
+            except IndexError:
+                return # reached end of jqsh array (raising StopIteration inside a generator is an error since PEP 479)
     
     def __len__(self):
         while not self.terminated:
             with contextlib.suppress(StopIteration):
-                self.pop()
+                self.pop_many()
         return len(self.value_store)
     
     def __lt__(self, other):
@@ -443,7 +458,9 @@ class Array(Value, jqsh.channel.Channel, collections.abc.Sequence):
         return all(serializable(item) for item in self)
     
     def store_value(self, value):
+        value = from_native(value)
         self.value_store.append(value)
+        return value
     
     def syntax_highlight_lines(self, terminal):
         if not terminal.does_styling:
@@ -558,7 +575,10 @@ class Object(Value, jqsh.channel.Channel, collections.abc.Mapping):
     
     def store_value(self, value):
         key, value = value
+        key = from_native(key)
+        value = from_native(value)
         self.value_store[key] = value
+        return key, value
     
     def syntax_highlight_lines(self, terminal):
         if not terminal.does_styling:
@@ -1,11 +1,37 @@
 #!/usr/bin/env python3
 
+import asyncio
 import collections
 import decimal
+import io
+import jqsh.cache
+import jqsh.channel
+import jqsh.cli
+import jqsh.compiler
+import jqsh.context
+import jqsh.evaluation
+import jqsh.filter
+import jqsh.optimizer
+import jqsh.parser
+import jqsh.pool
 import jqsh.values
+import os
+import pathlib
+import queue
+import tempfile
+import threading
+import time
 import unittest
 
 class JQSHTests(unittest.TestCase):
+    def assertOutputs(self, the_filter, expected, input_values=(), *, engines=('threads', 'generators', 'compiled'), deadline=None):
+        """Asserts that the filter (a jqsh.filter.Filter or a string to parse) outputs the expected values, given as jqsh values or as Python objects, with each of the engines."""
+        if isinstance(the_filter, str):
+            the_filter = jqsh.parser.parse(the_filter)
+        for engine in engines:
+            output_channel = jqsh.cli.start_filter(the_filter, jqsh.channel.Channel(*input_values, terminated=True), engine=engine, deadline=None if deadline is None else time.monotonic() + deadline)
+            self.assertEqual(list(output_channel), [jqsh.values.from_native(value) for value in expected], (the_filter, engine))
+    
     def test_value_abcs(self):
         with self.assertRaises(TypeError):
             jqsh.values.Value()
@@ -62,6 +88,410 @@ class JQSHTests(unittest.TestCase):
         for i in range(len(values) - 1):
             for j in range(i + 1, len(values)):
                 self.assertLess(values[i], values[j])
+    
+    def test_tokenize(self):
+        jqsh_string = '"a\\(1 + (2))b"\n  # c\nfoo 12'
+        tokens = list(jqsh.parser.tokenize(jqsh_string))
+        self.assertEqual(''.join(token.string for token in tokens), jqsh_string)
+        self.assertEqual([(token.type, token.text, token.line, token.column) for token in tokens], [
+            (jqsh.parser.TokenType.string_start, 'a', 1, 1),
+            (jqsh.parser.TokenType.number, '1', 1, 4),
+            (jqsh.parser.TokenType.plus, None, 1, 6),
+            (jqsh.parser.TokenType.open_paren, None, 1, 8),
+            (jqsh.parser.TokenType.number, '2', 1, 9),
+            (jqsh.parser.TokenType.close_paren, None, 1, 10),
+            (jqsh.parser.TokenType.string_end, 'b', 1, 11),
+            (jqsh.parser.TokenType.comment, ' c', 2, 2),
+            (jqsh.parser.TokenType.name, 'foo', 3, 0),
+            (jqsh.parser.TokenType.number, '12', 3, 4)
+        ])
+        self.assertEqual([token.type for token in jqsh.parser.tokenize('"\\u00e9\\x')], [jqsh.parser.TokenType.string_incomplete, jqsh.parser.TokenType.illegal])
+        for chunk_size in (1, 2, 5):
+            self.assertEqual([(token.type, token.string, token.text, token.line, token.column) for token in jqsh.parser.tokenize_chunks(jqsh_string[i:i + chunk_size] for i in range(0, len(jqsh_string), chunk_size))], [(token.type, token.string, token.text, token.line, token.column) for token in tokens])
+
+        def tokenize_string_in_chunks(length):
+            json_string = '["' + 'a\\n\\u00e9' * (length // 8) + '", 1]'
+            start = time.perf_counter()
+            tokens = list(jqsh.parser.tokenize_chunks(json_string[i:i + 4096] for i in range(0, len(json_string), 4096)))
+            self.assertEqual(len(tokens[1].text), length // 8 * 3)
+            return time.perf_counter() - start
+
+        self.assertLess(min(tokenize_string_in_chunks(2 ** 20) for _ in range(2)), 8 * min(tokenize_string_in_chunks(2 ** 18) for _ in range(2))) # a string spanning many chunks is tokenized in linear time, 4 times the input would take 16 times as long otherwise
+
+    def test_parse_json_events(self):
+        json_string = '{"a": [1, {"x": 2}], "b": {}} 3 [[]]'
+        events = list(jqsh.parser.parse_json_events(jqsh.parser.tokenize_chunks(json_string[i:i + 3] for i in range(0, len(json_string), 3))))
+        self.assertEqual([str(event) for event in events], ['[["a", 0], 1]', '[["a", 1, "x"], 2]', '[["a", 1, "x"]]', '[["a", 1]]', '[["b"], {}]', '[["b"]]', '[[], 3]', '[[0], []]', '[[0]]'])
+        self.assertEqual(list(jqsh.parser.parse('fromStream').start(jqsh.channel.Channel(*events, terminated=True, empty_namespaces=True))), list(jqsh.parser.parse_json_values(json_string)))
+        self.assertEqual([str(event) for event in jqsh.parser.parse('toStream').start(jqsh.channel.Channel(*jqsh.parser.parse_json_values(json_string), terminated=True, empty_namespaces=True))], [str(event) for event in events])
+        events = jqsh.parser.parse_json_events('[{"a": 1}, 2, {"b": [3]}]')
+        self.assertEqual(list(jqsh.parser.parse('truncateStream 1 | fromStream').start(jqsh.channel.Channel(*events, terminated=True, empty_namespaces=True))), [jqsh.values.Object([('a', 1)]), jqsh.values.Object([('b', [3])])])
+        with self.assertRaises(jqsh.parser.Incomplete):
+            list(jqsh.parser.parse_json_events('[1, {"a": 2}'))
+    
+    def test_parse_json_records(self):
+        json_string = '{"a": 1}\n[1, 2\n\n3 4\n"\u00e9"\n  \n5'
+        values = list(jqsh.parser.parse_json_records(json_string[i:i + 3] for i in range(0, len(json_string), 3)))
+        self.assertEqual(values, [jqsh.values.Object([('a', 1)]), jqsh.values.JQSHException('input'), jqsh.values.JQSHException('input'), jqsh.values.String('\u00e9'), jqsh.values.Number(5)])
+        self.assertEqual([value.kwargs['record'] for value in values if isinstance(value, jqsh.values.JQSHException)], [2, 4])
+        self.assertEqual(list(jqsh.parser.parse_json_records(['\x1e{"a":\n 1}\n\x1e2\n'], '\x1e')), [jqsh.values.Object([('a', 1)]), jqsh.values.Number(2)])
+        self.assertEqual(list(jqsh.parser.split_records(['"ab', 'c', 'd"\r', '\n1\r', '\n'], '\r\n')), [[(1, '"abcd"')], [(2, '1')]]) # records and separators spanning chunks
+        channel = jqsh.channel.Channel(empty_namespaces=True)
+        error_file = io.StringIO()
+        jqsh.cli.read_input(io.BytesIO(b'1\n[\n2\n'), channel, record_separator='\n', error_file=error_file)
+        self.assertEqual(list(channel), [jqsh.values.Number(1), jqsh.values.Number(2)])
+        self.assertIn('input', error_file.getvalue())
+    
+    def test_parse_statements(self):
+        jqsh_string = '$a = 2; $b = [$a, ($a; 3)]; if true then $b; 4 else 5 end;'
+        statements = list(jqsh.parser.parse_statements(jqsh.parser.tokenize_chunks(jqsh_string[i:i + 4] for i in range(0, len(jqsh_string), 4))))
+        self.assertEqual([last for statement, last in statements], [False, False, False, True])
+        self.assertEqual(repr(jqsh.cache.join_statements(statement for statement, last in statements)), repr(jqsh.parser.parse(jqsh_string)))
+        self.assertEqual(list(jqsh.filter.Module(jqsh.parser.parse_statements('$a = 2; $b = [$a]; [$b, $a]')).start()), [jqsh.values.Array([[2], 2])])
+        self.assertEqual(list(jqsh.filter.Module(jqsh.parser.parse_statements('$a = 2; [$a]; (')).start()), [jqsh.values.JQSHException('syntax')])
+        for statements, expected in (('$a = 2; $b = [$a]; [$b, $a]', [jqsh.values.Array([[2], 2])]), ('$a = 2; [$a]; (', [jqsh.values.JQSHException('syntax')]), ('', [])):
+            self.assertOutputs(jqsh.filter.Module(jqsh.parser.parse_statements(statements) if statements else []), expected, engines=('threads', 'generators', 'compiled', 'threads')) # the parsed statements are kept, so the module can run again
+    
+    def test_parse_json_values(self):
+        json_string = '{"a": [1, true, {}], "b": "c\\u00e9"} null\n[[], "d"]'
+        expected = [jqsh.values.Object([('a', [1, True, {}]), ('b', 'c\u00e9')]), jqsh.values.Null(), jqsh.values.Array([[], 'd'])]
+        self.assertEqual(list(jqsh.parser.parse_json_values(json_string)), expected)
+        for chunk_size in range(1, 8):
+            self.assertEqual(list(jqsh.parser.parse_json_chunks(json_string[i:i + chunk_size] for i in range(0, len(json_string), chunk_size))), expected)
+        with self.assertRaises(jqsh.parser.Incomplete):
+            list(jqsh.parser.parse_json_values('1 [2, {"e": 3}'))
+        with self.assertRaises(SyntaxError):
+            list(jqsh.parser.parse_json_values('[1 2]'))
+    
+    def test_output_pairs(self):
+        for filter_string, expected in (('[(3 | range) + (10, 20)]', [10, 21, 12]), ('[(10, 20) * (3 | range)]', [0, 20, 20]), ('[empty + (1, 2)]', [1, 2]), ('[(1, 2) + empty]', [1, 2]), ('(100000000 | range) + 1 | nth 2', 3), ('"a" * (100000000 | range) | nth 2', 'aa')): # operands are paired as they arrive, so a single value can be paired with a huge stream
+            self.assertOutputs(filter_string, [expected], deadline=30)
+    
+    def test_parse(self):
+        self.assertEqual(repr(jqsh.parser.parse('1 + 2 * 3 | ., 4')), "jqsh.filter.Pipe(left=jqsh.filter.Add(left=jqsh.filter.NumberLiteral('1'), right=jqsh.filter.Multiply(left=jqsh.filter.NumberLiteral('2'), right=jqsh.filter.NumberLiteral('3'))), right=jqsh.filter.Comma(left=jqsh.filter.Apply(), right=jqsh.filter.NumberLiteral('4')))")
+        self.assertEqual(repr(jqsh.parser.parse('$a = 1; if $a then [.] else {} end')), "jqsh.filter.Semicolon(left=jqsh.filter.Assign(left=jqsh.filter.GlobalVariable(jqsh.filter.Name('a')), right=jqsh.filter.NumberLiteral('1')), right=jqsh.filter.Conditional([('if', jqsh.filter.GlobalVariable(jqsh.filter.Name('a'))), ('then', jqsh.filter.Array(jqsh.filter.Apply())), ('else', jqsh.filter.Object())]))")
+        self.assertEqual(repr(jqsh.parser.parse('[' * 200 + '1' + ']' * 200)), 'jqsh.filter.Array(' * 200 + "jqsh.filter.NumberLiteral('1')" + ')' * 200) # only paren nesting recurses
+        for incomplete in ('(1', '[1 | (2', 'if true then 1', '( $', '[ !'): # an unclosed paren takes precedence over the errors inside it
+            with self.assertRaises(jqsh.parser.Incomplete):
+                jqsh.parser.parse(incomplete)
+        for invalid in ('1)', '[1}', 'if true then 1 ]', 'end'):
+            with self.assertRaises(SyntaxError):
+                jqsh.parser.parse(invalid)
+    
+    def test_module_cache(self):
+        with tempfile.TemporaryDirectory() as temp_directory:
+            module_path = pathlib.Path(temp_directory) / 'module.jqsh'
+            module_path.write_text('[1, 2] | .0\n')
+            self.assertEqual(repr(jqsh.cache.load_module(module_path)), repr(jqsh.parser.parse('[1, 2] | .0')))
+            self.assertTrue(jqsh.cache.cache_path(module_path).exists())
+            self.assertEqual(repr(jqsh.cache.load_module(module_path)), repr(jqsh.parser.parse('[1, 2] | .0')))
+            module_path.write_text('{}\n')
+            os.utime(str(module_path), ns=(0, 0)) # a different mtime, in case both writes happened within the resolution of the file system's timestamps
+            self.assertEqual(repr(jqsh.cache.load_module(module_path)), 'jqsh.filter.Object()')
+            module_path.write_text('[\n')
+            with self.assertRaises(jqsh.parser.Incomplete):
+                jqsh.cache.load_module(module_path)
+        self.assertIs(jqsh.cache.parse('. | .'), jqsh.cache.parse('. | .'))
+    
+    def test_plain_json_input(self):
+        json_string = '{"a": [1, true, {}], "b": "c\\u00e9"} -1.5 [[], "d"]'
+        self.assertEqual(list(jqsh.parser.parse_json_chunks([json_string])), [jqsh.values.Object([('a', [1, True, {}]), ('b', 'c\u00e9')]), jqsh.values.Number('-1.5'), jqsh.values.Array([[], 'd'])])
+        for chunk_size in range(1, 8):
+            self.assertEqual(list(jqsh.parser.parse_json_chunks(json_string[i:i + chunk_size] for i in range(0, len(json_string), chunk_size))), list(jqsh.parser.parse_json_chunks([json_string])))
+        self.assertEqual(list(jqsh.parser.parse_json_chunks(['12', '3 "a\nb" 4'])), [jqsh.values.Number(123), jqsh.values.String('a\nb'), jqsh.values.Number(4)]) # the raw newline is not plain JSON, so the jqsh tokenizer takes over
+    
+    def test_read_chunks(self):
+        with tempfile.TemporaryDirectory() as temp_directory:
+            input_path = pathlib.Path(temp_directory) / 'input.json'
+            input_path.write_text('[1, "\u00e9\u4e2d"] 2' * 3, encoding='utf-8')
+            for memory_map in (False, True):
+                with input_path.open(encoding='utf-8') as input_file:
+                    self.assertEqual(''.join(jqsh.cli.read_chunks(input_file, chunk_size=3, memory_map=memory_map)), '[1, "\u00e9\u4e2d"] 2' * 3)
+            with input_path.open('rb') as input_file:
+                self.assertIsNotNone(jqsh.cli.map_file(input_file)[0])
+                input_file.read(4)
+                self.assertEqual(''.join(jqsh.cli.read_chunks(input_file)), '"\u00e9\u4e2d"] 2' + '[1, "\u00e9\u4e2d"] 2' * 2)
+            input_path.write_text('')
+            with input_path.open('rb') as input_file:
+                self.assertEqual(list(jqsh.cli.read_chunks(input_file)), [])
+    
+    def test_read_input(self):
+        channel = jqsh.channel.Channel(empty_namespaces=True)
+        jqsh.cli.read_input(io.BytesIO('[1, "\u00e9"] {"a": null}'.encode('utf-8')), channel, chunk_size=3)
+        self.assertEqual(list(channel), [jqsh.values.Array([1, '\u00e9']), jqsh.values.Object([('a', None)])])
+        channel = jqsh.channel.Channel(empty_namespaces=True)
+        jqsh.cli.read_input(io.BytesIO(b'1 [2'), channel)
+        self.assertEqual(list(channel), [jqsh.values.Number(1), jqsh.values.JQSHException('input')])
+    
+    def test_channel_batches(self):
+        channel = jqsh.channel.Channel(0, 1, capacity=3)
+        writer = jqsh.pool.start(channel.push_many, range(2, 5)) # more values than fit
+        self.assertEqual(channel.pop_many(max_values=2), [jqsh.values.Number(0), jqsh.values.Number(1)])
+        self.assertEqual(channel.pop(), jqsh.values.Number(2))
+        writer.join()
+        channel.push_many([])
+        channel.push(5)
+        channel.terminate()
+        self.assertEqual([value for values in channel.batches() for value in values], [jqsh.values.Number(value) for value in range(3, 6)])
+        self.assertRaises(StopIteration, channel.pop_many)
+        for filter_string, output in (('[1000 | range] | .999', [999]), ('[(3 | range), "x", (2 | range)]', [[0, 1, 2, 'x', 0, 1]]), ('[(1, 2) | each (. * 10)]', [[10, 20]]), ('[1000 | range | . * 2] | .500', [1000]), ('1.5 | range', [jqsh.values.JQSHException('integer')])):
+            self.assertEqual(list(jqsh.parser.parse(filter_string).start(jqsh.channel.Channel(terminated=True))), [jqsh.values.from_native(value) for value in output])
+    
+    def test_channel_core(self):
+        channel = jqsh.channel.Channel()
+        self.assertRaises(queue.Empty, channel.pop, wait=False)
+        reader = jqsh.pool.start(lambda: channel.local_namespace)
+        reader.join(timeout=0.1)
+        self.assertFalse(reader.done.is_set()) # waits for the namespace to be defined
+        channel.local_namespace = {}
+        reader.join()
+        source = jqsh.channel.Channel(1, 2)
+        puller = jqsh.pool.start(channel.pull, source, terminate=False)
+        for _ in range(100): # the pusher must start after the pull has begun
+            if channel.pulling:
+                break
+            time.sleep(0.01)
+        self.assertTrue(channel.pulling)
+        pusher = jqsh.pool.start(channel.push, 3)
+        pusher.join(timeout=0.1)
+        self.assertFalse(pusher.done.is_set()) # other writers wait until the pull is done
+        source.terminate()
+        puller.join()
+        pusher.join()
+        channel.throw('end')
+        channel.terminate() # terminating again has no effect
+        self.assertRaises(RuntimeError, channel.push, 4)
+        self.assertEqual(list(channel), [jqsh.values.Number(1), jqsh.values.Number(2), jqsh.values.Number(3), jqsh.values.JQSHException('end')])
+        self.assertEqual(channel.global_namespace, {}) # defined by throw
+    
+    def test_channel_capacity(self):
+        channel = jqsh.channel.Channel(capacity=2)
+        writer = jqsh.pool.start(lambda: [channel.push(value) for value in range(3)])
+        writer.join(timeout=0.2)
+        self.assertFalse(writer.done.is_set()) # the third value doesn't fit
+        self.assertEqual(channel.pop(), jqsh.values.Number(0))
+        writer.join()
+        channel.throw('full') # throwing never blocks
+        self.assertEqual(list(channel), [jqsh.values.Number(1), jqsh.values.Number(2), jqsh.values.JQSHException('full')])
+        channel = jqsh.channel.Channel(1, capacity=1)
+        writer = jqsh.pool.start(lambda: [channel.push(value) for value in range(1000)])
+        channel.abandon()
+        writer.join() # the values are dropped instead
+        jqsh.channel.default_capacity = 1
+        try:
+            for filter_string, output in (('[(3, 2) | range]', [jqsh.values.Array([0, 1, 2, 0, 1])]), ('100 | range; 1', [jqsh.values.Number(1)]), ('1000 | range | nth 2', [jqsh.values.Number(2)]), ('(1000 | range; 2) | . * 2', [jqsh.values.Number(4)])):
+                self.assertEqual(list(jqsh.parser.parse(filter_string).start(jqsh.channel.Channel(terminated=True))), output)
+        finally:
+            jqsh.channel.default_capacity = 0
+    
+    def test_channel_split(self):
+        numbers = [jqsh.values.Number(number) for number in range(5)]
+        source = jqsh.channel.Channel(*numbers[:2])
+        first, second, third = source / 3
+        source.push_many(numbers[2:]) # pushed after splitting
+        source.terminate()
+        self.assertRaises(RuntimeError, first.push, 5)
+        self.assertEqual(first.take_first(), numbers[0])
+        self.assertEqual(list(second), numbers)
+        self.assertEqual(len(third.tee.buffer), 5) # kept for the third channel only
+        third.abandon()
+        self.assertEqual(len(third.tee.buffer), 0)
+        left, right = jqsh.channel.Channel(*numbers, terminated=True) / 2
+        left, middle = left / 2
+        self.assertEqual([list(left), list(middle), list(right)], [numbers] * 3)
+    
+    def test_compiler(self):
+        the_filter = jqsh.parser.parse('$n = 2; [1, 2] | .1 * $n, (x = 3 | x + 1)')
+        compiled_filter = jqsh.compiler.compile_filter(the_filter)
+        self.assertIs(jqsh.compiler.compile_filter(the_filter), compiled_filter) # compiled trees are cached
+        self.assertNotIn('evaluate', vars(the_filter)) # the parse tree is not modified
+        self.assertIn('evaluate', vars(compiled_filter))
+        for _ in range(2): # a compiled tree can be run more than once
+            output_channel = jqsh.cli.start_filter(the_filter, jqsh.channel.Channel(terminated=True), engine='compiled')
+            self.assertEqual(list(output_channel), [jqsh.values.Number(4)] * 2)
+            self.assertEqual(output_channel.global_namespace, {'n': [jqsh.values.Number(2)]})
+    
+    def test_conditional(self):
+        for filter_string, expected in (('[(1, null, 2, false) | if . then . * 10 else "no" end]', [[10, 'no', 20, 'no']]), ('[(1, null, 2) | if . then [.] end]', [[[1], [2]]]), ('if true then 1 else 2 end', [1]), ('[10000 | range | if . then . + 1 else "no" end] | .0, .9999', [1, 10000])): # each value goes to its own branch, and without input values the branch still runs
+            self.assertOutputs(filter_string, expected)
+        start = time.monotonic()
+        output_channel = jqsh.cli.start_filter(jqsh.parser.parse('[10000 | range | if [.] then (., 1) else 0 end] | .19999'), jqsh.channel.Channel(terminated=True), engine='threads')
+        self.assertEqual(list(output_channel), [jqsh.values.Number(1)])
+        self.assertLess(time.monotonic() - start, 5) # conditions and branches which don't map each value don't start a thread per value either
+    
+    def test_try(self):
+        for filter_string, expected in (('[try (1, ("a" | range), 3) catch type then "t" end]', [[1, 't']]), ('[try (1, 2) else "e" end]', [['e']]), ('try (1, ("a" | range)) end', [1, jqsh.values.JQSHException('type')]), ('try (100000000 | range) catch "t" end | nth 2', [2])): # values before the exception are forwarded as they arrive
+            self.assertOutputs(filter_string, expected)
+    
+    def test_optimizer(self):
+        for filter_string, expected in (('(1 + 2) * 1.5', 'jqsh.filter.NumberLiteral(\'4.5\')'), ('((. | [("a" * 2, .)]))', 'jqsh.filter.Array(jqsh.filter.Comma(left=jqsh.filter.StringLiteral(\'aa\'), right=jqsh.filter.Apply()))'), ('"a" + 1', 'jqsh.filter.Add(left=jqsh.filter.StringLiteral(\'a\'), right=jqsh.filter.NumberLiteral(\'1\'))'), ('(x = 1) | .', 'jqsh.filter.Parens(jqsh.filter.Assign(left=jqsh.filter.Name(\'x\'), right=jqsh.filter.NumberLiteral(\'1\')))')):
+            the_filter = jqsh.parser.parse(filter_string)
+            self.assertEqual(repr(jqsh.optimizer.optimize(the_filter)), expected, filter_string)
+            self.assertEqual(repr(the_filter), repr(jqsh.parser.parse(filter_string))) # the parse tree is not modified
+        optimized_filter, rewrites = jqsh.optimizer.explain(jqsh.parser.parse('(1 + 2) * 1.5'))
+        self.assertEqual([repr(rewritten) for _, rewritten in rewrites], ['jqsh.filter.NumberLiteral(\'3\')'] * 2 + ['jqsh.filter.NumberLiteral(\'4.5\')'])
+        previous_enabled = jqsh.optimizer.enabled
+        try:
+            for filter_string in ('(1 + 2) * 1.5, "a" + 1', '(x = 1) | .; x', '(x = 1); x', '[(3 | range) | (.) * (2 + 1.5)]', '$a = 2; . | $a'):
+                outputs = []
+                for enabled in (False, True):
+                    jqsh.optimizer.enabled = enabled
+                    output_channel = jqsh.cli.start_filter(jqsh.parser.parse(filter_string), jqsh.channel.Channel(jqsh.values.Number(1), terminated=True))
+                    outputs.append((list(output_channel), [{name: list(values) for name, values in namespace.items()} for namespace in output_channel.namespaces()]))
+                self.assertEqual(outputs[1], outputs[0], filter_string)
+            for filter_string in ('(.)', '((.))', '. | .', '1 . 5', '. | [.]', '[.] | .'): # with an exception in the input
+                for engine in ('threads', 'generators', 'compiled'):
+                    outputs = []
+                    for enabled in (False, True):
+                        jqsh.optimizer.enabled = enabled
+                        outputs.append(list(jqsh.cli.start_filter(jqsh.parser.parse(filter_string), jqsh.channel.Channel(jqsh.values.Number(1), jqsh.values.JQSHException('x'), jqsh.values.Number(3), terminated=True), engine=engine)))
+                    self.assertEqual(outputs[1], outputs[0], (filter_string, engine))
+        finally:
+            jqsh.optimizer.enabled = previous_enabled
+    
+    def test_cancellation(self):
+        channel = jqsh.channel.Channel(jqsh.values.Number(1))
+        channel.close() # like abandon, so that yield from propagates it
+        self.assertTrue(channel.abandoned)
+        for engine in ('threads', 'generators', 'compiled'):
+            for filter_string in ('1000000 | range | nth 0', '(1000000 | range), 1 | nth 0', '1000000 | range | each (.) | nth 0'):
+                output_channel = jqsh.cli.start_filter(jqsh.parser.parse(filter_string), jqsh.channel.Channel(terminated=True), engine=engine)
+                self.assertEqual(list(output_channel), [jqsh.values.Number(0)], (engine, filter_string))
+                for _ in range(100): # the producers stop soon after the output is abandoned, instead of running until the range is exhausted
+                    if jqsh.pool.default_pool.stats()['busy_workers'] == 0:
+                        break
+                    time.sleep(0.05)
+                else:
+                    self.fail('filter still running after nth: {} ({})'.format(filter_string, engine))
+    
+    def test_deadline(self):
+        for engine in ('threads', 'generators', 'compiled'):
+            with self.subTest(engine=engine):
+                start = time.monotonic()
+                output_channel = jqsh.cli.start_filter(jqsh.parser.parse('1 | !"sleep" "30" | . + 1'), jqsh.channel.Channel(terminated=True), engine=engine, deadline=time.monotonic() + 0.3)
+                self.assertEqual(list(output_channel), [jqsh.values.JQSHException('timeout')])
+                self.assertLess(time.monotonic() - start, 10)
+                self.assertTrue(output_channel.evaluation.stopped.wait(10))
+                self.assertEqual(output_channel.evaluation.report['processes'], 1)
+        output_channel = jqsh.parser.parse('[100000000 | range]').start(deadline=time.monotonic() + 0.3) # the API of Filter.start
+        self.assertEqual(list(output_channel), [jqsh.values.JQSHException('timeout')])
+    
+    def test_evaluation_cancel(self):
+        for engine in ('threads', 'compiled'):
+            with self.subTest(engine=engine):
+                output_channel = jqsh.cli.start_filter(jqsh.parser.parse('1 | !"sleep" "30"'), jqsh.channel.Channel(terminated=True), engine=engine)
+                evaluation = output_channel.evaluation
+                if engine == 'compiled': # the generator engine only starts the command when its output is read
+                    reader = jqsh.pool.start(list, output_channel)
+                for _ in range(100):
+                    if len(evaluation.processes):
+                        break
+                    time.sleep(0.05)
+                process = next(iter(evaluation.processes.values()))()
+                report = evaluation.cancel()
+                self.assertEqual(report['processes'], 1)
+                self.assertEqual(report['threads_running'] + report['jobs_running'], 0)
+                self.assertLess(process.wait(timeout=10), 0) # killed by a signal
+                self.assertIsNone(evaluation.cancel()) # only once
+                if engine == 'compiled':
+                    reader.join()
+        channel = jqsh.channel.Channel(1, 2)
+        reader = jqsh.pool.start(lambda: self.assertEqual(list(channel), [jqsh.values.JQSHException('cancelled')]))
+        channel.cancel(jqsh.values.JQSHException('cancelled')) # the waiting values are replaced by the exception, and the blocked reader stops
+        reader.join()
+        channel.push(3) # dropped
+        self.assertEqual(channel.global_namespace, {})
+        evaluation = jqsh.evaluation.Evaluation()
+        output_channel = evaluation.start(jqsh.parser.parse('100000000 | range'), jqsh.channel.LazyChannel((), namespaces=({}, {}, {}, jqsh.context.FilterContext())))
+        self.assertEqual(next(output_channel), jqsh.values.Number(0))
+        evaluation.cancel(jqsh.values.JQSHException('cancelled'))
+        self.assertEqual(list(output_channel), [jqsh.values.JQSHException('cancelled')]) # the generator engine checks for cancellation as values are read, see jqsh.evaluation.Cancelled
+    
+    def test_fusion(self):
+        the_filter = jqsh.optimizer.optimize(jqsh.parser.parse('. | ."a" | ."b" + 1 | [.]'))
+        self.assertIsInstance(the_filter.left_operand, jqsh.filter.Fused) # the lookups and the addition run as one stage
+        self.assertIsInstance(the_filter.right_operand, jqsh.filter.Array)
+        records = list(jqsh.parser.parse_json_values('{"a": {"b": 1}} {"a": {"b": 2}}'))
+        for filter_string, input_values, expected in (('. | ."a" | ."b" + 1 | [.]', records, [jqsh.values.Array([2, 3])]), ('."a" | ."b" * 2', records, [jqsh.values.Number(2), jqsh.values.Number(4)]), ('. + 1', [], [jqsh.values.Number(1)]), ('."a" | .0', records, [jqsh.values.JQSHException('key')])):
+            self.assertOutputs(filter_string, expected, input_values)
+    
+    def test_engines(self):
+        for filter_string in ('1 + 2 * 3, "ab" * 2', '[1, [2, {"a": 3}]] | [toStream] | .2', '(3, 2) | range', '5 | range | reduce 0 (. + 1)', 'if null then 1 elif . then 2 end', 'try "a" | range catch type then "t" end', '$a = (1, 2); b = 3; [$a, b]', '"ab" | explode | implode', 'foo'):
+            outputs = {}
+            for engine in ('threads', 'generators', 'compiled'):
+                output_channel = jqsh.cli.start_filter(jqsh.parser.parse(filter_string), jqsh.channel.Channel(jqsh.values.Number(1), terminated=True), engine=engine)
+                outputs[engine] = list(output_channel), [{name: list(values) for name, values in namespace.items()} for namespace in output_channel.namespaces()]
+            self.assertEqual(outputs['generators'], outputs['threads'], filter_string)
+            self.assertEqual(outputs['compiled'], outputs['threads'], filter_string)
+        for filter_string in ('[.] | .0', '(., .) | . + 1', '[.]', 'if . then [.] end', 'try [.] end', '., 1', '1', '"s"', '', '1.5', '{"k": .}', 'x = 1; x', '$a = 5; $a', 'true'): # the output for the values before an input exception comes before it, and the exception is output even by filters which don't read their input
+            outputs = {}
+            for engine in ('threads', 'generators', 'compiled'):
+                output_channel = jqsh.cli.start_filter(jqsh.parser.parse(filter_string), jqsh.channel.Channel(jqsh.values.Number(1), jqsh.values.JQSHException('x'), jqsh.values.Number(3), terminated=True), engine=engine)
+                outputs[engine] = list(output_channel)
+            self.assertIn(jqsh.values.JQSHException('x') if '=' not in filter_string else jqsh.values.JQSHException('name'), outputs['threads'], filter_string) # the value of an assignment contains the exception, so the variable is not defined
+            self.assertEqual(outputs['generators'], outputs['threads'], filter_string)
+            self.assertEqual(outputs['compiled'], outputs['threads'], filter_string)
+            self.assertEqual(asyncio.run(jqsh.parser.parse(filter_string).run_async([1, jqsh.values.JQSHException('x'), 3])), outputs['threads'], filter_string)
+        for filter_string, expected in (('1', [jqsh.values.Number(1), jqsh.values.JQSHException('x')]), ('true', [jqsh.values.Boolean(True), jqsh.values.JQSHException('x')]), ('nth 0', [jqsh.values.Number(1)])): # whether an input exception is output doesn't depend on how far the input has been read when the filter is done
+            for i in range(200):
+                input_channel = jqsh.channel.Channel(jqsh.values.Number(1), empty_namespaces=True)
+                writer = jqsh.pool.start(lambda: (time.sleep(i % 3 * 0.001), input_channel.push_many([jqsh.values.JQSHException('x'), jqsh.values.Number(3)]), input_channel.terminate())) # the exception usually arrives after the filter is done
+                self.assertEqual(list(jqsh.cli.start_filter(jqsh.parser.parse(filter_string), input_channel, engine='threads')), expected, filter_string)
+                writer.join()
+        output_channel = jqsh.cli.start_filter(jqsh.parser.parse('1000 | range | reduce 0 (. + 1)'), jqsh.channel.Channel(terminated=True), engine='generators')
+        self.assertEqual(list(output_channel), [jqsh.values.Number(1000)]) # not limited by the recursion limit
+    
+    def test_asyncio(self):
+        async def run_filters():
+            for filter_string in ('1 + 2 * 3, "ab" * 2', '[1, [2, {"a": 3}]] | [toStream] | .2', 'if null then 1 elif . then 2 end', 'try "a" | range catch type then "t" end', '$a = (1, 2); b = 3; [$a, b]', '"x": ."a"', '(1, 2) | !"cat" "-u"', 'foo'):
+                output_channel = jqsh.cli.start_filter(jqsh.parser.parse(filter_string), jqsh.channel.Channel(jqsh.values.Number(1), terminated=True))
+                self.assertEqual(await jqsh.parser.parse(filter_string).run_async([1]), list(output_channel), filter_string)
+            the_filter = jqsh.parser.parse('. | !"cat" | . * 2')
+            self.assertEqual(await asyncio.gather(*(the_filter.run_async([i]) for i in range(50))), [[jqsh.values.Number(2 * i), jqsh.values.JQSHException('commandOutput')] for i in range(50)]) # concurrent evaluations on one event loop
+            start = time.monotonic()
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(jqsh.parser.parse('1 | !"sleep" "30" | . + 1').run_async(), 0.3)
+            self.assertLess(time.monotonic() - start, 10)
+            ticks = []
+
+            async def tick():
+                while True:
+                    ticks.append(time.monotonic())
+                    await asyncio.sleep(0.01)
+
+            ticker = asyncio.ensure_future(tick())
+            self.assertEqual(await jqsh.parser.parse('[1] | each (!"sleep" "0.3")').run_async(), [])
+            ticker.cancel()
+            self.assertGreater(len(ticks), 5) # a command in the body of a builtin doesn't block the event loop
+            for _ in range(100): # cancelling the evaluation cancels all of its tasks
+                if len(asyncio.all_tasks()) == 1:
+                    break
+                await asyncio.sleep(0.05)
+            else:
+                self.fail('tasks still running after cancellation')
+        
+        asyncio.run(run_filters())
+    
+    def test_worker_pool(self):
+        pool = jqsh.pool.WorkerPool(max_idle_workers=1)
+        for _ in range(3):
+            pool.start(lambda: None).join()
+        self.assertEqual(pool.stats()['workers_started'], 1)
+        event = threading.Event()
+        waiting_job = pool.start(event.wait) # a job that waits for another one must not keep it from starting
+        pool.start(event.set).join()
+        waiting_job.join()
+        self.assertEqual(pool.stats()['jobs_started'], 5)
+        self.assertEqual(pool.stats()['jobs_reused_worker'], 3)
+        previous_enabled = jqsh.optimizer.enabled
+        try:
+            for enabled in (False, True): # an exception in the input comes after the output for the values before it, however the jobs are scheduled
+                jqsh.optimizer.enabled = enabled
+                for _ in range(40):
+                    output_channel = jqsh.cli.start_filter(jqsh.parser.parse('."c" | .0'), jqsh.channel.Channel(*jqsh.parser.parse_json_values('{"c": [1, 2]} {"c": []} 3'), terminated=True))
+                    self.assertEqual(list(output_channel), [jqsh.values.Number(1), jqsh.values.JQSHException('index')], enabled)
+        finally:
+            jqsh.optimizer.enabled = previous_enabled
 
 if __name__ == '__main__':
     unittest.main()